@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import argparse, time
+import numpy as np
+import pandas as pd
+from tuba_seq.fastq import MasterRead, IterFASTQ, default_master_read
+from tuba_seq.batch_align import pack_reads
+from tuba_seq.shared import logPrint
+
+parser = argparse.ArgumentParser(description="Compare the speed & concordance of the SSW and banded alignment engines.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('input_fastq', type=str, help='FASTQ file of (merged) amplicon reads.')
+parser.add_argument('--master_read', type=str, default=default_master_read, help='Outline of the amplicon sequence (see preprocess.py).')
+parser.add_argument('-n', '--reads', type=int, default=1000000, help='Maximum number of reads to align.')
+parser.add_argument('--threads', type=int, default=1, help='Threads used by each engine.')
+parser.add_argument('-a', '--allowable_deviation', type=int, default=4, help="Length of Indel to tolerate (sets the bandwidth of the banded engine).")
+parser.add_argument('--alignment_flank', type=int, default=22, help='# of bases flanking the degenerate region to be aligned.')
+parser.add_argument('--trim', default='symmetric', help='Trimming of reads before alignment (see preprocess.py).')
+###############################################################################
+
+args = parser.parse_args()
+Log = logPrint(args)
+args.training_flank = args.cluster_flank = args.alignment_flank
+args.ClonTracer = False
+args.min_align_score = 0
+args.aligner = 'banded'
+
+master_read = MasterRead(args.master_read, args)
+reads = []
+for header, DNA, QC in IterFASTQ(args.input_fastq):
+    reads.append(DNA[master_read.pre_slice])
+    if len(reads) >= args.reads:
+        break
+seqs, offsets = pack_reads(reads)
+
+engines = {'ssw': master_read.batch_aligner, 'banded': master_read.banded_aligner}
+outputs = {}
+timings = {}
+for name, engine in engines.items():
+    start = time.perf_counter()
+    outputs[name] = engine.align(seqs, offsets, threads=args.threads)
+    timings[name] = time.perf_counter() - start
+
+results = pd.DataFrame({name:{'Seconds':timings[name], 'Reads/s':len(reads)/timings[name]} for name in engines}).T
+Log("Aligned {:,} reads from {:}:".format(len(reads), args.input_fastq), True)
+Log(results.to_string(float_format='{:,.2f}'.format), True)
+
+accepted = outputs['banded'][0] > 0
+concordance = pd.Series({label:(ssw == banded)[accepted].mean() for label, ssw, banded in zip(['Score', 'Barcode Start', 'Barcode Stop'], outputs['ssw'], outputs['banded'])})
+Log("{:.2%} of reads did not align within the band (preprocess.py re-aligns these with SSW). Concordance of the remaining alignments:".format(1 - accepted.mean()), True)
+Log(concordance.to_string(float_format='{:.3%}'.format), True)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import argparse, time, os, tempfile
+import pandas as pd
+from tuba_seq.fastq import fastqDF
+from tuba_seq.shared import logPrint, smart_open, available_codecs, compression_ext
+
+parser = argparse.ArgumentParser(description="Benchmark the throughput of FASTQ writing & of every compression codec.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('input_fastq', type=str, help='FASTQ file to re-write.')
+parser.add_argument('--replicates', type=int, default=3, help='Number of timed writes per method (the fastest is reported).')
+parser.add_argument('--out_dir', type=str, default=tempfile.gettempdir(), help='Directory for the (deleted) output files.')
+parser.add_argument('--codecs', nargs='+', default=available_codecs(), help='Codecs to benchmark (--compression choices).')
+parser.add_argument('--level', type=int, default=None, help='Compression level of every codec (default: the default level of each codec).')
+parser.add_argument('--threads', type=int, default=None, help='Compression threads for bgzf & zst (default: all CPUs).')
+###############################################################################
+
+args = parser.parse_args()
+Log = logPrint(args)
+
+def to_csv_write(df, filename):
+    """Previous implementation of fastqDF.write (via DataFrame.to_csv)."""
+    header = df.info['Fake Header']
+    df = df.copy()
+    df.insert(1, 'header', header)
+    df.insert(2, '__plus_sign__', len(df)*['+'])
+    df.to_csv(filename, columns=['header', 'DNA', '__plus_sign__', 'QC'], compression='gzip', header=False, index=False, sep='\n')
+
+df = fastqDF.from_file(args.input_fastq)
+methods = {'DataFrame.to_csv':to_csv_write, 'fastqDF.write':fastqDF.write}
+
+def fastest(func, *func_args):
+    times = []
+    for i in range(args.replicates):
+        start = time.perf_counter()
+        func(*func_args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+############################## FASTQ Writers ##################################
+filename = os.path.join(args.out_dir, 'benchmark_io.fastq.gz')
+uncompressed_MB = sum(len(df.info['Fake Header']) + 2*L + 5 for L in df['DNA'].str.len())*1e-6
+timings = {name:fastest(method, df, filename) for name, method in methods.items()}
+os.remove(filename)
+
+results = pd.DataFrame({name:{'Seconds':seconds, 'Reads/s':len(df)/seconds, 'MB/s':uncompressed_MB/seconds} for name, seconds in timings.items()}).T
+Log("Wrote {:,} reads ({:.1f} MB uncompressed) from {:}:".format(len(df), uncompressed_MB, args.input_fastq), True)
+Log(results.to_string(float_format='{:,.2f}'.format), True)
+
+################################## Codecs #####################################
+with smart_open(args.input_fastq) as f:
+    data = f.read()
+MB = len(data)*1e-6
+
+def write(filename, codec):
+    with smart_open(filename, 'wb', compression=codec, level=args.level, threads=args.threads) as f:
+        f.write(data)
+
+def read(filename):
+    with smart_open(filename) as f:
+        f.read()
+
+codec_results = {}
+for codec in args.codecs:
+    filename = os.path.join(args.out_dir, 'benchmark_io.fastq'+compression_ext(codec))
+    write_time = fastest(write, filename, codec)
+    read_time = fastest(read, filename)
+    codec_results[codec] = {'Write MB/s':MB/write_time, 'Read MB/s':MB/read_time, 'Ratio':len(data)/os.path.getsize(filename)}
+    os.remove(filename)
+
+Log("Compression of {:} ({:.1f} MB uncompressed, level: {:}, threads: {:}):".format(
+    args.input_fastq, MB, 'default' if args.level is None else args.level, 'all CPUs' if args.threads is None else args.threads), True)
+Log(pd.DataFrame(codec_results).T.to_string(float_format='{:,.2f}'.format), True)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import argparse, time, os, sys, subprocess, platform, tempfile
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from tuba_seq.fastq import MasterRead, IterFASTQ, default_master_read
+from tuba_seq.shared import logPrint, compression_ext
+from tuba_seq.synthetic import SyntheticLibrary
+
+bin_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bin_dir)
+stages = ['generate', 'IterFASTQ', 'iter_fastq', 'fastq_map_sum', 'postprocess', 'final_processing', 'bootstrap']
+
+parser = argparse.ArgumentParser(description="""End-to-end benchmark of the pipeline on a synthetic Tuba-seq library. Timings of every
+stage are appended to a CSV results table (one row per stage, labeled by commit), so that runs can be compared across commits.""",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--sgRNA_file', default=os.path.join(repo_dir, 'sgRNA_info.csv'), help='sgRNAs (& their sgIDs) of the synthetic library.')
+parser.add_argument('--master_read', type=str, default=default_master_read, help='Outline of the amplicon sequence (see preprocess.py).')
+parser.add_argument('-n', '--reads', type=int, default=1000000, help='Reads in the synthetic FASTQ file.')
+parser.add_argument('--barcodes', type=int, default=1000, help='Tumors (barcodes) per sgRNA.')
+parser.add_argument('--error_rate', type=float, default=1e-3, help='Substitution probability per base.')
+parser.add_argument('--indel_rate', type=float, default=1e-5, help='Indel probability per base.')
+parser.add_argument('--N_rate', type=float, default=1e-3, help='N probability per base.')
+parser.add_argument('--contamination', type=float, default=0.01, help='Fraction of contaminating reads.')
+parser.add_argument('--contaminant_genome', type=str, default=None, help='FASTA file of the genome that contaminating reads are drawn from, e.g. PhiX174 (default: random sequence).')
+parser.add_argument('--samples', type=int, default=8, help='Samples of synthetic DADA2 clusters for postprocess.py & final_processing.py.')
+parser.add_argument('--bootstrap_samples', type=int, default=1000, help='Bootstrap samples drawn by the bootstrap stage.')
+parser.add_argument('--processes', type=int, default=max(os.cpu_count() - 1, 1), help='Worker processes of fastq_map_sum.')
+parser.add_argument('--seed', type=int, default=42, help='Seed of the synthetic library.')
+parser.add_argument('--stages', nargs='+', default=stages, choices=stages, help='Stages to benchmark (generate is always run).')
+parser.add_argument('--compression', default='gz', help='Compression of the synthetic FASTQ & of the outputs of preprocessing.')
+parser.add_argument('--work_dir', type=str, default=None, help='Directory of the synthetic data & outputs (default: a temporary directory).')
+parser.add_argument('-o', '--results', type=str, default='benchmark_results.csv', help='CSV table that the timings are appended to.')
+parser.add_argument('--label', type=str, default='', help='Free-text label of this run (e.g. the machine or the change being tested).')
+parser.add_argument('--alignment_flank', type=int, default=22, help='See preprocess.py.')
+parser.add_argument('--training_flank', type=int, default=22, help='See preprocess.py.')
+parser.add_argument('--cluster_flank', type=int, default=22, help='See preprocess.py.')
+parser.add_argument('-a', '--allowable_deviation', type=int, default=4, help='See preprocess.py.')
+parser.add_argument('-M', '--min_align_score', type=float, default=0.65, help='See preprocess.py.')
+parser.add_argument('--trim', default='symmetric', help='See preprocess.py.')
+parser.add_argument('--aligner', default='ssw', choices=['ssw', 'banded'], help='See preprocess.py.')
+parser.add_argument('--cache_size', type=int, default=0, help='See preprocess.py.')
+###############################################################################
+
+args = parser.parse_args()
+args.ClonTracer = False
+results_file = os.path.abspath(args.results)
+work_dir = os.path.abspath(args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='tuba_seq_benchmark'))
+os.makedirs(work_dir, exist_ok=True)
+os.chdir(work_dir)      # The scripts log into the working directory
+Log = logPrint(args)
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+results = []
+def record(stage, seconds, reads=np.nan, nbytes=np.nan, status='ok', **extra):
+    results.append(dict(Stage=stage, Seconds=seconds, Reads=reads,
+                        **{'Reads/s':reads/seconds if seconds > 0 else np.nan, 'MB/s':nbytes*1e-6/seconds if seconds > 0 else np.nan},
+                        Status=status, **extra))
+    rate = '{:,.0f} reads/s'.format(results[-1]['Reads/s']) if np.isfinite(results[-1]['Reads/s']) else ''
+    Log("{:<18} {:>9.2f}s {:>16}  {:}".format(stage, seconds, rate, status), True)
+
+def timed(stage, func, *func_args, **kargs):
+    """Runs & records a stage; returns its output (None, if it failed)."""
+    start = time.perf_counter()
+    try:
+        output = func(*func_args)
+    except Exception as e:
+        record(stage, time.perf_counter() - start, status='{:}: {:}'.format(type(e).__name__, e).replace('\n', ' '))
+        return None
+    seconds = time.perf_counter() - start
+    record(stage, seconds, **{key:(value(output) if callable(value) else value) for key, value in kargs.items()})
+    return output
+
+def run_script(script, *script_args):
+    process = subprocess.run([sys.executable, os.path.join(bin_dir, script)] + list(script_args), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        errors = process.stderr.decode(errors='replace').strip().splitlines()
+        raise RuntimeError("{:} failed: {:}".format(script, errors[-1] if errors else 'exit code {:}'.format(process.returncode)))
+
+################################ Synthetic Data ###############################
+ext = compression_ext(args.compression)
+fastq = os.path.join(work_dir, 'synthetic.fastq'+ext)
+library = SyntheticLibrary(args.sgRNA_file, args.master_read, barcodes=args.barcodes, seed=args.seed)
+timed('generate', library.write_fastq, fastq, args.reads, args.error_rate, args.indel_rate, args.N_rate, args.contamination, args.contaminant_genome,
+      reads=args.reads, nbytes=lambda output: os.path.getsize(fastq))
+library.truth().to_csv(os.path.join(work_dir, 'truth.csv'), index=False)
+
+def outputs(name):
+    filenames = [os.path.join(work_dir, name, Dir, 'synthetic'+suffix+ext) for Dir, suffix in [('training', '.fastq'), ('preprocessed', '.fastq'), ('unaligned', '.fasta')]]
+    for f in filenames:
+        os.makedirs(os.path.dirname(f), exist_ok=True)
+        if os.path.isfile(f):
+            os.remove(f)
+    return filenames
+
+################################ Preprocessing ################################
+master_read = MasterRead(args.master_read, args)
+if 'IterFASTQ' in args.stages:
+    timed('IterFASTQ', lambda: sum(1 for read in IterFASTQ(fastq)), reads=args.reads, nbytes=lambda output: os.path.getsize(fastq))
+
+if 'iter_fastq' in args.stages:
+    output = timed('iter_fastq', master_read.iter_fastq, IterFASTQ(fastq), outputs('serial'), reads=args.reads, nbytes=lambda output: output[4]['Bytes In'])
+    if output is not None:
+        results[-1].update({'Clustered':output[0]['Clustered'], **output[4].to_dict()})
+
+if 'fastq_map_sum' in args.stages:
+    from tuba_seq.pmap import fastq_map_sum
+    output = timed('fastq_map_sum', lambda: fastq_map_sum(fastq, outputs('parallel'), master_read.iter_fastq, CPUs=args.processes), reads=args.reads, nbytes=lambda output: output[4]['Bytes In'])
+    if output is not None:
+        results[-1].update({'Clustered':output[0]['Clustered'], **output[4].to_dict()})
+
+############################### Postprocessing ################################
+clustered_dir = os.path.join(work_dir, 'clustered')
+library.write_clusters(clustered_dir, args.samples, reads_per_sample=args.reads)
+clusters = len(library.tumors)*args.samples
+if 'postprocess' in args.stages:
+    timed('postprocess', run_script, 'postprocess.py', args.sgRNA_file, '--dir', clustered_dir, '-o', 'combined.csv', Clusters=clusters)
+if 'final_processing' in args.stages:
+    timed('final_processing', run_script, 'final_processing.py', '-i', 'combined.csv.gz', Clusters=clusters)
+
+def target_means(df):
+    return df.groupby('target')['size'].mean()
+
+if 'bootstrap' in args.stages:
+    from tuba_seq.bootstrap import sample
+    timed('bootstrap', lambda: sample(library.tumors, target_means, N=args.bootstrap_samples, map=map), Clusters=len(library.tumors))
+
+################################## Results ####################################
+run = dict(Commit=commit(), Date=datetime.now().isoformat(timespec='seconds'), Label=args.label, Host=platform.node(), CPUs=os.cpu_count(),
+           Python=platform.python_version(), Processes=args.processes, Input_Reads=args.reads, Barcodes=args.barcodes, Error_Rate=args.error_rate,
+           Indel_Rate=args.indel_rate, N_Rate=args.N_rate, Contamination=args.contamination, Compression=args.compression)
+table = pd.DataFrame([dict(run, **result) for result in results])
+if os.path.isfile(results_file):
+    table = pd.concat([pd.read_csv(results_file), table], ignore_index=True, sort=False)
+table.to_csv(results_file, index=False)
+Log("Appended {:} stage timings of commit {:} to {:}.".format(len(results), run['Commit'], results_file), True)
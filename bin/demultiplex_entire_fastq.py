@@ -2,7 +2,7 @@
 
 import os, argparse
 from tuba_seq.fastq import singleMismatcher 
-from tuba_seq.shared import smart_open, logPrint
+from tuba_seq.shared import smart_open, logPrint, compression_ext
 from collections import defaultdict
 import pandas as pd
 
@@ -13,7 +13,7 @@ parser.add_argument("reverse_read_file", help='FASTQ file of reverse reads')
 parser.add_argument('barcode_file', type=str, help='Tab-delimited file with sample_name, barcode pairs.')
 parser.add_argument("--forward_read_dir", default='forward_reads', help='Directory to put split forward reads.')
 parser.add_argument("--reverse_read_dir", default='reverse_reads', help='Directory to put split reverse reads.')
-parser.add_argument('--compression', default='gz', choices=['bz2', 'gz', 'lzma', 'none'], help='Compression algorithm for output.')
+parser.add_argument('--compression', default='gz', choices=['bz2', 'gz', 'bgzf', 'lzma', 'zst', 'lz4', 'none'], help='Compression algorithm for output (bgzf: block-gzip .gz files compressed on all CPUs).')
 ###############################################################################
 
 args = parser.parse_args()
@@ -61,9 +61,9 @@ filenames = samples.tolist()+extras
 
 file_tallies = defaultdict(int)
 
-fastq_ext = '.fastq{:}'.format('' if args.derep or args.compression == 'none' else '.'+args.compression)
-out_files = {filename:[ smart_open(os.path.join(args.forward_read_dir, filename)+fastq_ext, 'wb', makedirs=True),
-                        smart_open(os.path.join(args.reverse_read_dir, filename)+fastq_ext, 'wb', makedirs=True)] for filename in filenames}
+fastq_ext = '.fastq' + compression_ext(args.compression)
+out_files = {filename:[ smart_open(os.path.join(args.forward_read_dir, filename)+fastq_ext, 'wb', makedirs=True, compression=args.compression),
+                        smart_open(os.path.join(args.reverse_read_dir, filename)+fastq_ext, 'wb', makedirs=True, compression=args.compression)] for filename in filenames}
 
 with smart_open(args.forward_reads) as forward_file, smart_open(args.reverse_reads) as reverse_file:
     for i, (forward_line, reverse_line) in enumerate(zip(forward_file, reverse_file)):
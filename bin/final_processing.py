@@ -3,6 +3,7 @@ import argparse, os
 import pandas as pd
 import numpy as np
 from tuba_seq.shared import logPrint
+from tuba_seq.packed import GC_count
 from tuba_seq.reports import plt, barcode_diversity, contamination
 import seaborn as sns
 
@@ -51,7 +52,7 @@ def trimmed_mean(S):
     from scipy.stats import trim_mean
     return trim_mean(S, args.proportion) if args.proportion > 0 else np.mean(S)
 
-clean.insert(0, 'GCs', clean['ID'].str.count("G") + clean['ID'].str.count("C") + clean['barcode'].str.count("G") + clean['barcode'].str.count("C"))
+clean.insert(0, 'GCs', GC_count(clean['ID'].values) + GC_count(clean['barcode'].values))
 
 barcode_length = clean.iloc[0][['sgRNA', 'barcode']].str.len().sum()
 
@@ -1,20 +1,18 @@
 #!/usr/bin/env python3
 import pandas as pd
-import os, numpy, argparse, sys, warnings
-from tuba_seq.fastq import MasterRead
-from tuba_seq.shared import logPrint, smart_open
+import os, numpy, argparse, sys, time, json
+from tuba_seq.fastq import MasterRead, default_master_read
+from tuba_seq.shared import logPrint, smart_open, compression_ext
+from tuba_seq.manifest import RunManifest
+from tuba_seq.derep import derep_ext, DEFAULT_MAX_BYTES
+from tuba_seq.sketch import DEFAULT_CAPACITY
 from rpy2.robjects.packages import importr
 from rpy2.robjects import pandas2ri
 pandas2ri.activate()
 
 fastq_ext = '.fastq'
 histogram_filename = 'alignment_histogram.pdf'
-
-default_master_read = ''.join((
-    'GCGCACGTCTGCCGCGCTGTTCTCCTCTTCCTCATCTCCGGGACCCGGA',# forward flank
-    '........',                                         # sgID
-    'AA.....TT.....AA.....',                            # random barcode
-    'ATGCCCAAGAAGAAGAGGAAGGTGTCCAATTTACTGACCGTACACCAAAATTTGCCTGCATTACCGGTCGATGCAACGAGTGATGAGGTTCGCAAGAACCT')) # aft flank
+unchecked_parameters = {'input_dir', 'verbose', 'parallel', 'search_blast', 'local_blast', 'fraction', 'skip', 'resume', 'manifest', 'metrics_dir', 'compression_threads', 'derep_max_mb', 'unaligned_sketch_size', 'align_threads'}
 
 ############################ Input Parameters #################################
 parser = argparse.ArgumentParser(description="Prepare FASTQ files for DADA training & clustering.",
@@ -27,19 +25,34 @@ parser.add_argument('-t', '--training_dir', default='training', help='Directory
 parser.add_argument('-o', '--output_dir', default='preprocessed', help='Directory to save files for barcode clustering.') 
 parser.add_argument('-u', '--unaligned_dir', default='unaligned', help='Directory to save unaligned reads')
 parser.add_argument("-v", "--verbose", help='Output more', action="store_true")
-parser.add_argument('-p', '--parallel', action='store_true', help='Multi-threaded operation')
-parser.add_argument('-s', '--search_blast', action='store_true', help='Use NCBI BLAST algorithm to identify contaminations in samples')
+parser.add_argument('-p', '--parallel', action='store_true', help='Multi-process operation: all samples are split into work units, which are processed on one shared process pool.')
+parser.add_argument('-s', '--search_blast', action='store_true', help='Use NCBI BLAST algorithm to identify contaminations in samples (PhiX & other contaminants are counted among the most frequent unaligned sequences, see --unaligned_sketch_size)')
 parser.add_argument('-l', '--local_blast', action='store_true', 
     help='Use local NCBI BLAST+ algorithm to accelerate searching (if present), see tuba_seq/blast.py.')
-parser.add_argument('-d', '--derep', action='store_true', help='De-replicate output fastQ files for DADA2 to minimize file sizes.')
+parser.add_argument('-d', '--derep', action='store_true', help='De-replicate training & clustering reads as they are written, saving DADA2 derep objects (.rds files) instead of fastQ files.')
+parser.add_argument('--derep_max_mb', type=int, default=DEFAULT_MAX_BYTES >> 20, help='Megabytes of unique sequences & qualities per output held in memory by --derep before spilling to temporary files (which are merged out of core).')
 parser.add_argument('-f', '--fraction', type=float, default=0.01, help='Minimum fraction of total reads to elicit a BLAST-search of an unknown sequence.')
+parser.add_argument('--unaligned_sketch_size', type=int, default=DEFAULT_CAPACITY, 
+    help='Most frequent unaligned sequences tracked (in bounded memory) per sample & work unit, from which --search_blast draws its candidates (see tuba_seq/sketch.py).')
 parser.add_argument('-k',  '--skip', action='store_true', help='Skip files that already exist in output directories.')
+parser.add_argument('-r', '--resume', action='store_true', 
+    help='Resume an interrupted run: samples (or, with --parallel, work units) completed by a previous run with identical inputs & parameters are not re-processed (see --manifest).')
+parser.add_argument('--metrics_dir', default=None, help='Directory to save the performance metrics (stage times, reads/s, bytes in/out) of every sample as <sample>.metrics.json (default: metrics are only logged).')
+parser.add_argument('--manifest', default='preprocess.manifest.json', help='Checkpoints of the run (inputs, parameters, & the outputs & stats of every completed work unit; stats are stored in MANIFEST.stats/), used by --resume.')
 parser.add_argument('-a', '--allowable_deviation', type=int, default=4, help="Length of Indel to tolerate before discarding reads.")
 parser.add_argument('--alignment_flank', type=int, default=22, help='# of bases flanking the degenerate region to be used to score the quality of the read.')
 parser.add_argument('--training_flank', type=int, default=22, help='# of bases flanking the degenerate region to be used to develop the DADA2 error model.')
 parser.add_argument('--cluster_flank', type=int, default=22, help='# of bases flanking the degenerate region to be used for clustering.')
 parser.add_argument('-M', '--min_align_score', type=float, default=0.65, help='Minimum alignment score needed to keep read, Range [0, 1).')
-parser.add_argument('--compression', default='bz2', choices=['bz2', 'gz', 'lzma', 'none'], help='Compression algorithm for saved file.')
+parser.add_argument('--aligner', default='ssw', choices=['ssw', 'banded'], 
+    help='Alignment engine: striped Smith-Waterman (ssw), or banded semi-global alignment (banded) with a bandwidth of 2x --allowable_deviation. Reads that do not align within the band are re-aligned with ssw.')
+parser.add_argument('--cache_size', type=int, default=0, 
+    help='Align every distinct (trimmed) read sequence only once, caching the outcomes of up to this many sequences (~0.5 kB each) for their duplicates. 0 disables caching.')
+parser.add_argument('--align_threads', type=int, default=1, 
+    help='Threads that align every block of reads (alignment releases the GIL). With --parallel, every process uses this many threads.')
+parser.add_argument('--compression', default='bz2', choices=['bz2', 'gz', 'bgzf', 'lzma', 'zst', 'lz4', 'none'], help='Compression algorithm for saved file. bgzf writes block-gzip (.gz) files compressed on all CPUs. zst & lz4 require the zstandard & lz4 packages (see bin/benchmark_io.py to compare codecs).')
+parser.add_argument('--compression_level', type=int, default=None, help='Compression level (default: the default level of the codec).')
+parser.add_argument('--compression_threads', type=int, default=None, help='Compression threads for bgzf & zst (default: all CPUs).')
 parser.add_argument('--trim', default='symmetric', help='Nucleotides to immediately trim from the amplicon reads before searching for the barcode--trimming accelerates runtime. Can be two integers--a start and stop position, `none`, or `symmetric`, which truncates the read such that the barcode is exactly in the middle of the read.')
 parser.add_argument('--ClonTracer', action='store_true', help="Process Single-End read cloneTracer data w/o 5' flank of barcode")
 ###############################################################################
@@ -49,14 +62,10 @@ Log = logPrint(args)
 master_read = MasterRead(args.master_read, args)
 
 dada2 = importr("dada2")
-R_base = importr('base')
 
 single_file = '.fastq' in args.input_dir
 
-compression = '' if args.derep or args.compression == 'none' else '.'+args.compression
-
-if args.parallel and not single_file:
-    from tuba_seq.pmap import pmap as map
+compression = compression_ext(args.compression)
 
 input_fastqs = [os.path.join(args.input_dir, f) for f in os.listdir(args.input_dir) if fastq_ext in f] if not single_file else [args.input_dir]
 
@@ -74,64 +83,103 @@ if len(instruments.value_counts()) > 1:
 if not single_file:
     Log('Processing {:} samples found in {:}.'.format(len(input_fastqs), args.input_dir), True)
 
+def is_complete(ix):
+    if args.skip and all([os.path.isfile(f) for f in fastq_outputs[ix]]):
+        Log(samples[ix]+" already exists, skipping...")
+        return True
+    return False
+
 def process_fastq(ix):
+    from tuba_seq.fastq import IterFASTQ
+    input_fastq = input_fastqs[ix]
+    output_files = fastq_outputs[ix] + fasta_outputs[ix:ix+1]
+    resumed = manifest.resume(input_fastq, output_files)
+    if resumed is not None and resumed[1] == len(resumed[0]):
+        Log(samples[ix]+" was completed by a previous run, re-using its outputs...")
+        return resumed[2], 0.
+    manifest.start(input_fastq, output_files, [(0, None, None)])
+    start = time.time()
+    output = master_read.iter_fastq(IterFASTQ(input_fastq), output_files)
+    manifest.chunk_done(input_fastq, output, [os.path.getsize(f) for f in output_files])
+    return output, time.time() - start
+
+def describe_metrics(metrics):
+    processing = max(metrics['Wall Time (s)'], 1e-9)
+    lookups = metrics['Cache Hits'] + metrics['Cache Misses']
+    return ('{:,.0f} reads/s, {:.1f} MB/s input. '.format(metrics['Reads']/processing, metrics['Bytes In']*1e-6/processing)+
+            ', '.join(['{:.0%} {:}'.format(metrics[stage+' Time (s)']/processing, stage) for stage in ['Read', 'Align', 'Output']])+
+            ' of {:.1f}s processing time; {:.1f}s of background compression of {:.1f} MB into {:.1f} MB.'.format(
+            metrics['Wall Time (s)'], metrics['Compress Time (s)'], metrics['Bytes Out']*1e-6, metrics['Compressed Bytes Out']*1e-6)+
+            (' Alignment cache hit rate: {:.1%} of {:,.0f} lookups.'.format(metrics['Cache Hits']/lookups, lookups) if lookups > 0 else ''))
+
+def finish_fastq(ix, output, wall_time):
     sample = samples[ix]
     input_fastq = input_fastqs[ix]
     fastqs = fastq_outputs[ix]
     output_files = fastqs + fasta_outputs[ix:ix+1]
-    if args.skip and all([os.path.isfile(f) for f in fastqs]):
-        Log(sample+" already exists, skipping...")
-        return 
-    
-    if args.parallel and single_file:
-        from tuba_seq.pmap import fastq_map_sum
-        outcomes, scores, bad_lengths = fastq_map_sum(input_fastq, output_files, master_read.iter_fastq)
-    else:
-        from tuba_seq.fastq import IterFASTQ
-        outcomes, scores, bad_lengths = master_read.iter_fastq(IterFASTQ(input_fastq), output_files)
+    outcomes, scores, bad_lengths, alignments, metrics, unaligned = output
     reads = outcomes.sum()
-    Log('Sample {:} ({:.2f}M Reads): '.format(sample, reads*1e-6)+
-        ','.join(['{:.1%} {:}'.format(num/reads, name) for name, num in outcomes.iteritems() if num > 0])+'.')
+    Log('Sample {:} ({:.2f}M Reads, {:.1f}s): '.format(sample, reads*1e-6, wall_time)+
+        ','.join(['{:.1%} {:}'.format(num/reads, name) for name, num in outcomes.iteritems() if num > 0])+'. '+
+        'Alignment of reads: '+', '.join(['{:.1%} {:}'.format(num/max(alignments.sum(), 1), name) for name, num in alignments.iteritems()])+'.')
+    Log('Sample {:} performance: '.format(sample)+describe_metrics(metrics))
+    if args.metrics_dir is not None:
+        os.makedirs(args.metrics_dir, exist_ok=True)
+        with open(os.path.join(args.metrics_dir, sample+'.metrics.json'), 'w') as f:
+            json.dump({'Sample':sample, 'Input':input_fastq, 'Wall Time (s)':wall_time, 
+                       'Metrics':metrics.to_dict(), 'Outcomes':outcomes.to_dict(), 'Alignments':alignments.to_dict()}, f, indent=1, default=float)
     if outcomes['Clustered'] == 0:
         Log('There were no passable reads in {:}. Deleting output files...'.format(input_fastq), True)
         list(map(os.remove, output_files))
         return 
-
-    if args.derep:
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore") 
-            for f in fastqs:
-                try:
-                    print(f)
-                    derep = dada2.derepFastq(f, verbose=args.verbose)
-                    R_base.saveRDS(derep, file=f.replace(fastq_ext, '.rds'))
-                except Exception as e: 
-                    Log("Could not derep {:}:\n{:}".format(f, e), True)
-                else:
-                    os.remove(f)
-    return outcomes, scores, bad_lengths
+    return outcomes, scores, bad_lengths, alignments, metrics, unaligned
 
 samples = [os.path.basename(input_fastq.partition(fastq_ext)[0]) for input_fastq in input_fastqs]
-fastq_outputs = [[os.path.join(Dir, sample+fastq_ext+compression) for Dir in [args.training_dir, args.output_dir]] for sample in samples]
+fastq_outputs = [[os.path.join(Dir, sample+(derep_ext if args.derep else fastq_ext+compression)) for Dir in [args.training_dir, args.output_dir]] for sample in samples]
 fasta_outputs = [os.path.join(args.unaligned_dir, sample+'.fasta'+compression) for sample in samples]
-outputs = list(filter(lambda output: output is not None, map(process_fastq, range(len(samples)))))
+to_process = [ix for ix in range(len(samples)) if not is_complete(ix)]
+
+output_parameters = {key:value for key, value in vars(args).items() if key not in unchecked_parameters}
+manifest = RunManifest(args.manifest, output_parameters)
+if not args.resume:
+    for ix in to_process:
+        manifest.forget(input_fastqs[ix])
+
+if args.parallel and to_process:
+    # Every sample is split into record ranges, which are processed (largest first) on one shared process pool
+    from tuba_seq.pmap import fastq_map_sums
+    sums, timings, utilization = fastq_map_sums([(input_fastqs[ix], fastq_outputs[ix] + fasta_outputs[ix:ix+1]) for ix in to_process], master_read.iter_fastq, manifest=manifest)
+    results = zip(sums, timings['Wall Time (s)'])
+    Log("Processed {:} samples in {:} work units at {:.0%} utilization of the process pool ({:.1f}s merging outputs).".format(
+        len(to_process), timings['Units'].sum(), utilization, timings['Merge Time (s)'].sum()), True)
+else:
+    results = map(process_fastq, to_process)
+outputs = list(filter(lambda output: output is not None, [finish_fastq(ix, output, wall_time) for ix, (output, wall_time) in zip(to_process, results)]))
 
 if not outputs:
     Log("No files were processed.")
     sys.exit()
 
-outcome_totals, score_totals, bad_barcode_length_totals = [sum(output_set) for output_set in zip(*outputs)]
+outcome_totals, score_totals, bad_barcode_length_totals, alignment_totals, metric_totals, unaligned_totals = [sum(output_set) for output_set in zip(*outputs)]
 total_reads = outcome_totals.sum()
 
 if args.search_blast:  
-    from collections import Counter
-    unaligned = pd.Series(sum([Counter(open(fasta, 'rb')) for fasta in fasta_outputs], Counter()))
-    unaligned.index = unaligned.index.astype(str).str.slice(0, -1)
+    # Counts (upper bounds) of the most frequent unaligned sequences, from the sketches of every sample & work unit
+    unaligned = unaligned_totals.top()
+    unaligned.index = unaligned.index.str.decode('ascii')
+    guaranteed = unaligned_totals.guaranteed()
+    guaranteed.index = guaranteed.index.str.decode('ascii')
 
     PhiX = pandas2ri.ri2py(dada2.isPhiX(pandas2ri.py2ri(unaligned.index))) == 1
-    outcome_totals['PhiX (subset of Unaligned)'] = unaligned.loc[PhiX].sum()
+    # Counts of the sketch overestimate sequences that entered it after pruning, so only the lower bound is reported
+    outcome_totals['PhiX (subset of Unaligned, at least)'] = guaranteed.loc[unaligned.index[PhiX]].sum()
+    if unaligned_totals.floor > 0:
+        Log("PhiX reads: between {:,} & {:,} among the tracked unaligned sequences (PhiX sequences that occurred <= {:,} times may be untracked).".format(
+            outcome_totals['PhiX (subset of Unaligned, at least)'], unaligned.loc[PhiX].sum(), unaligned_totals.floor), True)
     non_PhiX = unaligned.loc[~PhiX]
     unknown_DNAs = (non_PhiX/total_reads).loc[lambda x: x >= args.fraction]
+    if unaligned_totals.floor >= args.fraction*total_reads:
+        Log("Unaligned sequences as frequent as --fraction may have been missed (up to {:} untracked occurrences each); increase --unaligned_sketch_size.".format(unaligned_totals.floor), True)
 
     if len(unknown_DNAs) > 0: 
         from tuba_seq.blast import sleuth_DNAs
@@ -163,6 +211,9 @@ except Exception as e:
 
 Log("Summary of the {:.2f}M processed reads in {:}:".format(total_reads*1e-6, args.input_dir), True, header=True)
 Log((outcome_totals/total_reads).to_string(float_format='{:.2%}'.format), True)
+Log("Alignment method of the aligned reads:", True)
+Log((alignment_totals/alignment_totals.sum()).to_string(float_format='{:.2%}'.format), True)
+Log("Performance: "+describe_metrics(metric_totals), True)
 
 bad_lengths = bad_barcode_length_totals.sum()
 if bad_lengths > 0:
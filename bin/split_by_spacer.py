@@ -2,7 +2,7 @@
 
 import argparse
 from tuba_seq.fastq import Mismatcher, IterFASTQ
-from tuba_seq.shared import smart_open, logPrint
+from tuba_seq.shared import smart_open, logPrint, compression_ext
 import pandas as pd
 from pathlib import Path
 import numpy as np
@@ -25,8 +25,8 @@ parser.add_argument('--reverse', type=str, default='ATGTCCAAGA'[::-1],
     help='Reverse string (read in the forward direction)')
 parser.add_argument('-p', '--parallel', action='store_true', 
     help='Multithreaded operation')
-parser.add_argument('--compression', default='gz', choices=['bz2', 'gz', 'lzma', 'none'], 
-    help='Compression algorithm for output.')
+parser.add_argument('--compression', default='gz', choices=['bz2', 'gz', 'bgzf', 'lzma', 'zst', 'lz4', 'none'], 
+    help='Compression algorithm for output (bgzf: block-gzip .gz files compressed on all CPUs).')
 parser.add_argument('--indel', default=1, type=int, 
     help='Tolerable deviation from expected spacer.')
 parser.add_argument('--substitutions', default=3, type=int, 
@@ -42,9 +42,7 @@ Log = logPrint(args)
 
 samples = pd.read_csv(args.spacer_file).set_index(['input_file', 'forward_spacer_length', 'reverse_spacer_length'])['sample']
 
-fastq_ext = '.fastq'
-if args.compression != 'none':
-    fastq_ext += '.'+args.compression
+fastq_ext = '.fastq' + compression_ext(args.compression)
 if args.parallel:
     from tuba_seq.pmap import pmap as map
 
@@ -93,8 +91,8 @@ def split_fastq(filename):
     reverse_spacers = frozenset(spacers['reverse_spacer_length'].values)
     forward_finder = StringFinder(args.forward, forward_spacers)
     reverse_finder = StringFinder(args.reverse[::-1], reverse_spacers)
-    output_files = {sample:smart_open(args.output_dir / (sample + fastq_ext), 'wb', makedirs=True) for sample in spacers['sample']}
-    output_files['Failed'] = smart_open(args.failed_dir / (input_name + fastq_ext), 'wb', makedirs=True)
+    output_files = {sample:smart_open(args.output_dir / (sample + fastq_ext), 'wb', makedirs=True, compression=args.compression) for sample in spacers['sample']}
+    output_files['Failed'] = smart_open(args.failed_dir / (input_name + fastq_ext), 'wb', makedirs=True, compression=args.compression)
     destinations = dict(zip(output_files.keys(), len(output_files)*[0]))
     for bheader, bDNA, bQC in IterFASTQ(filename):
         DNA = bDNA.decode('ascii')
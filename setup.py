@@ -3,6 +3,8 @@ from distutils.core import setup, Extension
 from Cython.Build import cythonize
 import numpy
 
+ssw_dir = 'Complete-Striped-Smith-Waterman-Library/src'
+
 setup(  name='tuba_seq',
         description='Tools for the tuba-seq analysis pipeline',
         url='https://github.com/petrov-lab/tuba-seq',
@@ -16,8 +18,12 @@ setup(  name='tuba_seq',
             'Operating System :: POSIX',
             'Topic :: Scientific/Engineering :: Bio-Informatics'],
         packages=['tuba_seq'], 
-        ext_modules=cythonize(Extension("*", ['tuba_seq/*.pyx'], 
-            include_dirs=['seq-align/src', numpy.get_include()])),
+        ext_modules=cythonize([
+            Extension("tuba_seq.batch_align", ['tuba_seq/batch_align.pyx', ssw_dir+'/ssw.c'],
+                include_dirs=[ssw_dir, numpy.get_include()]),
+            Extension("tuba_seq.gzindex", ['tuba_seq/gzindex.pyx'], libraries=['z']),
+            Extension("*", ['tuba_seq/*.pyx'], 
+                include_dirs=['seq-align/src', numpy.get_include()])]),
         install_requires=[  
             'numpy',
             'scipy',
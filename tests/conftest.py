@@ -0,0 +1,19 @@
+"""Shared fixtures of the test suite (run with `python -m pytest tests` after building the extensions in place)."""
+import os
+from types import SimpleNamespace
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+example_fastq = os.path.join(repo_dir, 'examples', 'merged_reads', 'IW3098.fastq')
+
+def preprocess_args(**kargs):
+    """Namespace of the bin/preprocess.py arguments that MasterRead reads (defaults of preprocess.py)."""
+    args = dict(alignment_flank=22, training_flank=22, cluster_flank=22, allowable_deviation=4, ClonTracer=False,
+                trim='symmetric', min_align_score=0.65, aligner='ssw', cache_size=0)
+    args.update(kargs)
+    return SimpleNamespace(**args)
+
+@pytest.fixture
+def example_reads():
+    with open(example_fastq, 'rb') as f:
+        return f.read().split(b'\n')[1::4]
@@ -0,0 +1,105 @@
+import gzip
+import numpy as np
+import pytest
+from tuba_seq.batch_align import BatchAligner, BandedAligner, pack_reads
+from tuba_seq.fastq import MasterRead, IterFASTQ, default_master_read
+from conftest import example_fastq, preprocess_args
+
+def read_outputs(filenames):
+    return [gzip.open(f).read() for f in filenames]
+
+@pytest.mark.parametrize('threads', [2, 3, 8])
+def test_threaded_align_matches_serial(example_reads, threads):
+    master_read = MasterRead(default_master_read, preprocess_args())
+    reference = master_read.c_ref
+    for aligner in [BatchAligner(reference), BandedAligner(reference, ref_offset=master_read.ref_offset, bandwidth=8)]:
+        seqs, offsets = pack_reads(example_reads)
+        serial = aligner.align(seqs, offsets)
+        threaded = aligner.align(seqs, offsets, threads=threads)
+        for s, t in zip(serial, threaded):
+            np.testing.assert_array_equal(s, t)
+
+@pytest.mark.parametrize('aligner', ['ssw', 'banded'])
+def test_iter_fastq_align_threads(tmp_path, aligner):
+    outputs = {}
+    for threads in [1, 4]:
+        master_read = MasterRead(default_master_read, preprocess_args(aligner=aligner, align_threads=threads))
+        filenames = [str(tmp_path / '{:}.{:}.fastq.gz'.format(name, threads)) for name in ['training', 'cluster', 'unaligned']]
+        stats = master_read.iter_fastq(IterFASTQ(example_fastq), filenames)
+        outputs[threads] = stats[:4], read_outputs(filenames)
+    (serial_stats, serial_files), (threaded_stats, threaded_files) = outputs[1], outputs[4]
+    for s, t in zip(serial_stats, threaded_stats):
+        assert s.equals(t)
+    assert serial_files == threaded_files
+
+@pytest.fixture
+def reads_with_Ns(example_reads):
+    """Example reads (trimmed as by MasterRead) with 3 random bases replaced by N."""
+    master_read = MasterRead(default_master_read, preprocess_args())
+    rng = np.random.RandomState(0)
+    reads = []
+    for read in example_reads[:500]:
+        read = np.frombuffer(read[master_read.pre_slice], dtype=np.uint8).copy()
+        read[rng.randint(0, len(read), 3)] = ord('N')
+        reads.append(read.tobytes())
+    return reads
+
+def test_batch_aligner_fills_Ns_like_SSW(reads_with_Ns):
+    master_read = MasterRead(default_master_read, preprocess_args())
+    seqs, offsets = pack_reads(reads_with_Ns)
+    scores, N_starts, N_stops, begins, filled = master_read.batch_aligner.align(seqs, offsets, fill_Ns=True)
+    for i, read in enumerate(reads_with_Ns):
+        assert filled[offsets[i]:offsets[i+1]].tobytes() == master_read.aligner.barcode_align(read).filled
+    np.testing.assert_array_equal(scores, master_read.batch_aligner.align(seqs, offsets)[0])
+
+def test_banded_aligner_fills_only_Ns(reads_with_Ns):
+    master_read = MasterRead(default_master_read, preprocess_args())
+    aligner = BandedAligner(master_read.c_ref, ref_offset=master_read.ref_offset, bandwidth=8)
+    seqs, offsets = pack_reads(reads_with_Ns)
+    scores, N_starts, N_stops, begins, filled = aligner.align(seqs, offsets, fill_Ns=True)
+    read_bases = np.frombuffer(seqs, dtype=np.uint8)
+    changed = filled != read_bases
+    assert changed.any() and (read_bases[changed] == ord('N')).all()
+    for i in np.flatnonzero(scores == 0):
+        assert filled[offsets[i]:offsets[i+1]].tobytes() == reads_with_Ns[i]
+
+def test_align_sequences_fills_Ns_without_realigning(reads_with_Ns, example_reads):
+    master_read = MasterRead(default_master_read, preprocess_args())
+    DNAs = reads_with_Ns + [read[master_read.pre_slice] for read in example_reads[:100]]
+    for DNA, alignment in zip(DNAs, master_read._align_sequences(DNAs)):
+        assert alignment[5] == master_read.aligner.barcode_align(DNA).filled
+
+def indel_reads(reads, c_ref, ref_offset, size, rng):
+    """`reads` with an insertion (size > 0) or deletion (size < 0) of |size| bases in a random flank of the barcode."""
+    N_positions = np.flatnonzero(np.frombuffer(c_ref, dtype=np.uint8) == ord('N'))
+    out = []
+    for read in reads:
+        if rng.rand() < 0.5:
+            lo, hi = 2, N_positions[0] - abs(size) - 2
+        else:
+            lo, hi = N_positions[-1] + 3, len(c_ref) - abs(size) - 2
+        pos = ref_offset + rng.randint(lo, hi + 1)
+        out.append(read[:pos] + bytes(rng.choice(list(b'ACGT'), size).astype(np.uint8)) + read[pos:] if size > 0 else read[:pos] + read[pos-size:])
+    return out
+
+def test_banded_aligner_concordance_near_band_edge(example_reads):
+    """Within the band, accepted reads are assigned the barcode coordinates of SSW (reads that
+match poorly, e.g. those missing 8 flanking bases, are rejected & re-aligned by SSW); reads
+far outside of the band are rejected."""
+    master_read = MasterRead(default_master_read, preprocess_args(aligner='banded'))
+    bandwidth = master_read.banded_aligner.bandwidth
+    reads = [read[master_read.pre_slice] for read in example_reads[:500]]
+    rng = np.random.RandomState(0)
+    def align(reads):
+        seqs, offsets = pack_reads(reads)
+        return master_read.batch_aligner.align(seqs, offsets), master_read.banded_aligner.align(seqs, offsets)
+    def barcode_concordance(ssw, banded):
+        accepted = banded[0] > 0
+        return accepted.mean(), ((ssw[1] == banded[1]) & (ssw[2] == banded[2]))[accepted].mean()
+    for size in [-bandwidth, 1 - bandwidth, bandwidth - 1, bandwidth]:
+        accepted, concordance = barcode_concordance(*align(indel_reads(reads, master_read.c_ref, master_read.ref_offset, size, rng)))
+        assert accepted > 0.25 and concordance > 0.95, size
+    accepted, concordance = barcode_concordance(*align([b'ACGT'*(bandwidth//4) + read for read in reads]))
+    assert accepted > 0.8 and concordance > 0.99
+    ssw, banded = align([b'ACGT'*(bandwidth//2) + read for read in reads])
+    assert (banded[0] == 0).all() and (banded[1] == -1).all()
@@ -0,0 +1,89 @@
+import gzip
+import io
+import os
+import numpy as np
+import pytest
+from conftest import repo_dir, example_fastq
+from tuba_seq.derep import Dereplicator, DerepWriter, write_derep_rds, merge_partials, _in_memory
+
+golden_rds = os.path.join(repo_dir, 'tests', 'data', 'derep.rds')
+small_reads = [(b'ACGT', b'IIII'), (b'ACG', b'#+5'), (b'ACGT', b'5555'), (b'TTTTA', b'IIII#'), (b'ACG', b'III')]
+
+@pytest.fixture
+def example_records():
+    with open(example_fastq, 'rb') as f:
+        lines = f.read().split(b'\n')
+    return list(zip(lines[1::4], lines[3::4]))
+
+def dereplicate(reads, **kargs):
+    dereplicator = Dereplicator(**kargs)
+    for DNA, QC in reads:
+        dereplicator.add(DNA, QC)
+    return dereplicator
+
+def rds_contents(filename):
+    with gzip.open(filename) as f:
+        return f.read()
+
+def test_table_matches_reference(example_records):
+    table = dereplicate(example_records).finish()
+    counts, qsums = {}, {}
+    for DNA, QC in example_records:
+        counts[DNA] = counts.get(DNA, 0) + 1
+        qsums[DNA] = qsums.get(DNA, 0) + np.frombuffer(QC, dtype=np.uint8).astype(np.int64) - 33
+    seqs = [bytes(seq) for seq in table['seqs']]
+    assert dict(zip(seqs, table['counts'])) == counts
+    assert list(table['counts']) == sorted(counts.values(), reverse=True)
+    for seq, row in zip(seqs, table['qsums']):
+        np.testing.assert_array_equal(row[:len(seq)], qsums[seq])
+        assert not row[len(seq):].any()
+    assert [seqs[i] for i in table['map']] == [DNA for DNA, QC in example_records]
+
+def test_rds_matches_golden_fixture(tmp_path):
+    filename = str(tmp_path / 'small.rds')
+    write_derep_rds(filename, dereplicate(small_reads).finish())
+    assert rds_contents(filename) == rds_contents(golden_rds)
+
+def test_rds_reads_back_in_R(tmp_path):
+    robjects = pytest.importorskip('rpy2.robjects')
+    derep = robjects.r['readRDS'](golden_rds)
+    uniques, quals, read_map = derep.rx2('uniques'), derep.rx2('quals'), derep.rx2('map')
+    assert list(robjects.r['class'](derep)) == ['derep']
+    assert list(uniques.names) == ['ACG', 'ACGT', 'TTTTA'] and list(uniques) == [2, 2, 1]
+    np.testing.assert_array_equal(np.array(quals).reshape(3, 5, order='F'),
+        [[21, 25, 30, np.nan, np.nan], [30, 30, 30, 30, np.nan], [40, 40, 40, 40, 2]])
+    assert list(read_map) == [2, 1, 2, 3, 1]
+
+def test_spilled_tables_merge_like_one_table(example_records, tmp_path):
+    spilled = dereplicate(example_records, max_bytes=1, block_size=64, temp_dir=str(tmp_path))
+    assert spilled.spilled is not None and len(spilled.spilled.sizes) > 1
+    in_core, out_of_core = dereplicate(example_records).finish(), spilled.finish()
+    write_derep_rds(str(tmp_path / 'spilled.rds'), out_of_core, block_bytes=1024)
+    spilled.close()
+    assert os.listdir(str(tmp_path)) == ['spilled.rds']
+    write_derep_rds(str(tmp_path / 'in_core.rds'), in_core)
+    assert rds_contents(str(tmp_path / 'spilled.rds')) == rds_contents(str(tmp_path / 'in_core.rds'))
+
+@pytest.mark.parametrize('max_bytes', [2**28, 1])
+def test_merged_partials_match_whole_derep(example_records, tmp_path, max_bytes):
+    def records(reads):
+        return b''.join(b'@read\n' + DNA + b'\n+\n' + QC + b'\n' for DNA, QC in reads)
+    with DerepWriter(str(tmp_path / 'whole.rds')) as writer:
+        writer.write(records(example_records))
+    with open(str(tmp_path / 'partials.rds'), 'wb') as f:
+        for part in np.array_split(np.arange(len(example_records)), 3):
+            sink = io.BytesIO()
+            with DerepWriter(sink) as writer:
+                writer.write(records([example_records[i] for i in part]))
+            f.write(sink.getvalue())
+    merge_partials(str(tmp_path / 'partials.rds'), max_bytes=max_bytes, temp_dir=str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path))) == ['partials.rds', 'whole.rds']
+    assert rds_contents(str(tmp_path / 'partials.rds')) == rds_contents(str(tmp_path / 'whole.rds'))
+
+def test_spilled_partial_table_is_loaded(example_records, tmp_path):
+    dereplicator = dereplicate(example_records, max_bytes=1, block_size=64, temp_dir=str(tmp_path))
+    table = _in_memory(dereplicator.finish())
+    dereplicator.close()
+    reference = dereplicate(example_records).finish()
+    for key in ['seqs', 'counts', 'qsums', 'map']:
+        np.testing.assert_array_equal(table[key], reference[key])
@@ -0,0 +1,96 @@
+import gzip
+import os
+import numpy as np
+import pytest
+from conftest import example_fastq, preprocess_args
+from tuba_seq.fastq import batch_expected_errors, _expected_errors, MasterRead, IterFASTQ, IterFASTQBatches, default_master_read
+
+def phred(*scores):
+    return np.array(scores, dtype=np.uint8) + 33
+
+@pytest.mark.parametrize('lengths', [[3, 0], [0, 3], [2, 0, 1], [1, 0, 0, 2, 0, 0], [0, 0], [4]])
+def test_batch_expected_errors_with_empty_reads(lengths):
+    rng = np.random.RandomState(sum(lengths))
+    reads = [phred(*rng.randint(0, 42, size=L)) for L in lengths]
+    offsets = np.r_[0, np.cumsum(lengths)]
+    QC = np.concatenate(reads + [np.zeros(0, dtype=np.uint8)])
+    expected = [_expected_errors(read.tobytes().decode('ascii')) if len(read) else 0. for read in reads]
+    np.testing.assert_allclose(batch_expected_errors(QC, offsets), expected)
+
+def test_batch_expected_errors_trailing_empty_read():
+    QC = phred(0, 0, 0)                 # Error probabilities of 1 (Phred 0)
+    np.testing.assert_array_equal(batch_expected_errors(QC, [0, 3, 3]), [3., 0.])
+    np.testing.assert_array_equal(batch_expected_errors(phred(), [0, 0, 0]), [0., 0.])
+
+def test_batch_expected_errors_matrix_matches_offsets():
+    matrix = np.zeros((2, 4), dtype=np.uint8)
+    matrix[0, :4] = phred(10, 20, 30, 40)
+    matrix[1, :2] = phred(2, 3)
+    concatenated = np.r_[matrix[0], matrix[1, :2]]
+    np.testing.assert_allclose(batch_expected_errors(matrix), batch_expected_errors(concatenated, [0, 4, 6]))
+
+def run_iter_fastq(tmp_path, name, **kargs):
+    master_read = MasterRead(default_master_read, preprocess_args(**kargs))
+    filenames = [str(tmp_path / '{:}.{:}.fastq.gz'.format(output, name)) for output in ['training', 'cluster', 'unaligned']]
+    output = master_read.iter_fastq(IterFASTQ(example_fastq), filenames)
+    return master_read, output, [gzip.open(f).read() for f in filenames]
+
+@pytest.mark.parametrize('cache_size', [1, 100, 10**6])
+def test_cached_iter_fastq_matches_uncached(tmp_path, cache_size):
+    master_read, uncached, uncached_files = run_iter_fastq(tmp_path, 'uncached')
+    master_read, cached, cached_files = run_iter_fastq(tmp_path, 'cached', cache_size=cache_size)
+    for u, c in zip(uncached[:3], cached[:3]):
+        assert u.equals(c)
+    assert cached_files == uncached_files
+    assert cached[5].counts == uncached[5].counts
+    statistics, metrics, alignments = cached[0], cached[4], cached[3]
+    aligned = statistics.sum() - statistics['Filtered']
+    assert metrics['Cache Hits'] + metrics['Cache Misses'] == aligned
+    assert metrics['Cache Hits'] == alignments['Cached']
+    if cache_size == 10**6:
+        distinct = {DNA[master_read.pre_slice] for header, DNA, QC in IterFASTQ(example_fastq)}
+        assert metrics['Cache Misses'] == len(distinct)
+    assert uncached[4]['Cache Hits'] == uncached[4]['Cache Misses'] == 0
+
+@pytest.mark.parametrize('output', ['fastq.gz', 'rds'])
+def test_iter_fastq_metrics(tmp_path, output):
+    master_read = MasterRead(default_master_read, preprocess_args(cache_size=1000))
+    filenames = [str(tmp_path / ('training.' + output)), str(tmp_path / ('cluster.' + output)), str(tmp_path / 'unaligned.fasta.gz')]
+    statistics, scores, bad_barcode_lengths, alignments, metrics, unaligned = master_read.iter_fastq(IterFASTQ(example_fastq), filenames)
+    assert list(metrics.index) == master_read.metric_names
+    assert metrics['Reads'] == statistics.sum() == 2098
+    assert metrics['Bytes In'] == os.path.getsize(example_fastq)
+    stages = metrics[['Read Time (s)', 'Align Time (s)', 'Output Time (s)']]
+    assert (stages > 0).all() and metrics['Compress Time (s)'] > 0
+    assert 0.8*metrics['Wall Time (s)'] <= stages.sum() <= metrics['Wall Time (s)']       # Stages are timed directly
+
+def batch_records(filename, **kargs):
+    return [batch.read(i) for batch in IterFASTQBatches(filename, **kargs) for i in range(len(batch))]
+
+@pytest.fixture
+def example_records():
+    return [tuple(line.rstrip(b'\n') for line in record) for record in IterFASTQ(example_fastq)]
+
+@pytest.mark.parametrize('batch_size,block_size', [(65536, 2**24), (1000, 4096), (7, 333), (1, 1)])
+def test_iter_fastq_batches_match_iter_fastq(example_records, batch_size, block_size):
+    """Small blocks split records (and lines) between reads of the file."""
+    batches = list(IterFASTQBatches(example_fastq, batch_size=batch_size, block_size=block_size))
+    assert all(len(batch) == batch_size for batch in batches[:-1])
+    assert [batch.read(i) for batch in batches for i in range(len(batch))] == example_records
+
+@pytest.mark.parametrize('block_size', [2**24, 100])
+def test_iter_fastq_batches_without_final_newline(tmp_path, example_records, block_size):
+    filename = str(tmp_path / 'no_newline.fastq')
+    with open(example_fastq, 'rb') as f, open(filename, 'wb') as g:
+        g.write(f.read().rstrip(b'\n'))
+    assert batch_records(filename, batch_size=1000, block_size=block_size) == example_records
+
+@pytest.mark.parametrize('cut', [2, 5, 30, 200])
+def test_iter_fastq_batches_of_truncated_file(tmp_path, cut):
+    filename = str(tmp_path / 'truncated.fastq.gz')
+    with open(example_fastq, 'rb') as f:
+        raw = f.read()
+    with gzip.open(filename, 'wb') as f:
+        f.write(raw[:-cut])
+    with pytest.raises(RuntimeError):
+        batch_records(filename, batch_size=1000, block_size=4096)
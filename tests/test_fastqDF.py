@@ -0,0 +1,97 @@
+import gzip
+import zlib
+import numpy as np
+import pytest
+from conftest import example_fastq
+from tuba_seq.fastq import fastqDF
+
+def fastq_contents(filename):
+    with gzip.open(filename) as f:
+        return f.read()
+
+def random_slices(n, seed):
+    """Per-read slices with None, negative & out-of-range bounds."""
+    rng = np.random.RandomState(seed)
+    bounds = [None] + list(range(-250, 250, 7))
+    return [slice(bounds[i], bounds[j]) for i, j in rng.randint(0, len(bounds), size=(n, 2))]
+
+def assert_same_reads(matrix, df):
+    converted = matrix.to_fastqDF()
+    assert list(converted['DNA']) == list(df['DNA'])
+    assert list(converted['QC']) == list(df['QC'])
+    np.testing.assert_array_equal(matrix.lengths, df['DNA'].str.len().values)
+
+@pytest.fixture
+def df():
+    return fastqDF.from_file(example_fastq)
+
+def test_matrix_round_trip(df):
+    assert_same_reads(df.to_matrix(), df)
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_matrix_vector_slice_matches_fastqDF(df, seed):
+    slices, second = random_slices(len(df), seed), random_slices(len(df), seed + 100)
+    matrix = df.to_matrix()
+    assert_same_reads(matrix.vector_slice(slices), fastqDF.from_file(example_fastq).vector_slice(slices))
+    assert_same_reads(df.to_matrix().vector_slice(slices, second), df.vector_slice(slices, second))
+
+def test_matrix_vector_slice_of_bounds_arrays(df):
+    rng = np.random.RandomState(2)
+    starts, stops = rng.randint(-300, 300, size=(2, len(df)))
+    matrix = df.to_matrix().vector_slice((starts, stops))
+    assert_same_reads(matrix, df.vector_slice([slice(start, stop) for start, stop in zip(starts, stops)]))
+
+@pytest.mark.parametrize('Slice', [slice(None, None), slice(10, 60), slice(-40, None), slice(None, -300), slice(100, 10**4), slice(-10**4, 5)])
+def test_matrix_co_slice_matches_fastqDF(df, Slice):
+    assert_same_reads(df.to_matrix().co_slice(Slice), df.co_slice(Slice))
+
+def test_matrix_expected_errors_match_fastqDF(df):
+    df['QC'] = df['QC'].str.translate({q:'K' for q in range(ord('K') + 1, 128)})     # Merged example reads exceed Q42
+    np.testing.assert_allclose(df.to_matrix().expected_errors(), df.expected_errors().values)
+    np.testing.assert_array_equal(df.to_matrix().maxEE_mask(1), df.maxEE_mask(1).values)
+
+def test_matrix_write_matches_fastqDF(df, tmp_path):
+    df.write(str(tmp_path / 'df.fastq'))
+    df.to_matrix().write(str(tmp_path / 'matrix.fastq'))
+    assert fastq_contents(str(tmp_path / 'matrix.fastq.gz')) == fastq_contents(str(tmp_path / 'df.fastq.gz'))
+
+@pytest.mark.parametrize('chunksize', [1000, 777, 10**6])
+def test_iter_chunks_concatenate_to_from_file(df, chunksize):
+    chunks = list(fastqDF.iter_chunks(example_fastq, chunksize=chunksize))
+    assert [chunk.info['Chunk'] for chunk in chunks] == list(range(-(-len(df)//chunksize)))
+    assert sum(chunk.info['Initial Reads'] for chunk in chunks) == df.info['Initial Reads']
+    for chunk in chunks:
+        assert chunk.info.drop(['Chunk', 'Initial Reads']).equals(df.info.drop('Initial Reads'))
+    assert list(np.concatenate([chunk['DNA'].values for chunk in chunks])) == list(df['DNA'])
+    assert list(np.concatenate([chunk['QC'].values for chunk in chunks])) == list(df['QC'])
+    length = chunks[0].normal_length()
+    kept = [chunk.drop_abnormal_lengths(length) for chunk in chunks]
+    assert list(np.concatenate([chunk['DNA'].values for chunk in kept])) == list(df.drop_abnormal_lengths()['DNA'])
+
+def gzip_members(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    members = 0
+    while data:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        decompressor.decompress(data)
+        data = decompressor.unused_data
+        members += 1
+    return members
+
+def test_write_quotes_and_reads_back(df, tmp_path):
+    df = df.select_reads(df.index[:10])
+    df.loc[df.index[3], 'QC'] = '"' + df.loc[df.index[3], 'QC'][1:]
+    df.loc[df.index[5], 'QC'] = df.loc[df.index[5], 'QC'][:-2] + '""'
+    df.write(str(tmp_path / 'quotes.fastq'))
+    written = fastqDF.from_file(str(tmp_path / 'quotes.fastq.gz'))
+    assert list(written['DNA']) == list(df['DNA']) and list(written['QC']) == list(df['QC'])
+    assert written.info['Fake Header'] == df.info['Fake Header']
+
+def test_write_append_concatenates_members(df, tmp_path):
+    filename = str(tmp_path / 'appended.fastq.gz')
+    for i, part in enumerate(np.array_split(df.index, 3)):
+        df.select_reads(part).write(filename, append=i > 0)
+    df.write(str(tmp_path / 'whole.fastq.gz'))
+    assert gzip_members(filename) == 3 and gzip_members(str(tmp_path / 'whole.fastq.gz')) == 1
+    assert fastq_contents(filename) == fastq_contents(str(tmp_path / 'whole.fastq.gz'))
@@ -0,0 +1,56 @@
+import gzip
+import os
+import shutil
+import numpy as np
+import pytest
+from conftest import example_fastq
+from tuba_seq.fastq import FASTQIndex
+from tuba_seq.gzindex import GzipIndex
+from tuba_seq.shared import smart_open
+
+@pytest.fixture(params=['.gz', '.bgz'])
+def compressed_fastq(request, tmp_path):
+    filename = str(tmp_path / ('IW3098.fastq' + request.param))
+    with open(example_fastq, 'rb') as f:
+        raw = f.read()
+    if request.param == '.gz':
+        with gzip.open(filename, 'wb') as f:
+            f.write(raw)
+    else:
+        with smart_open(filename, 'wb', compression='bgzf') as f:
+            f.write(raw)
+    return filename
+
+def assert_same_index(a, b, attributes):
+    for attribute in attributes:
+        x, y = getattr(a, attribute), getattr(b, attribute)
+        if isinstance(x, (int, float)):
+            assert x == y, attribute
+        else:
+            assert len(x) == len(y), attribute
+            for u, v in zip(x, y):
+                np.testing.assert_array_equal(np.asarray(u), np.asarray(v))
+
+def test_one_pass_indices_match_separate_builds(compressed_fastq):
+    fastq_index, gzip_index = FASTQIndex.load_or_build_gzip(compressed_fastq, stride=100, span=2**14)
+    assert_same_index(fastq_index, FASTQIndex.build(compressed_fastq, stride=100), ['offsets', 'reads', 'length', 'stride'])
+    assert_same_index(gzip_index, GzipIndex.build(compressed_fastq, span=2**14), ['compressed', 'uncompressed', 'member_start', 'windows', 'window_offsets', 'uncompressed_size'])
+    assert os.path.exists(compressed_fastq + '.fqidx') and os.path.exists(compressed_fastq + '.gzidx')
+    reloaded, regzip = FASTQIndex.load_or_build_gzip(compressed_fastq, stride=100, span=2**14)
+    assert_same_index(reloaded, fastq_index, ['offsets', 'reads', 'length'])
+    assert len(regzip) == len(gzip_index)
+
+def test_read_only_inputs_cache_sidecars(tmp_path, monkeypatch):
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    filename = str(data_dir / 'IW3098.fastq')
+    shutil.copy(example_fastq, filename)
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setenv('TUBA_SEQ_CACHE', str(cache_dir))
+    access = os.access
+    monkeypatch.setattr(os, 'access', lambda path, mode: False if os.path.abspath(path) == str(data_dir) else access(path, mode))
+    index = FASTQIndex.load_or_build(filename)
+    assert os.listdir(str(data_dir)) == ['IW3098.fastq']
+    cached = os.listdir(str(cache_dir))
+    assert len(cached) == 1 and cached[0].endswith('IW3098.fastq.fqidx')
+    assert FASTQIndex.load_or_build(filename).reads == index.reads
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from tuba_seq.packed import PackedDNA, GC_count
+
+seqs = ['ACGTN', 'GGCCAATTGGCCAATTA', '', 'NNNN', 'C', 'TACGGATTACAGATNAC']
+
+def hamming_reference(a, b):
+    return sum(x != y for x, y in zip(a, b))
+
+@pytest.fixture
+def packed():
+    return PackedDNA.from_strings(seqs)
+
+def test_round_trip(packed):
+    assert list(packed.to_strings()) == seqs
+    assert list(packed[[1, 3]].to_strings()) == [seqs[1], seqs[3]]
+    assert list(PackedDNA.from_strings([s.encode() for s in seqs]).to_strings()) == seqs
+
+@pytest.mark.parametrize('start,stop', [(None, None), (2, None), (None, 3), (1, 4), (-3, None), (None, -2), (-10, 100), (5, 2), (20, 30)])
+def test_slice_bases(packed, start, stop):
+    assert list(packed.slice_bases(start, stop).to_strings()) == [s[start:stop] for s in seqs]
+
+def test_hamming():
+    a = ['ACGTN', 'ACGTA', 'NNNNN', 'TTTTT', 'ACNTA']
+    b = ['ACGTN', 'ACGTN', 'ACGTN', 'AAAAA', 'ACNGA']
+    distances = PackedDNA.from_strings(a).hamming(PackedDNA.from_strings(b))
+    assert list(distances) == [hamming_reference(x, y) for x, y in zip(a, b)] == [0, 1, 4, 5, 1]
+    assert list(PackedDNA.from_strings(a).hamming(PackedDNA.from_strings(['ACGTN']))) == [hamming_reference(x, 'ACGTN') for x in a]
+    with pytest.raises(ValueError):
+        PackedDNA.from_strings(a).hamming(PackedDNA.from_strings(['ACGT']))
+
+def test_GC_count(packed):
+    assert list(packed.GC_count()) == [s.count('G') + s.count('C') for s in seqs]
+
+def test_GC_count_of_lowercase_and_IUPAC_strings():
+    with pytest.raises(ValueError):
+        PackedDNA.from_strings(['ACGt'])
+    assert list(GC_count(['ACGt', 'gcN'])) == [2, 2]
+    assert list(GC_count(['ACGt', 'gcRY', 'S'])) == [2, 2, 0]
+    np.testing.assert_array_equal(GC_count(np.array(seqs, dtype=object)), [s.count('G') + s.count('C') for s in seqs])
@@ -0,0 +1,65 @@
+import gzip
+import json
+import os
+import pytest
+from conftest import example_fastq, preprocess_args
+from tuba_seq.fastq import MasterRead, IterFASTQ
+from tuba_seq.pmap import fastq_map_sums, _schedule
+from tuba_seq.manifest import RunManifest
+
+master_read = ('GCGCACGTCTGCCGCGCTGTTCTCCTCTTCCTCATCTCCGGGACCCGGA' + '........' + 'AA.....TT.....AA.....' +
+               'ATGCCCAAGAAGAAGAGGAAGGTGTCCAATTTACTGACCGTACACCAAAATTTGCCTGCATTACCGGTCGATGCAACGAGTGATGAGGTTCGCAAGAACCT')
+
+def test_schedule_orders_jobs_largest_first_and_units_in_chunk_order():
+    job_units = [[(0, 10, 10), (10, 20, 10), (20, 25, 5)],
+                 [(0, 40, 40), (40, 80, 40), (80, 90, 10)],
+                 [(0, 20, 20)]]
+    done = [0, 1, 0]
+    assert [(job, chunk) for reads, job, chunk, start, stop in _schedule(job_units, done)] == \
+        [(1, 1), (1, 2), (2, 0), (0, 0), (0, 1), (0, 2)]
+
+@pytest.fixture
+def inputs(tmp_path):
+    """Plain & gzip inputs of >2 FASTQIndex strides (10000 records), i.e. of several units."""
+    plain = str(tmp_path / 'IW3098.fastq')
+    with open(example_fastq, 'rb') as f:
+        raw = f.read()*11
+    with open(plain, 'wb') as f:
+        f.write(raw)
+    with gzip.open(plain + '.gz', 'wb') as f:
+        f.write(raw)
+    return [plain, plain + '.gz']
+
+def test_fastq_map_sums_matches_serial(inputs, tmp_path):
+    master = MasterRead(master_read, preprocess_args())
+    names = ['training.fastq.gz', 'cluster.fastq.gz', 'unaligned.fasta.gz']
+    serial_files = [str(tmp_path / 'serial' / name) for name in names]
+    os.makedirs(str(tmp_path / 'serial'))
+    serial = master.iter_fastq(IterFASTQ(inputs[0]), serial_files)
+    jobs = [(in_fastq, [str(tmp_path / str(job) / name) for name in names]) for job, in_fastq in enumerate(inputs)]
+    sums, timings, utilization = fastq_map_sums(jobs, master.iter_fastq, CPUs=2, chunks=6)
+    for (in_fastq, out_files), output in zip(jobs, sums):
+        assert output[0].equals(serial[0])
+        for out_file, serial_file in zip(out_files, serial_files):
+            with gzip.open(out_file) as f, gzip.open(serial_file) as g:
+                assert f.read() == g.read()
+    assert list(timings['Units']) == [3, 3]
+
+def test_manifest_keeps_only_summed_outputs(inputs, tmp_path):
+    master = MasterRead(master_read, preprocess_args())
+    names = ['training.fastq.gz', 'cluster.fastq.gz', 'unaligned.fasta.gz']
+    jobs = [(inputs[1], [str(tmp_path / 'out' / name) for name in names])]
+    filename = str(tmp_path / 'manifest.json')
+    sums, timings, utilization = fastq_map_sums(jobs, master.iter_fastq, CPUs=2, chunks=3, manifest=RunManifest(filename, {}))
+    with open(filename) as f:
+        entry = json.load(f)[inputs[1]]
+    assert len(entry['chunks']) == 3 and all(set(chunk) == {'output_sizes'} for chunk in entry['chunks'])
+    with open(filename) as f:
+        assert 'sketch' not in f.read()         # Stats (incl. sketches) are stored beside the manifest
+    assert os.listdir(filename + '.stats') == [entry['stats']]
+    resumed = RunManifest(filename, {}).resume(*jobs[0])
+    assert resumed[1] == 3
+    assert resumed[2][0].equals(sums[0][0])
+    assert resumed[2][5].counts == sums[0][5].counts and resumed[2][5].total == sums[0][5].total
+    resumed_sums, timings, utilization = fastq_map_sums(jobs, master.iter_fastq, CPUs=2, chunks=3, manifest=RunManifest(filename, {}))
+    assert list(timings['Units']) == [0] and resumed_sums[0][0].equals(sums[0][0])
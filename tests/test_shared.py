@@ -0,0 +1,159 @@
+import gc
+import io
+import os
+import pytest
+from conftest import example_fastq
+from tuba_seq.fastq import IterFASTQ
+from tuba_seq.shared import smart_open, detect_compression, compression_ext, file_openers, prefetch, BackgroundReader, BackgroundWriter
+
+data = b''.join(b'@read%d\nACGTACGTNN\n+\nIIIIIIII##\n' % i for i in range(5000))
+requires = dict(zst='zstandard', lz4='lz4.frame')
+detected = dict(bgzf='gz', lzma='xz')
+
+def importable(module):
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+def codec_params(codecs):
+    return [pytest.param(codec, marks=pytest.mark.skipif(not importable(requires[codec]), reason=requires[codec] + ' is not installed'))
+            if codec in requires else codec for codec in codecs]
+
+def write(filename, contents, mode='wb', **kargs):
+    with smart_open(filename, mode, **kargs) as f:
+        f.write(contents)
+
+def read(filename, **kargs):
+    with smart_open(filename, **kargs) as f:
+        return f.read()
+
+codecs = codec_params(['gz', 'bgzf', 'bz2', 'lzma', 'zst', 'lz4', 'none'])
+
+@pytest.mark.parametrize('codec', codecs)
+@pytest.mark.parametrize('background', [False, True])
+def test_round_trip_detects_codec(tmp_path, codec, background):
+    filename = str(tmp_path / ('reads.fastq' + compression_ext(codec)))
+    write(filename, data, compression=codec, background=background)
+    assert detect_compression(filename) == detected.get(codec, codec)
+    assert read(filename, background=background) == data
+    misnamed = str(tmp_path / 'misnamed.fastq.gz')
+    os.rename(filename, misnamed)
+    assert read(misnamed) == data           # Codecs of existing files are detected from magic bytes, not extensions
+
+@pytest.mark.parametrize('codec', codecs)
+def test_concatenated_files(tmp_path, codec):
+    """Appended & `cat`-ed streams (multiple gzip members/zstd frames/...) are read in full."""
+    appended = str(tmp_path / ('appended.fastq' + compression_ext(codec)))
+    write(appended, data[:1000], compression=codec)
+    write(appended, data[1000:], mode='ab', compression=codec)
+    assert read(appended) == data
+    parts = [str(tmp_path / ('{:}.fastq{:}'.format(i, compression_ext(codec)))) for i in range(2)]
+    write(parts[0], data[:5000], compression=codec)
+    write(parts[1], data[5000:], compression=codec)
+    concatenated = str(tmp_path / ('cat.fastq' + compression_ext(codec)))
+    with open(concatenated, 'wb') as f:
+        for part in parts:
+            with open(part, 'rb') as g:
+                f.write(g.read())
+    assert read(concatenated) == data
+
+def test_bgzf_blocks(tmp_path):
+    filename = str(tmp_path / 'reads.fastq.gz')
+    write(filename, data, compression='bgzf', threads=2)
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    assert raw[12:14] == b'BC'                              # BGZF extra subfield
+    assert raw.endswith(bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000'))   # EOF block
+
+def test_extension_infers_codec_of_new_files(tmp_path):
+    for ext, codec in [('.gz', 'gz'), ('.bz2', 'bz2'), ('.xz', 'xz'), ('', 'none'), ('.txt', 'none')]:
+        filename = str(tmp_path / ('reads.fastq' + ext))
+        write(filename, data)
+        assert detect_compression(filename) == codec and read(filename) == data
+    empty = str(tmp_path / 'empty')
+    open(empty, 'wb').close()
+    assert detect_compression(empty) == 'none'
+    assert set(codec for codec in file_openers) >= {'gz', 'bgzf', 'bz2', 'xz', 'zst', 'lz4', 'none'}
+
+class FailingFile(io.BytesIO):
+    """File object whose reads/writes fail after `n` calls."""
+    def __init__(self, contents=b'', n=0):
+        super(FailingFile, self).__init__(contents)
+        self.calls = 0
+        self.n = n
+
+    def read(self, size=-1):
+        self.calls += 1
+        if self.calls > self.n:
+            raise IOError("read failed")
+        return super(FailingFile, self).read(size)
+
+    def write(self, data):
+        self.calls += 1
+        if self.calls > self.n:
+            raise IOError("write failed")
+        return super(FailingFile, self).write(data)
+
+def test_background_reader_raises_errors_of_its_thread():
+    f = prefetch(FailingFile(data, n=2), block_size=1000)
+    assert f.read(2000) == data[:2000]
+    with pytest.raises(IOError):
+        f.read()
+    with pytest.raises(IOError):
+        f.read()
+    f.close()
+
+def test_background_reader_closed_early():
+    f = io.BytesIO(data)
+    reader = BackgroundReader(f, block_size=10, max_blocks=1)
+    assert reader.read(25) == data[:10]
+    reader.close()
+    assert not reader.thread.is_alive() and f.closed
+
+def test_abandoned_readers_stop_their_threads(tmp_path):
+    for Reader in [BackgroundReader, prefetch]:
+        reader = Reader(io.BytesIO(data), block_size=10, max_blocks=1)
+        reader.read(5)
+        thread = reader.thread if isinstance(reader, BackgroundReader) else reader.raw.thread
+        del reader
+        gc.collect()
+        thread.join(5)
+        assert not thread.is_alive()
+    filename = str(tmp_path / 'large.fastq')
+    with open(example_fastq, 'rb') as f, open(filename, 'wb') as g:
+        g.write(f.read()*8)                 # Larger than the prefetched blocks
+    reads = IterFASTQ(filename)
+    next(reads)
+    thread = reads.f.raw.thread
+    del reads
+    gc.collect()
+    thread.join(5)
+    assert not thread.is_alive()
+
+def test_background_writer_raises_errors_at_hand_off():
+    writer = BackgroundWriter(FailingFile(n=1), block_size=10)
+    writer.write(b'x'*10)
+    writer.write(b'y'*10)
+    writer.queue.join()
+    assert writer.f.getvalue() == b'x'*10
+    with pytest.raises(IOError):
+        writer.write(b'z'*10)
+    with pytest.raises(IOError):
+        writer.close()
+
+def test_background_writer_raises_errors_at_close():
+    writer = BackgroundWriter(FailingFile(n=0), block_size=100)
+    writer.write(b'x'*10)
+    with pytest.raises(IOError):
+        writer.close()
+    assert not writer.thread.is_alive()
+
+def test_background_writer_closed_early(tmp_path):
+    filename = str(tmp_path / 'reads.fastq.gz')
+    writer = smart_open(filename, 'wb', background=True)
+    writer.write(data[:100])
+    writer.close()
+    writer.close()
+    assert not writer.thread.is_alive() and read(filename) == data[:100]
@@ -0,0 +1,49 @@
+from collections import Counter
+import numpy as np
+import pytest
+from tuba_seq.sketch import SpaceSaving
+
+def zipf_stream(n, seed):
+    return [b'seq%d' % item for item in np.random.RandomState(seed).zipf(1.3, size=n)]
+
+def sketch(items, capacity):
+    sketch = SpaceSaving(capacity)
+    for item in items:
+        sketch.add(item)
+    return sketch
+
+def assert_bounds(sketch, truth):
+    counts, guaranteed = sketch.top(), sketch.guaranteed()
+    for item, count in counts.items():
+        assert guaranteed[item] <= truth[item] <= count
+    assert all(item in sketch.counts for item, count in truth.items() if count > sketch.floor)
+    assert sketch.total == sum(truth.values())
+
+def test_top_of_exact_sketch():
+    stream = zipf_stream(5000, 0)
+    truth = Counter(stream)
+    exact = sketch(stream, capacity=len(truth))
+    assert exact.floor == 0 and exact.top().to_dict() == dict(truth)
+    top = exact.top(10)
+    assert list(top.values) == [count for item, count in truth.most_common(10)]
+    assert exact.guaranteed().to_dict() == dict(truth)
+    assert exact.heavy_hitters(100).to_dict() == {item:count for item, count in truth.items() if count >= 100}
+
+@pytest.mark.parametrize('parts', [1, 3, 10])
+def test_merged_sketches_bound_counts(parts):
+    stream = zipf_stream(20000, parts)
+    sketches = [sketch(part, capacity=50) for part in np.array_split(np.array(stream, dtype=object), parts)]
+    assert any(s.floor > 0 for s in sketches)
+    for s, part in zip(sketches, np.array_split(np.array(stream, dtype=object), parts)):
+        assert_bounds(s, Counter(part))
+    merged = sum(sketches)
+    assert len(merged) <= 2*50 and merged.floor >= sum(s.floor for s in sketches)
+    assert_bounds(merged, Counter(stream))
+    top = merged.top()
+    assert top.is_monotonic_decreasing and list(merged.top(5).index) == list(top.index[:5])
+
+def test_sketch_round_trips_through_dict():
+    s = sketch(zipf_stream(5000, 1), capacity=20)
+    restored = SpaceSaving.from_dict(s.to_dict())
+    assert restored.counts == s.counts and restored.errors == s.errors
+    assert (restored.floor, restored.total, restored.capacity) == (s.floor, s.total, s.capacity)
@@ -0,0 +1,54 @@
+import os, resource, itertools
+import pytest
+from tuba_seq.striped_smith_waterman import SW, ReferenceSW
+from tuba_seq.fastq import MasterRead, default_master_read
+from conftest import preprocess_args
+
+# Alignments per method of the memory test; set TUBA_SEQ_LEAK_CALLS=10000000 for the full-scale check.
+CALLS = int(os.environ.get('TUBA_SEQ_LEAK_CALLS', 200000))
+WARM_UP = 20000
+MAX_GROWTH_MB = 4
+
+def peak_rss_MB():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024     # kB on Linux
+
+@pytest.fixture(scope='module')
+def reference():
+    return MasterRead(default_master_read, preprocess_args()).c_ref
+
+@pytest.mark.parametrize('method', ['SW.barcode_align', 'SW.char_score', 'ReferenceSW.barcode_align', 'ReferenceSW.score'])
+def test_memory_is_flat(example_reads, reference, method):
+    cls, name = method.split('.')
+    aligner = SW() if cls == 'SW' else ReferenceSW(reference)
+    func = getattr(aligner, name)
+    call = (lambda read: func(read, reference)) if cls == 'SW' else func
+    reads = itertools.cycle(read for read in example_reads if read)
+    for i in range(WARM_UP):
+        call(next(reads))
+    baseline = peak_rss_MB()
+    for i in range(CALLS):
+        call(next(reads))
+    aligner.close()
+    assert peak_rss_MB() - baseline < MAX_GROWTH_MB
+
+@pytest.mark.parametrize('cls', [SW, ReferenceSW])
+def test_close_is_idempotent(example_reads, reference, cls):
+    aligner = SW() if cls is SW else ReferenceSW(reference)
+    if cls is SW:
+        aligner.barcode_align(example_reads[0], reference)
+        aligner.char_score(example_reads[0], reference)
+    else:
+        aligner.barcode_align(example_reads[0])
+    aligner.close()
+    aligner.close()
+    assert aligner.res is None and aligner.qProfile is None
+    assert getattr(aligner, 'rProfile', None) is None
+    aligner.__del__()
+    del aligner
+
+def test_context_manager_releases(example_reads, reference):
+    with SW() as aligner:
+        score = aligner.char_score(example_reads[0], reference)
+        assert aligner.res is not None
+    assert aligner.res is None and aligner.qProfile is None
+    assert score == SW().char_score(example_reads[0], reference)
@@ -0,0 +1,56 @@
+import os
+import numpy as np
+import pytest
+from conftest import repo_dir
+from tuba_seq.fastq import IterFASTQ, default_master_read
+from tuba_seq.synthetic import SyntheticLibrary
+
+sgRNA_file = os.path.join(repo_dir, 'sgRNA_info.csv')
+reads = 25000
+
+@pytest.fixture
+def library():
+    return SyntheticLibrary(sgRNA_file, default_master_read, barcodes=50, seed=0)
+
+def read_fastq(filename):
+    return [(DNA.rstrip(b'\n'), QC.rstrip(b'\n')) for header, DNA, QC in IterFASTQ(filename)]
+
+def flank_matrix(library, records):
+    """(reads x flank bases) matrices of the DNA & QC of the constant flanks of full-length reads."""
+    L = library.amplicons.shape[1]
+    flanks = np.r_[np.arange(len(library.head)), np.arange(L - len(library.tail), L)]
+    full = [(DNA, QC) for DNA, QC in records if len(DNA) == L]
+    DNA = np.frombuffer(b''.join(DNA for DNA, QC in full), dtype=np.uint8).reshape((-1, L))[:, flanks]
+    QC = np.frombuffer(b''.join(QC for DNA, QC in full), dtype=np.uint8).reshape((-1, L))[:, flanks]
+    return DNA, QC, np.frombuffer(library.amplicons[0, flanks].tobytes(), dtype=np.uint8)
+
+def test_write_fastq_rates(library, tmp_path):
+    filename = str(tmp_path / 'synthetic.fastq.gz')
+    error_rate, indel_rate, N_rate = 0.01, 1e-4, 0.005
+    library.write_fastq(filename, reads, error_rate, indel_rate, N_rate, contamination=0, block_size=10000)
+    records = read_fastq(filename)
+    assert len(records) == reads and all(len(DNA) == len(QC) for DNA, QC in records)
+    L = library.amplicons.shape[1]
+    indels = np.mean([len(DNA) != L for DNA, QC in records])
+    assert indels == pytest.approx(indel_rate*L, rel=0.2)
+    DNA, QC, reference = flank_matrix(library, records)
+    Ns = DNA == ord('N')
+    assert Ns.mean() == pytest.approx(N_rate, rel=0.1)
+    assert ((DNA != reference) & ~Ns).mean() == pytest.approx(error_rate*(1 - N_rate), rel=0.1)
+    assert (QC == ord('+')).mean() == pytest.approx(error_rate + N_rate - error_rate*N_rate, rel=0.1)
+
+def test_contaminants_drawn_from_genome(library, tmp_path):
+    genome = ''.join(np.random.RandomState(1).choice(list('ACGT'), size=5000))
+    revcomp = genome[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+    fasta = str(tmp_path / 'genome.fasta')
+    with open(fasta, 'w') as f:
+        f.write('>genome\n' + '\n'.join(genome[i:i+60] for i in range(0, len(genome), 60)) + '\n')
+    filename = str(tmp_path / 'contaminated.fastq')
+    library.write_fastq(filename, 5000, 0, 0, 0, contamination=0.1, contaminant_genome=fasta)
+    head = library.head.encode('ascii')
+    contaminants = [DNA.decode('ascii') for DNA, QC in read_fastq(filename) if not DNA.startswith(head)]
+    assert len(contaminants)/5000 == pytest.approx(0.1, rel=0.15)
+    assert all(DNA in genome or DNA in revcomp for DNA in contaminants)
+    assert 0.3 < np.mean([DNA in genome for DNA in contaminants]) < 0.7
+    with pytest.raises(ValueError):
+        library.write_fastq(filename, 100, contaminant_genome=genome[:50])
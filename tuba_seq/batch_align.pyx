@@ -0,0 +1,397 @@
+"""Batch alignment of reads against a fixed reference.
+
+Reads are packed into one contiguous byte buffer, where read i is 
+seqs[offsets[i]:offsets[i+1]] (see pack_reads). Alignment loops release the GIL,
+so a thread pool can align several blocks concurrently within one process. There
+are two alignment engines, which share the same `align` interface:
+
+1) BatchAligner
+    Striped Smith-Waterman (SSW C library) with the query profile built once 
+    on the reference.
+
+2) BandedAligner
+    Banded semi-global alignment (the entire reference against any substring of
+    the read) for amplicons whose structure is known in advance. 
+
+Scores, barcode (N) coordinates & N-filled reads follow the same contract as
+striped_smith_waterman.ReferenceSW.barcode_align.
+"""
+from libc.stdint cimport int8_t, int32_t, int64_t, uint8_t, uint16_t, uint32_t
+from libc.stdlib cimport malloc, free
+from libc.limits cimport INT_MIN
+cimport cython
+import numpy as np
+cimport numpy as np
+
+cdef extern from "ssw.h" nogil:
+    ctypedef struct s_profile:
+        pass
+    ctypedef struct s_align:
+        uint16_t score1
+        uint16_t score2
+        int32_t ref_begin1
+        int32_t ref_end1
+        int32_t read_begin1
+        int32_t read_end1
+        int32_t ref_end2
+        uint32_t* cigar
+        int32_t cigarLen
+    s_profile* ssw_init(const int8_t* read, const int32_t readLen, const int8_t* mat, const int32_t n, const int8_t score_size)
+    void init_destroy(s_profile* p)
+    s_align* ssw_align(const s_profile* prof, const int8_t* ref, int32_t refLen, const uint8_t weight_gapO, const uint8_t weight_gapE,
+                       const uint8_t flag, const uint16_t filters, const int32_t filterd, const int32_t maskLen)
+    void align_destroy(s_align* a)
+
+cdef:
+    uint32_t CIGAR_INS = 1      # Base of the reference (the SSW query) aligned to a gap in the read
+    uint32_t CIGAR_DEL = 2      # Base of the read (the SSW target) aligned to a gap in the reference
+    uint8_t o_N = ord('N')
+
+lEle = np.frombuffer(b'ACGTN', dtype=np.uint8)
+nEle2Int = np.zeros(256, dtype=np.int8)
+nEle2Int[lEle] = np.arange(len(lEle))
+
+cdef class _ReadAligner:
+    """Base class of alignment engines: scoring, encoding & the (threaded) `align` method."""
+    cdef int8_t mat[25]
+    cdef int8_t nEle2Int[256]
+    cdef uint8_t[::1] is_N
+    cdef uint8_t[::1] ref_bases
+    cdef int8_t[::1] nReference
+    cdef uint8_t gap_open, gap_extend
+    cdef readonly bytes reference
+    cdef readonly dict scoring
+
+    def __cinit__(self, bytes reference, int match=6, int mismatch=2, int gap_open=6, int gap_extend=1, *args, **kargs):
+        cdef int i, j, n = len(lEle)
+        self.reference = reference
+        self.scoring = dict(match=match, mismatch=mismatch, gap_open=gap_open, gap_extend=gap_extend)
+        for i in range(256):
+            self.nEle2Int[i] = nEle2Int[i]
+        for i in range(n):
+            for j in range(n):
+                self.mat[i*n + j] = 0 if lEle[i] == ord('N') or lEle[j] == ord('N') else (match if i == j else mismatch)
+        self.gap_open = gap_open
+        self.gap_extend = gap_extend
+        ref_bytes = np.frombuffer(reference, dtype=np.uint8)
+        self.ref_bases = ref_bytes.copy()
+        self.is_N = (ref_bytes == ord('N')).astype(np.uint8)
+        self.nReference = nEle2Int[ref_bytes]
+
+    def __reduce__(self):
+        return (_rebuild_aligner, (type(self), self.reference, self.scoring))
+
+    cdef int _align_range(self, const uint8_t[::1] seqs, const int64_t[::1] offsets, Py_ssize_t lo, Py_ssize_t hi,
+                          int32_t[::1] scores, int32_t[::1] N_starts, int32_t[::1] N_stops, int32_t[::1] begins, uint8_t* filled) nogil:
+        return -1
+
+    def align(self, seqs, offsets, int threads=1, bint fill_Ns=False):
+        """Aligns every read in a packed block of reads.
+
+Parameters:
+-----------
+seqs : Contiguous buffer (bytes, bytearray, or uint8 array) of concatenated reads.
+
+offsets : int64 array of length (# reads + 1); read i is seqs[offsets[i]:offsets[i+1]].
+
+threads : Number of threads to split the block across (default: 1).
+
+fill_Ns : Also return the N-filled reads (default: False).
+
+Returns: scores, N_starts, N_stops, begins (int32 arrays) [, filled]. N_starts &
+    N_stops are the barcode coordinates within each read, begins is the first 
+    aligned position of each read. Unalignable reads have a score of 0 & 
+    coordinates of -1. `filled` (a uint8 copy of seqs, with the same offsets) 
+    replaces every N of a read that is aligned to a reference base by that base.
+"""
+        seqs = np.frombuffer(seqs, dtype=np.uint8) if not isinstance(seqs, np.ndarray) else seqs
+        offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        n = len(offsets) - 1
+        outputs = [np.empty(n, dtype=np.int32) for i in range(4)]
+        filled = np.array(seqs, dtype=np.uint8) if fill_Ns else None
+        if threads <= 1 or n < 2*threads:
+            status = self._align_block(seqs, offsets, 0, n, *outputs, filled=filled)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            bounds = np.linspace(0, n, threads + 1).round().astype(int)
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                status = min(executor.map(lambda lo, hi: self._align_block(seqs, offsets, lo, hi, *outputs, filled=filled), bounds[:-1], bounds[1:]))
+        if status != 0:
+            raise MemoryError("Could not allocate alignment buffer.")
+        return tuple(outputs) + ((filled,) if fill_Ns else ())
+
+    def _align_block(self, const uint8_t[::1] seqs, const int64_t[::1] offsets, Py_ssize_t lo, Py_ssize_t hi,
+                     int32_t[::1] scores, int32_t[::1] N_starts, int32_t[::1] N_stops, int32_t[::1] begins, uint8_t[::1] filled=None):
+        cdef int status
+        cdef uint8_t* fill = &filled[0] if filled is not None and filled.shape[0] > 0 else NULL
+        with nogil:
+            status = self._align_range(seqs, offsets, lo, hi, scores, N_starts, N_stops, begins, fill)
+        return status
+
+cdef class BatchAligner(_ReadAligner):
+    """Aligns blocks of reads to a reference with a single, reusable SSW query profile.
+
+Parameters:
+-----------
+reference : Reference sequence (bytes). Degenerate positions are 'N'.
+
+match, mismatch, gap_open, gap_extend : Scoring parameters, identical to
+    striped_smith_waterman.SW.
+"""
+    cdef s_profile* profile
+    cdef int32_t mask_len
+
+    def __cinit__(self, bytes reference, *args, **kargs):
+        self.profile = NULL
+        self.mask_len = len(reference) // 2 if len(reference) > 30 else 15
+        # ssw_init keeps a pointer to the encoded reference, so it is stored for the lifetime of the profile.
+        self.profile = ssw_init(&self.nReference[0], len(reference), self.mat, len(lEle), 2)
+        if self.profile == NULL:
+            raise MemoryError("Could not allocate SSW query profile.")
+
+    def __dealloc__(self):
+        if self.profile != NULL:
+            init_destroy(self.profile)
+            self.profile = NULL
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int _align_range(self, const uint8_t[::1] seqs, const int64_t[::1] offsets, Py_ssize_t lo, Py_ssize_t hi,
+                          int32_t[::1] scores, int32_t[::1] N_starts, int32_t[::1] N_stops, int32_t[::1] begins, uint8_t* filled) nogil:
+        cdef:
+            Py_ssize_t i, j, L, max_L = 0
+            int32_t k, n, f, r, N_start, N_stop
+            uint32_t op
+            s_align* res
+            int8_t* buf
+        for i in range(lo, hi):
+            L = offsets[i+1] - offsets[i]
+            if L > max_L:
+                max_L = L
+        buf = <int8_t*>malloc(max_L + 1)
+        if buf == NULL:
+            return -1
+        for i in range(lo, hi):
+            scores[i] = 0
+            N_starts[i] = -1
+            N_stops[i] = -1
+            begins[i] = -1
+            L = offsets[i+1] - offsets[i]
+            if L == 0:
+                continue
+            for j in range(L):
+                buf[j] = self.nEle2Int[seqs[offsets[i] + j]]
+            res = ssw_align(self.profile, buf, L, self.gap_open, self.gap_extend, 2, 0, 0, self.mask_len)
+            if res == NULL:
+                continue
+            scores[i] = res.score1
+            begins[i] = res.ref_begin1
+            # Project the degenerate region of the reference onto the read by walking the CIGAR
+            # (roles are reversed: the reference is the SSW query & the read is the SSW target).
+            f = res.read_begin1
+            r = res.ref_begin1
+            N_start = -1
+            N_stop = -1
+            for k in range(res.cigarLen):
+                op = res.cigar[k] & 0xf
+                n = res.cigar[k] >> 4
+                if op == CIGAR_DEL:
+                    r += n
+                    continue
+                for j in range(n):
+                    if self.is_N[f]:
+                        if N_start == -1:
+                            N_start = r
+                        N_stop = r if op == CIGAR_INS else r + 1
+                    if filled != NULL and op != CIGAR_INS and seqs[offsets[i] + r] == o_N:
+                        filled[offsets[i] + r] = self.ref_bases[f]
+                    f += 1
+                    if op != CIGAR_INS:
+                        r += 1
+            N_starts[i] = N_start
+            N_stops[i] = N_stop
+            align_destroy(res)
+        free(buf)
+        return 0
+
+cdef class BandedAligner(_ReadAligner):
+    """Aligns blocks of reads to a reference by banded, semi-global dynamic programming.
+
+Reads of a fixed amplicon are nearly identical to the reference, which begins at
+a known position within every read. The entire reference is aligned (globally) 
+to a substring of the read (locally), considering only read positions within 
+`bandwidth` of the expected diagonal. Work per read is therefore 
+O(len(reference) x bandwidth), rather than O(len(reference) x len(read)).
+
+Parameters:
+-----------
+reference : Reference sequence (bytes). Degenerate positions are 'N'.
+
+ref_offset : Expected position of the reference's first base within reads.
+
+bandwidth : Largest deviation from the expected diagonal that can be aligned, 
+    i.e. the largest net indel (default: 8).
+
+min_identity : Minimum fraction of the reference's non-degenerate bases that
+    must be matched by the read. Reads whose amplicon lies outside of the band
+    are forced onto the expected diagonal & match poorly; these reads are 
+    reported as unaligned (score 0, coordinates -1), so that they can be 
+    re-aligned by BatchAligner (default: 0.8).
+
+match, mismatch, gap_open, gap_extend : Scoring parameters, identical to
+    striped_smith_waterman.SW. A gap of length L costs gap_open + (L-1)*gap_extend.
+"""
+    cdef readonly int32_t ref_offset, bandwidth
+    cdef readonly double min_identity
+    cdef int32_t min_matches
+
+    def __cinit__(self, bytes reference, *args, int ref_offset=0, int bandwidth=8, double min_identity=0.8, **kargs):
+        if ref_offset < 0 or bandwidth < 0:
+            raise ValueError("ref_offset & bandwidth must be non-negative.")
+        self.ref_offset = ref_offset
+        self.bandwidth = bandwidth
+        self.min_identity = min_identity
+        self.min_matches = int(np.ceil(min_identity*(len(reference) - np.sum(self.is_N))))
+
+    def __reduce__(self):
+        return (_rebuild_aligner, (type(self), self.reference, dict(self.scoring, ref_offset=self.ref_offset, bandwidth=self.bandwidth, min_identity=self.min_identity)))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int _align_range(self, const uint8_t[::1] seqs, const int64_t[::1] offsets, Py_ssize_t lo, Py_ssize_t hi,
+                          int32_t[::1] scores, int32_t[::1] N_starts, int32_t[::1] N_stops, int32_t[::1] begins, uint8_t* filled) nogil:
+        cdef:
+            Py_ssize_t x, i, k, k_best, cell, row, prev, m = self.nReference.shape[0], W = 2*self.bandwidth + 1
+            int64_t j, L, first_j = self.ref_offset - self.bandwidth
+            int32_t best, best_I, best_D, a, b, N_start, N_stop, matches
+            int32_t NEG = INT_MIN // 2
+            uint8_t trace_bits, state
+            const uint8_t* read
+            int32_t* H = <int32_t*>malloc((m+1)*W*sizeof(int32_t))
+            int32_t* I = <int32_t*>malloc((m+1)*W*sizeof(int32_t))
+            int32_t* D = <int32_t*>malloc((m+1)*W*sizeof(int32_t))
+            uint8_t* trace = <uint8_t*>malloc((m+1)*W)
+        # trace bits: 0-1 source of H (0: match/mismatch, 1: I, 2: D), 2: I extends I, 3: D extends D
+        if H == NULL or I == NULL or D == NULL or trace == NULL:
+            free(H); free(I); free(D); free(trace)
+            return -1
+        for x in range(lo, hi):
+            scores[x] = 0
+            N_starts[x] = -1
+            N_stops[x] = -1
+            begins[x] = -1
+            L = offsets[x+1] - offsets[x]
+            if L == 0:
+                continue
+            read = &seqs[offsets[x]]
+            # Row 0: the reference may begin anywhere within the band (free leading read bases).
+            for k in range(W):
+                j = first_j + k
+                H[k] = 0 if 0 <= j <= L else NEG
+                I[k] = NEG
+                D[k] = NEG
+            for i in range(1, m+1):
+                row = i*W
+                prev = row - W
+                for k in range(W):
+                    cell = row + k
+                    j = first_j + i + k
+                    if j < 0 or j > L:
+                        H[cell] = I[cell] = D[cell] = NEG
+                        continue
+                    trace_bits = 0
+                    # I: reference base i-1 aligned to a gap in the read, from (i-1, j)
+                    best_I = NEG
+                    if k + 1 < W:
+                        a = H[prev+k+1] - self.gap_open
+                        b = I[prev+k+1] - self.gap_extend
+                        best_I = a if a >= b else b
+                        if b > a:
+                            trace_bits |= 4
+                    # D: read base j-1 aligned to a gap in the reference, from (i, j-1)
+                    best_D = NEG
+                    if k > 0 and j > 0:
+                        a = H[cell-1] - self.gap_open
+                        b = D[cell-1] - self.gap_extend
+                        best_D = a if a >= b else b
+                        if b > a:
+                            trace_bits |= 8
+                    best = NEG
+                    if j > 0:
+                        best = H[prev+k] + self.mat[self.nReference[i-1]*5 + self.nEle2Int[read[j-1]]]
+                    if best_I > best:
+                        best = best_I
+                        trace_bits |= 1
+                    if best_D > best:
+                        best = best_D
+                        trace_bits = (trace_bits & 12) | 2
+                    H[cell] = best
+                    I[cell] = best_I
+                    D[cell] = best_D
+                    trace[cell] = trace_bits
+            # The reference may end anywhere within the band (free trailing read bases).
+            row = m*W
+            k_best = 0
+            for k in range(1, W):
+                if H[row+k] > H[row+k_best]:
+                    k_best = k
+            best = H[row+k_best]
+            if best <= NEG // 2:
+                continue
+            # Traceback, projecting the degenerate region of the reference onto the read.
+            i = m
+            k = k_best
+            j = first_j + i + k
+            state = 0
+            N_start = -1
+            N_stop = -1
+            matches = 0
+            while i > 0:
+                cell = i*W + k
+                if state == 0:
+                    state = trace[cell] & 3
+                    if state != 0:
+                        continue
+                    if self.is_N[i-1]:
+                        if N_stop == -1:
+                            N_stop = j
+                        N_start = j - 1
+                    elif self.nReference[i-1] == self.nEle2Int[read[j-1]]:
+                        matches += 1
+                    if filled != NULL and read[j-1] == o_N:
+                        filled[offsets[x] + j - 1] = self.ref_bases[i-1]
+                    i -= 1
+                    j -= 1
+                elif state == 1:
+                    if self.is_N[i-1]:
+                        if N_stop == -1:
+                            N_stop = j
+                        N_start = j
+                    state = 1 if trace[cell] & 4 else 0
+                    i -= 1
+                    k += 1
+                else:
+                    state = 2 if trace[cell] & 8 else 0
+                    j -= 1
+                    k -= 1
+            if matches < self.min_matches:
+                if filled != NULL:              # Unaligned reads are not filled
+                    for j in range(L):
+                        filled[offsets[x] + j] = read[j]
+                continue
+            scores[x] = best if best > 0 else 0
+            N_starts[x] = N_start
+            N_stops[x] = N_stop
+            begins[x] = j
+        free(H); free(I); free(D); free(trace)
+        return 0
+
+def _rebuild_aligner(cls, reference, kargs):
+    return cls(reference, **kargs)
+
+def pack_reads(reads):
+    """Packs an iterable of reads (bytes) into a contiguous buffer & offsets for `align`."""
+    reads = list(reads)
+    offsets = np.zeros(len(reads) + 1, dtype=np.int64)
+    np.cumsum([len(read) for read in reads], out=offsets[1:])
+    return b''.join(reads), offsets
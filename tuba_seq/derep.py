@@ -0,0 +1,409 @@
+"""Dereplication of reads into DADA2 `derep` objects, without R.
+
+A Dereplicator tallies the unique sequences of reads, the sum of their quality
+scores at every position, & the unique sequence of every read (the `map`)--i.e.
+the contents of a derep object of dada2::derepFastq. Qualities are summed in
+vectorized blocks of reads. When its table of uniques outgrows `max_bytes`, the
+table is spilled to temporary files & a new table begins. Spilled tables are
+merged out of core when the Dereplicator finishes: their uniques are hash-
+partitioned into buckets that are merged one at a time, & summed qualities are
+written to a memory-mapped file, which the RDS writer reads in blocks.
+
+write_derep_rds() saves a derep object as an RDS file (gzip-compressed XDR
+serialization, version 2), which readRDS() loads & DADA2 (dada, learnErrors)
+accepts directly. A DerepWriter is a file-like sink of FASTQ records (e.g. an
+output of MasterRead.iter_fastq) that writes this RDS file when closed, so reads
+are dereplicated as they are written. DerepWriters of file objects (e.g. the
+MemorySinks of fastq_map_sum workers) write partial tables instead, which are
+concatenated like other outputs & merged into an RDS file by merge_partials().
+"""
+import os, io, gzip, zlib, struct, shutil, tempfile
+from array import array
+from time import perf_counter
+import numpy as np
+
+derep_ext = '.rds'
+PHRED_OFFSET = 33
+PARTIAL_MAGIC = b'TSDP'
+DEFAULT_MAX_BYTES = 2**28
+UNIQUE_OVERHEAD = 100       # Approximate bytes of the index entry of a unique, besides its sequence
+
+def is_derep(filename):
+    """Whether output `filename` (or MemorySink) is dereplicated, i.e. named *.rds."""
+    return str(getattr(filename, 'name', filename)).endswith(derep_ext)
+
+def _sum_uniques(tables):
+    """(sorted unique seqs, index of the unique of every row of the tables, summed 
+counts, summed qsums, row offsets of the tables) of tables (dicts of seqs, counts 
+& qsums)."""
+    width = max([table['qsums'].shape[1] for table in tables] + [0])
+    n = sum(len(table['seqs']) for table in tables)
+    seqs = np.concatenate([table['seqs'] for table in tables] + [np.zeros(0, dtype='S1')])
+    uniques, inverse = np.unique(seqs, return_inverse=True)
+    counts = np.zeros(len(uniques), dtype=np.int64)
+    np.add.at(counts, inverse, np.concatenate([table['counts'] for table in tables] + [np.zeros(0, dtype=np.int64)]))
+    qsums = np.zeros((n, width), dtype=np.int64)
+    offsets = np.zeros(len(tables) + 1, dtype=np.int64)
+    for i, table in enumerate(tables):
+        offsets[i+1] = offsets[i] + len(table['seqs'])
+        qsums[offsets[i]:offsets[i+1], :table['qsums'].shape[1]] = table['qsums']
+    if n > 0:
+        order = np.argsort(inverse, kind='stable')
+        starts = np.searchsorted(inverse[order], np.arange(len(uniques)))
+        qsums = np.add.reduceat(qsums[order], starts, axis=0)
+    else:
+        qsums = qsums[:0]
+    return uniques, inverse, counts, qsums, offsets
+
+def _by_abundance(seqs, counts):
+    """Order of uniques by decreasing abundance (& then sequence)."""
+    return np.lexsort((seqs, -counts))
+
+def _merge_tables(tables):
+    """Merges tables (dicts of seqs, counts, qsums & map) into one table, whose
+uniques are sorted by decreasing abundance & whose map concatenates the maps
+of the tables (in order)."""
+    uniques, inverse, counts, qsums, offsets = _sum_uniques(tables)
+    by_abundance = _by_abundance(uniques, counts)
+    rank = np.empty_like(by_abundance)
+    rank[by_abundance] = np.arange(len(by_abundance))
+    read_map = np.concatenate([rank[inverse[offset + table['map']]] for offset, table in zip(offsets, tables)] + [np.zeros(0, dtype=np.int64)])
+    return dict(seqs=uniques[by_abundance], counts=counts[by_abundance], qsums=qsums[by_abundance], map=read_map.astype(np.int32))
+
+def _table_bytes(table):
+    return table['qsums'].nbytes + table['seqs'].nbytes + table['map'].nbytes
+
+class _SpilledTables(object):
+    """Tables merged out of core. The uniques of every added table are hash-
+partitioned into `buckets` files (& its map saved), so that merge() sums one
+bucket at a time & writes the summed qualities into a memory-mapped file. Only
+the sequences & abundances of all uniques are held in memory at once; the map
+of the merged table is a generator of the maps of the added tables (in order).
+"""
+    def __init__(self, temp_dir=None, buckets=64):
+        self.dir = tempfile.mkdtemp(prefix='derep', dir=temp_dir)
+        self.buckets = buckets
+        self.sizes = []         # Uniques of every added table
+        self.reads = 0
+        self.width = 0
+
+    def _file(self, *name):
+        return os.path.join(self.dir, '.'.join(map(str, name)))
+
+    def add(self, table):
+        k = len(self.sizes)
+        seqs = table['seqs']
+        bucket = np.fromiter((zlib.crc32(seq) % self.buckets for seq in seqs), dtype=np.int64, count=len(seqs))
+        order = np.argsort(bucket, kind='stable')
+        bounds = np.searchsorted(bucket[order], np.arange(self.buckets + 1))
+        for b in range(self.buckets):
+            rows = order[bounds[b]:bounds[b+1]]
+            if len(rows):
+                np.savez(self._file(b, k, 'npz'), rows=rows, seqs=seqs[rows], counts=table['counts'][rows], qsums=table['qsums'][rows])
+        np.save(self._file('map', k, 'npy'), table['map'])
+        self.sizes.append(len(seqs))
+        self.reads += len(table['map'])
+        self.width = max(self.width, table['qsums'].shape[1])
+
+    def merge(self):
+        """Merged table (see _merge_tables), with qsums in a memory-mapped file."""
+        ids = [np.zeros(size, dtype=np.int64) for size in self.sizes]     # Merged unique of every unique of every table
+        seqs, counts, n = [], [], 0
+        for b in range(self.buckets):
+            parts = []
+            for k in range(len(self.sizes)):
+                if os.path.exists(self._file(b, k, 'npz')):
+                    with np.load(self._file(b, k, 'npz')) as npz:
+                        parts.append((k, {key:npz[key] for key in npz.files}))
+            if not parts:
+                continue
+            uniques, inverse, bucket_counts, qsums, offsets = _sum_uniques([part for k, part in parts])
+            for (k, part), start, stop in zip(parts, offsets[:-1], offsets[1:]):
+                ids[k][part['rows']] = n + inverse[start:stop]
+                os.remove(self._file(b, k, 'npz'))
+            np.save(self._file('merged', b, 'npy'), qsums)
+            seqs.append(uniques)
+            counts.append(bucket_counts)
+            n += len(uniques)
+        seqs = np.concatenate(seqs + [np.zeros(0, dtype='S1')])
+        counts = np.concatenate(counts + [np.zeros(0, dtype=np.int64)])
+        by_abundance = _by_abundance(seqs, counts)
+        rank = np.empty_like(by_abundance)
+        rank[by_abundance] = np.arange(n)
+        qsums = np.lib.format.open_memmap(self._file('qsums', 'npy'), mode='w+', dtype=np.int64, shape=(n, self.width), fortran_order=True)
+        start = 0
+        for b in range(self.buckets):
+            if os.path.exists(self._file('merged', b, 'npy')):
+                bucket_qsums = np.load(self._file('merged', b, 'npy'))
+                rows = rank[start:start+len(bucket_qsums)]
+                for j in range(bucket_qsums.shape[1]):
+                    qsums[rows, j] = bucket_qsums[:, j]
+                start += len(bucket_qsums)
+                os.remove(self._file('merged', b, 'npy'))
+        maps = (rank[ids[k][np.load(self._file('map', k, 'npy'), mmap_mode='r')]].astype(np.int32) for k in range(len(self.sizes)))
+        return dict(seqs=seqs[by_abundance], counts=counts[by_abundance], qsums=qsums, map=maps, reads=self.reads)
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def _in_memory(table):
+    """`table` with its qsums & map (see _SpilledTables.merge) loaded into memory."""
+    read_map = table['map']
+    if not isinstance(read_map, np.ndarray):
+        read_map = np.concatenate(list(read_map) + [np.zeros(0, dtype=np.int32)])
+    return dict(seqs=table['seqs'], counts=table['counts'], qsums=np.ascontiguousarray(table['qsums']), map=read_map)
+
+class Dereplicator(object):
+    """Unique sequences, their abundances & summed qualities (see module docstring).
+
+Parameters:
+-----------
+max_bytes : Approximate memory of the table of uniques before it is spilled to 
+    disk (default: 256 MB).
+
+block_size : Reads whose qualities are summed at once (default: 65,536).
+
+temp_dir : Directory of spilled tables (default: the system's temporary
+    directory).
+"""
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, block_size=2**16, temp_dir=None):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.temp_dir = temp_dir
+        self.spilled = None         # _SpilledTables, once a table has been spilled
+        self._new_table()
+
+    def _new_table(self):
+        self.index = {}
+        self.map = array('i')
+        self.qsums = np.zeros((0, 0), dtype=np.int64)
+        self.block = []             # Qualities of reads that await summation
+
+    def add(self, DNA, QC):
+        """Adds a read (DNA & QC bytes)."""
+        index = self.index
+        i = index.get(DNA)
+        if i is None:
+            i = index[DNA] = len(index)
+        self.map.append(i)
+        self.block.append(QC)
+        if len(self.block) >= self.block_size:
+            self._sum_block()
+            if self.qsums.nbytes + len(index)*(self.qsums.shape[1] + UNIQUE_OVERHEAD) + 4*len(self.map) > self.max_bytes:
+                self._spill()
+    def _sum_block(self):
+        n = len(self.block)
+        if n == 0:
+            return
+        ix = np.array(self.map[len(self.map) - n:], dtype=np.int64)
+        lengths = np.fromiter(map(len, self.block), dtype=np.int64, count=n)
+        width = lengths.max()
+        qualities = np.frombuffer(b''.join(self.block), dtype=np.uint8)
+        if (lengths == width).all():
+            Q = qualities.reshape(n, width)
+        else:
+            Q = np.full((n, width), PHRED_OFFSET, dtype=np.uint8)
+            Q[np.arange(width) < lengths[:, np.newaxis]] = qualities
+        order = np.argsort(ix, kind='stable')
+        ix = ix[order]
+        starts = np.flatnonzero(np.r_[True, ix[1:] != ix[:-1]])
+        sums = np.add.reduceat(Q[order].astype(np.int64), starts, axis=0) - PHRED_OFFSET*np.diff(np.r_[starts, n])[:, np.newaxis]
+        rows, columns = self.qsums.shape
+        if len(self.index) > rows or width > columns:
+            grown = np.zeros((max(len(self.index), 2*rows), max(width, columns)), dtype=np.int64)
+            grown[:rows, :columns] = self.qsums
+            self.qsums = grown
+        self.qsums[ix[starts], :width] += sums
+        self.block = []
+
+    def _table(self):
+        n = len(self.index)
+        read_map = np.array(self.map, dtype=np.int32)
+        return dict(seqs=np.array(list(self.index), dtype=bytes) if n else np.zeros(0, dtype='S1'),
+                    counts=np.bincount(read_map, minlength=n).astype(np.int64),
+                    qsums=self.qsums[:n], map=read_map)
+
+    def _spill(self):
+        if self.spilled is None:
+            self.spilled = _SpilledTables(self.temp_dir)
+        self.spilled.add(self._table())
+        self._new_table()
+
+    def finish(self):
+        """Merged table (dict of seqs, counts, qsums & map) of all reads, sorted by 
+decreasing abundance. Tables that were spilled are merged out of core (see 
+_SpilledTables.merge), & their files are removed by close()."""
+        self._sum_block()
+        if self.spilled is None:
+            table = _merge_tables([self._table()])
+        else:
+            self.spilled.add(self._table())
+            table = self.spilled.merge()
+        self._new_table()
+        return table
+
+    def close(self):
+        """Removes the files of spilled tables."""
+        if self.spilled is not None:
+            self.spilled.close()
+            self.spilled = None
+
+####################### RDS (R serialization) Writer ##########################
+NILVALUE_SXP, SYMSXP, LISTSXP, CHARSXP, INTSXP, REALSXP, STRSXP, VECSXP = 254, 1, 2, 9, 13, 14, 16, 19
+ASCII_LEVEL = 64
+NA_REAL = 0x7FF00000000007A2
+R_VERSION = 0x030600        # Written by R 3.6.0 ...
+MIN_R_VERSION = 0x020300    # ... & readable by R >= 2.3.0
+
+def _sexp_header(sexp_type, attributes=False, is_object=False, tag=False, levels=0):
+    return struct.pack('>i', sexp_type | is_object << 8 | attributes << 9 | tag << 10 | levels << 12)
+
+def _charsxp(s):
+    return _sexp_header(CHARSXP, levels=ASCII_LEVEL) + struct.pack('>i', len(s)) + s
+
+def _attributes(pairs):
+    return b''.join([_sexp_header(LISTSXP, tag=True) + _sexp_header(SYMSXP) + _charsxp(name) + value for name, value in pairs]) + _sexp_header(NILVALUE_SXP)
+
+def _vector_header(sexp_type, length, attributes=False, is_object=False):
+    return _sexp_header(sexp_type, attributes, is_object) + struct.pack('>i', length)
+
+def _vector(sexp_type, length, data, attributes=(), is_object=False):
+    return _vector_header(sexp_type, length, bool(attributes), is_object) + data + (_attributes(attributes) if attributes else b'')
+
+def _strsxp(strings):
+    return _vector(STRSXP, len(strings), b''.join(map(_charsxp, strings)))
+
+def write_derep_rds(filename, table, level=6, block_bytes=2**25):
+    """Saves a table (see Dereplicator.finish) as the RDS file of a derep object: a
+list of `uniques` (named integer vector of abundances), `quals` (matrix of the mean
+quality of every unique at every position; NA beyond its length) & `map` (index
+of every read's unique). Qualities are written in blocks of columns (of about
+`block_bytes`), & a map may be an iterable of arrays (of `reads` in total), so
+that tables merged out of core are written without loading them."""
+    seqs = [bytes(seq) for seq in table['seqs']]
+    n, width = table['qsums'].shape
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    names = _strsxp(seqs)
+    maps = [table['map']] if isinstance(table['map'], np.ndarray) else table['map']
+    reads = table['reads'] if 'reads' in table else len(table['map'])
+    with open(filename, 'wb') as raw, gzip.GzipFile('', 'wb', compresslevel=level, fileobj=raw, mtime=0) as f:
+        f.write(b'X\n' + struct.pack('>iii', 2, R_VERSION, MIN_R_VERSION))
+        f.write(_vector_header(VECSXP, 3, attributes=True, is_object=True))
+        f.write(_vector(INTSXP, n, table['counts'].astype('>i4').tobytes(), [(b'names', names)]))
+        f.write(_vector_header(REALSXP, n*width, attributes=True))
+        columns = max(1, block_bytes//(8*max(n, 1)))
+        for start in range(0, width, columns):
+            stop = min(start + columns, width)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                quals = (np.asarray(table['qsums'][:, start:stop])/table['counts'][:, np.newaxis]).astype('>f8')
+            quals.view('>u8')[np.arange(start, stop) >= lengths[:, np.newaxis]] = NA_REAL
+            f.write(quals.tobytes(order='F'))
+        f.write(_attributes([(b'dim', _vector(INTSXP, 2, struct.pack('>ii', n, width))),
+                             (b'dimnames', _vector(VECSXP, 2, names + _sexp_header(NILVALUE_SXP)))]))
+        f.write(_vector_header(INTSXP, reads))
+        for read_map in maps:
+            f.write((read_map + 1).astype('>i4').tobytes())
+        f.write(_attributes([(b'names', _strsxp([b'uniques', b'quals', b'map'])), (b'class', _strsxp([b'derep']))]))
+
+############################### Partial Tables ################################
+def _write_partial(f, table):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **_in_memory(table))
+    data = buffer.getvalue()
+    f.write(PARTIAL_MAGIC + struct.pack('<Q', len(data)) + data)
+
+def _read_partials(filename):
+    with open(filename, 'rb') as f:
+        while True:
+            header = f.read(12)
+            if not header:
+                return
+            if len(header) < 12 or header[:4] != PARTIAL_MAGIC:
+                raise RuntimeError("{:} is not a file of partial dereplications.".format(filename))
+            size = struct.unpack('<Q', header[4:])[0]
+            with np.load(io.BytesIO(f.read(size))) as npz:
+                yield {key:npz[key] for key in npz.files}
+
+def merge_partials(filename, level=6, max_bytes=DEFAULT_MAX_BYTES, temp_dir=None):
+    """Replaces a file of concatenated partial tables (written by DerepWriters of
+file objects) with the RDS file of their merged derep object. Partial tables
+are merged in memory, unless they exceed `max_bytes` (see Dereplicator), in 
+which case they are merged out of core (see _SpilledTables)."""
+    filename = str(filename)
+    tables, size, spilled = [], 0, None
+    temp = filename + '.tmp'
+    try:
+        for table in _read_partials(filename):
+            tables.append(table)
+            size += _table_bytes(table)
+            if size > max_bytes:
+                if spilled is None:
+                    spilled = _SpilledTables(temp_dir)
+                for partial in tables:
+                    spilled.add(partial)
+                tables, size = [], 0
+        if spilled is None:
+            write_derep_rds(temp, _merge_tables(tables), level=level)
+        else:
+            for partial in tables:
+                spilled.add(partial)
+            write_derep_rds(temp, spilled.merge(), level=level)
+    finally:
+        if spilled is not None:
+            spilled.close()
+    os.replace(temp, filename)
+
+class DerepWriter(object):
+    """File-like sink of FASTQ records that dereplicates them into `filename` (see
+module docstring). `bytes_in` counts the bytes written & `busy` the seconds spent
+writing the derep object (or partial table) upon closing.
+
+Parameters:
+-----------
+filename : RDS file to write, or file object (e.g. MemorySink) of a partial table.
+
+max_bytes : See Dereplicator.
+
+level : gzip compression level of the RDS file (default: 6, as saveRDS).
+"""
+    def __init__(self, filename, max_bytes=DEFAULT_MAX_BYTES, level=6):
+        self.filename = filename
+        self.level = level
+        self.dereplicator = Dereplicator(max_bytes)
+        self.bytes_in = 0
+        self.busy = 0.
+        self.closed = False
+
+    def write(self, data):
+        lines = data.split(b'\n')
+        add = self.dereplicator.add
+        for i in range(0, len(lines) - 1, 4):
+            add(lines[i+1], lines[i+3])
+        self.bytes_in += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            start = perf_counter()
+            try:
+                table = self.dereplicator.finish()
+                if hasattr(self.filename, 'write'):
+                    _write_partial(self.filename, table)
+                else:
+                    head = os.path.dirname(str(self.filename))
+                    if head:
+                        os.makedirs(head, exist_ok=True)
+                    write_derep_rds(str(self.filename), table, level=self.level)
+            finally:
+                self.dereplicator.close()
+            self.busy += perf_counter() - start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
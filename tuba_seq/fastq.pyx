@@ -1,9 +1,10 @@
 """Low-level, efficient functionality to handle FASTQ files.
 
-There are three classes within this module:
+The principal classes within this module are:
 
-1) fastqDF (subclass of pandas.DataFrame)
-    Reads, processes (slices, queries, etc), and writes FASTQ files.
+1) fastqDF (subclass of pandas.DataFrame) & fastqMatrix
+    Reads, processes (slices, queries, etc), and writes FASTQ files. fastqMatrix
+    stores reads in fixed-width uint8 matrices for vectorized slicing.
 
 2) MasterRead
     Can identify a `MasterRead` from amplicon pileups and then align/score reads
@@ -12,11 +13,17 @@ There are three classes within this module:
 3) singleMismatcher
     Identifies single-mismatch-tolerant substrings within a sequence.
 
+4) IterFASTQ, IterFASTQBatches & IterFASTQRange
+    Iterate over FASTQ files one read at a time, in columnar FASTQBatches of
+    reads stored in contiguous NumPy buffers, or over a byte range located by
+    a FASTQIndex (a sidecar of record offsets & read counts). 
+
 """
 
 import pandas as pd
 import os
 from collections import OrderedDict
+from time import perf_counter
 import numpy as np
 cimport numpy as np
 
@@ -32,24 +39,50 @@ class fastqDF(pd.DataFrame):
 
     @classmethod
     def from_file(cls, filename, fake_header=True, use_Illumina_filter=True, check_lengths=True):
+        lines = pd.read_table(filename, names=['__'], encoding='ascii', quoting=3, dtype=str)['__'].values
+        return cls._from_lines(lines, filename, fake_header, use_Illumina_filter, check_lengths)
+
+    @classmethod
+    def iter_chunks(cls, filename, chunksize=1000000, fake_header=True, use_Illumina_filter=True, check_lengths=True):
+        """Iterates over a FASTQ file in fastqDFs of (at most) `chunksize` reads. 
+
+Every chunk shares the `info` of the first chunk, except 'Initial Reads' (reads
+in the chunk) and 'Chunk' (its ordinal). Write chunks to a single file with 
+write(filename, append=True) after the first chunk. Filters should likewise be
+fixed by the first chunk, e.g. drop_abnormal_lengths(length) of every chunk 
+should use the normal_length() of the first chunk.
+"""
+        info = None
+        for i, chunk in enumerate(pd.read_table(filename, names=['__'], encoding='ascii', quoting=3, dtype=str, chunksize=4*chunksize)):
+            self = cls._from_lines(chunk['__'].values, filename, fake_header, use_Illumina_filter, check_lengths, info=info)
+            self.info['Chunk'] = i
+            info = self.info
+            yield self
+
+    @classmethod
+    def _from_lines(cls, lines, filename, fake_header, use_Illumina_filter, check_lengths, info=None):
         self = cls(pd.DataFrame(
-            data=pd.read_table(filename, names=['__'], encoding='ascii', quoting=3, dtype=str)['__'].values.reshape((-1, 4))[:, [True, True, False, True]], 
+            data=lines.reshape((-1, 4))[:, [True, True, False, True]], 
             columns=cls.essential_columns))
         if use_Illumina_filter:
             self.select_reads(self['header'].str.contains(":N:"))       # Y = failed filter, N = passed filter
-        sample_header = self['header'].iloc[0]
-        split = sample_header.split()
-        self.info = pd.Series(dict(zip(['Instrument', 'Run', 'Flowcell', 'Lane'], split[0].split(':'))))
-        if len(split) == 2:
-            h2 = split[1]
-            self.info['Paired-end'] = h2.split(':')[0] == '1'
-        self.info['Index'] = sample_header.split(':')[-1]
+        if info is not None:
+            self.info = info.copy()
+        else:
+            sample_header = self['header'].iloc[0]
+            split = sample_header.split()
+            self.info = pd.Series(dict(zip(['Instrument', 'Run', 'Flowcell', 'Lane'], split[0].split(':'))))
+            if len(split) == 2:
+                h2 = split[1]
+                self.info['Paired-end'] = h2.split(':')[0] == '1'
+            self.info['Index'] = sample_header.split(':')[-1]
+            self.info['Filtered'] = use_Illumina_filter
+            if fake_header:
+                self.info['Fake Header'] = sample_header
+            self.info['Sample'] = os.path.basename(filename.partition('.fastq')[0])
         self.info['Initial Reads'] = len(self)
-        self.info['Filtered'] = use_Illumina_filter
         if fake_header:
-            self.info['Fake Header'] = sample_header
             self.pop('header') 
-        self.info['Sample'] = os.path.basename(filename.partition('.fastq')[0])
         if check_lengths:
             DNA_L = self['DNA'].str.len()
             QC_L = self['QC'].str.len()
@@ -67,9 +100,13 @@ class fastqDF(pd.DataFrame):
     def isDegenerate(self):
         return self['DNA'].str.contains('N') 
 
-    def drop_abnormal_lengths(self):
-        lengths = self['DNA'].str.len()
-        keep = lengths == int(lengths[:999].median())
+    def normal_length(self):
+        """Median length of the first 999 reads."""
+        return int(self['DNA'].str.len()[:999].median())
+
+    def drop_abnormal_lengths(self, length=None):
+        """Drops reads that are not `length` bases long (default: normal_length())."""
+        keep = self['DNA'].str.len() == (self.normal_length() if length is None else length)
         return self.select_reads(keep)
     
     def co_slice(self, *args, **kargs):
@@ -89,44 +126,216 @@ class fastqDF(pd.DataFrame):
             self.loc[:, ['DNA', 'QC']] = np.array([[dna[Slice], qc[Slice]] for (dna, qc), Slice in zip(initial_seqs, slices)])
 
             if second_slice is not None:
-                second_slice = np.array([[dna[Slice], qc[Slice]] for (dna, qc), Slice in zip(initial_seqs, slices)])
+                second_slice = np.array([[dna[Slice], qc[Slice]] for (dna, qc), Slice in zip(initial_seqs, second_slice)])
                 self['DNA'] = self['DNA'].str.cat(second_slice[:, 0]) 
                 self['QC' ] = self['QC' ].str.cat(second_slice[:, 1])
         return self
 
     def expected_errors(self):
-        return self['QC'].apply(_expected_errors)
-
-    def write(self, filename):
-        if 'Fake Header' in self.info:
-            self.insert(1, 'header', self.info['Fake Header'])
-        if '__plus_sign__' not in self.columns:
-            self.insert(2, '__plus_sign__', len(self)*['+'])
-        filename = filename.split('.fastq')[0] + '.fastq'
-        self.to_csv(filename + '.gz', 
-                    columns=self.essential_columns[0:2] + ['__plus_sign__'] + self.essential_columns[2:3], 
-                    compression='gzip',
-                    header=False,
-                    index=False,
-                    sep='\n')
+        lengths = self['QC'].str.len().values
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        QC = np.frombuffer(''.join(self['QC'].values).encode('ascii'), dtype=np.uint8)
+        return pd.Series(batch_expected_errors(QC, offsets), index=self.index)
+
+    def maxEE_mask(self, maxEE):
+        """Boolean mask of reads with <= `maxEE` expected errors (for select_reads)."""
+        return self.expected_errors() <= maxEE
+
+    def write(self, filename, append=False, block_size=65536):
+        """Writes reads to `filename`.gz (appending to it, if `append`) without modifying the fastqDF.
+
+Records are formatted & compressed in blocks of `block_size` reads.
+"""
+        filename = filename.split('.fastq')[0] + '.fastq.gz'
+        headers = None if 'Fake Header' in self.info else self['header'].values
+        DNA = self['DNA'].values
+        QC = self['QC'].values
+        with smart_open(filename, 'ab' if append else 'wb') as f:
+            for start in range(0, len(self), block_size):
+                stop = min(start + block_size, len(self))
+                lines = np.empty(4*(stop - start), dtype=object)
+                lines[0::4] = self.info['Fake Header'] if headers is None else headers[start:stop]
+                lines[1::4] = DNA[start:stop]
+                lines[2::4] = '+'
+                lines[3::4] = QC[start:stop]
+                f.write(('\n'.join(lines) + '\n').encode('ascii'))
 
     def construct_read_set(self, dna, QCs):
         s = self.info['Fake Header']+'\n'+dna+'\n+\n'
         return (s+('\n'+s).join(QCs)+'\n').encode('ascii')
 
+    def pack_DNA(self):
+        """DNA column as a PackedDNA (2 bits per base)."""
+        return PackedDNA.from_strings(self['DNA'].values)
+
+    def to_matrix(self):
+        """Copy of reads as a fastqMatrix (compact, vectorized slicing)."""
+        return fastqMatrix.from_fastqDF(self)
+
+def _slice_bounds(slices, lengths):
+    """Per-read (start, length) of Python-style `slices` (iterable of slice objects,
+or a (starts, stops) tuple of arrays) on reads of `lengths`."""
+    if isinstance(slices, slice):
+        starts = np.full(len(lengths), 0 if slices.start is None else slices.start, dtype=np.int64)
+        stops = lengths.copy() if slices.stop is None else np.full(len(lengths), slices.stop, dtype=np.int64)
+    elif isinstance(slices, tuple):
+        starts, stops = (np.asarray(bounds, dtype=np.int64) for bounds in slices)
+    else:
+        slices = list(slices)
+        starts = np.array([0 if s.start is None else s.start for s in slices], dtype=np.int64)
+        stops = np.array([L if s.stop is None else s.stop for s, L in zip(slices, lengths)], dtype=np.int64)
+    starts = np.clip(np.where(starts < 0, starts + lengths, starts), 0, lengths)
+    stops = np.clip(np.where(stops < 0, stops + lengths, stops), 0, lengths)
+    return starts, np.maximum(stops - starts, 0)
+
+class fastqMatrix(object):
+    """Compact, fixed-width store of reads for bulk slicing & filtering.
+
+DNA & QC are (n_reads x max_len) uint8 matrices (zero-padded) & `lengths` holds 
+the length of each read. Mirrors the slicing/filtering API of fastqDF, but every
+operation is a vectorized NumPy gather--strings are only materialized by 
+to_fastqDF() & write().
+"""
+    def __init__(self, DNA, QC, lengths, info, headers=None, index=None):
+        self.DNA = DNA
+        self.QC = QC
+        self.lengths = lengths
+        self.info = info
+        self.headers = headers
+        self.index = np.arange(len(lengths)) if index is None else index
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @staticmethod
+    def _to_matrix(strings):
+        S = np.asarray(strings).astype(np.bytes_)
+        if S.dtype.itemsize == 0 or len(S) == 0:
+            return np.zeros((len(S), 0), dtype=np.uint8)
+        return S.view(np.uint8).reshape((len(S), S.dtype.itemsize))
+
+    @staticmethod
+    def _to_strings(matrix):
+        if matrix.shape[1] == 0:
+            return np.full(len(matrix), '', dtype=object)
+        return np.ascontiguousarray(matrix).view('S{:}'.format(matrix.shape[1])).ravel().astype(str).astype(object)
+
+    @classmethod
+    def from_fastqDF(cls, df):
+        headers = df['header'].values if 'header' in df.columns else None
+        return cls(cls._to_matrix(df['DNA'].values), cls._to_matrix(df['QC'].values), df['DNA'].str.len().values.astype(np.int64), 
+                   df.info.copy(), headers=headers, index=df.index.values)
+
+    @classmethod
+    def from_batch(cls, batch, info):
+        """Builds a fastqMatrix from a FASTQBatch (headers are kept unless info has a 'Fake Header')."""
+        lengths = batch.lengths()
+        n, width = len(lengths), (lengths.max() if len(lengths) else 0)
+        rows = np.repeat(np.arange(n), lengths)
+        cols = np.arange(batch.offsets[-1]) - np.repeat(batch.offsets[:-1], lengths)
+        DNA = np.zeros((n, width), dtype=np.uint8)
+        QC = np.zeros((n, width), dtype=np.uint8)
+        DNA[rows, cols] = batch.DNA
+        QC[rows, cols] = batch.QC
+        headers = None
+        if 'Fake Header' not in info:
+            header_lengths = np.diff(batch.header_offsets)
+            headers = batch.headers.tobytes()
+            headers = np.array([headers[i:i+L].decode('ascii') for i, L in zip(batch.header_offsets[:-1], header_lengths)], dtype=object)
+        return cls(DNA, QC, lengths, info.copy(), headers=headers)
+
+    def to_fastqDF(self):
+        columns = dict(DNA=self._to_strings(self.DNA), QC=self._to_strings(self.QC))
+        if self.headers is not None:
+            columns['header'] = self.headers
+        df = fastqDF(pd.DataFrame(columns, index=self.index, columns=[col for col in fastqDF.essential_columns if col in columns]))
+        df.info = self.info
+        return df
+
+    def write(self, filename, append=False):
+        self.to_fastqDF().write(filename, append=append)
+
+    def select_reads(self, ix):
+        ix = np.asarray(ix)
+        return fastqMatrix(self.DNA[ix], self.QC[ix], self.lengths[ix], self.info, 
+                           headers=None if self.headers is None else self.headers[ix], 
+                           index=self.index[ix])
+
+    def isDegenerate(self):
+        return (self.DNA == ord('N')).any(axis=1)
+
+    def normal_length(self):
+        return int(np.median(self.lengths[:999]))
+
+    def drop_abnormal_lengths(self, length=None):
+        keep = self.lengths == (self.normal_length() if length is None else length)
+        return self.select_reads(keep)
+
+    def expected_errors(self):
+        return batch_expected_errors(self.QC)
+
+    def maxEE_mask(self, maxEE):
+        return self.expected_errors() <= maxEE
+
+    def _gather(self, pieces):
+        """Concatenates the (start, length) `pieces` of every read into new matrices."""
+        lengths = sum(L for start, L in pieces)
+        width = lengths.max() if len(lengths) else 0
+        cols = np.arange(width)
+        src = np.zeros((len(self), width), dtype=np.int64)
+        end = np.zeros(len(self), dtype=np.int64)
+        for start, L in pieces:
+            in_piece = (cols >= end[:, None]) & (cols < (end + L)[:, None])
+            src = np.where(in_piece, start[:, None] - end[:, None] + cols, src)
+            end = end + L
+        valid = cols < lengths[:, None]
+        src = np.minimum(src, max(self.DNA.shape[1] - 1, 0))
+        self.DNA = np.where(valid, np.take_along_axis(self.DNA, src, axis=1), 0).astype(np.uint8)
+        self.QC = np.where(valid, np.take_along_axis(self.QC, src, axis=1), 0).astype(np.uint8)
+        self.lengths = lengths
+        return self
+
+    def co_slice(self, *args, **kargs):
+        Slice = args[0] if args else slice(kargs.get('start'), kargs.get('stop'))
+        return self._gather([_slice_bounds(Slice, self.lengths)])
+
+    def vector_slice(self, slices, second_slice=None):
+        """Slices every read by its own slice (concatenated with `second_slice`, if provided). 
+
+Slices may be iterables of slice objects (as in fastqDF) or, much faster, a 
+(starts, stops) tuple of integer arrays.
+"""
+        pieces = [_slice_bounds(slices, self.lengths)]
+        if second_slice is not None:
+            pieces.append(_slice_bounds(second_slice, self.lengths))
+        return self._gather(pieces)
+
 NW_kwargs = dict(match=2, mismatch=1, gap_open=3, gap_extend=1)
-from striped_smith_waterman import SW
+from striped_smith_waterman import SW, ReferenceSW
+from batch_align import BatchAligner, BandedAligner, pack_reads
+from packed import PackedDNA
 sw = SW(**NW_kwargs)
 
 def cprint(s): print(s.decode('ascii'))
 
-from shared import smart_open
+from shared import smart_open, prefetch, detect_compression, MemorySink, sidecar_paths
+from gzindex import GzipIndex, open_at
+from derep import DerepWriter, is_derep, DEFAULT_MAX_BYTES
+from sketch import SpaceSaving, DEFAULT_CAPACITY
 class IterFASTQ(object): 
     def __iter__(self): return self
     
     def __init__(self, filename): 
         self.filename = filename
-        self.f = smart_open(self.filename)
+        self.f = smart_open(self.filename, background=True)
+
+    def close(self):
+        """Stops reading (& prefetching) the file. Abandoned iterators are closed when collected."""
+        self.f.close()
+
+    def __del__(self):
+        self.close()
 
     def __next__(self):
         header = self.f.readline()
@@ -141,6 +350,300 @@ class IterFASTQ(object):
             raise RuntimeError("Input FASTQ file was not 4x lines long")
         return header, dna, QC
 
+def _gather(buf, starts, lengths):
+    """Concatenates buf[starts[i]:starts[i]+lengths[i]] for every i. Returns (contiguous buffer, offsets)."""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return buf[np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])], offsets
+
+class FASTQBatch(object):
+    """A block of FASTQ records stored column-wise in contiguous uint8 NumPy buffers.
+
+headers : Concatenated header lines (including '@', excluding newlines).
+
+header_offsets : Header i is headers[header_offsets[i]:header_offsets[i+1]].
+
+DNA, QC : Concatenated sequence & Phred-score lines (excluding newlines).
+
+offsets : Read i is DNA[offsets[i]:offsets[i+1]] with scores QC[offsets[i]:offsets[i+1]].
+    These offsets (and DNA) can be passed directly to BatchAligner.align.
+"""
+    def __init__(self, headers, header_offsets, DNA, QC, offsets):
+        self.headers = headers
+        self.header_offsets = header_offsets
+        self.DNA = DNA
+        self.QC = QC
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def expected_errors(self):
+        return batch_expected_errors(self.QC, self.offsets)
+
+    def maxEE_mask(self, maxEE):
+        """Boolean mask of reads with <= `maxEE` expected errors."""
+        return self.expected_errors() <= maxEE
+
+    def read(self, i):
+        """(header, DNA, QC) of read i as bytes (for inspection--not intended for bulk access)."""
+        s = slice(self.offsets[i], self.offsets[i+1])
+        return self.headers[self.header_offsets[i]:self.header_offsets[i+1]].tobytes(), self.DNA[s].tobytes(), self.QC[s].tobytes()
+
+    @classmethod
+    def from_buffer(cls, buf, line_ends):
+        """Parses complete records in `buf` (uint8 array), given the positions of its newlines."""
+        line_starts = np.r_[0, line_ends[:-1] + 1]
+        if (buf[line_starts[0::4]] != ord('@')).any() or (buf[line_starts[2::4]] != ord('+')).any():
+            raise RuntimeError("FASTQ records are malformed (headers must begin with '@' & third lines with '+')")
+        lengths = line_ends - line_starts
+        if (lengths[1::4] != lengths[3::4]).any():
+            raise RuntimeError("Inconsistent lengths in FASTQ File")
+        headers, header_offsets = _gather(buf, line_starts[0::4], lengths[0::4])
+        DNA, offsets = _gather(buf, line_starts[1::4], lengths[1::4])
+        QC, offsets = _gather(buf, line_starts[3::4], lengths[3::4])
+        return cls(headers, header_offsets, DNA, QC, offsets)
+
+class IterFASTQBatches(object):
+    """Iterates over a FASTQ file in FASTQBatches of `batch_size` reads. 
+
+Unlike IterFASTQ, no Python objects are created for individual reads: the file
+is read in blocks of `block_size` bytes & parsed with NumPy.
+"""
+    def __iter__(self): 
+        return self._batches()
+
+    def __init__(self, filename, batch_size=65536, block_size=2**24):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.block_size = block_size
+
+    def _batches(self):
+        buf = b''
+        with smart_open(self.filename, background=True) as f:
+            while True:
+                block = f.read(self.block_size)
+                if not block and buf and not buf.endswith(END):
+                    block = END
+                buf += block
+                arr = np.frombuffer(buf, dtype=np.uint8)
+                line_ends = np.flatnonzero(arr == ord(END))
+                n_lines = 4*self.batch_size if block else len(line_ends) - len(line_ends) % 4
+                start = 0
+                while len(line_ends) - start >= n_lines > 0:
+                    ends = line_ends[start:start + n_lines]
+                    offset = line_ends[start - 1] + 1 if start > 0 else 0
+                    yield FASTQBatch.from_buffer(arr[offset:ends[-1] + 1], ends - offset)
+                    start += n_lines
+                if not block:
+                    if start != len(line_ends):
+                        raise RuntimeError("Input FASTQ file was not 4x lines long")
+                    return
+                buf = buf[line_ends[start - 1] + 1:] if start > 0 else buf
+
+class _FASTQIndexer(object):
+    """Builds a FASTQIndex from the decompressed stream of `filename`, which is
+passed to it (called) in pieces of any size (see FASTQIndex.build & GzipIndex.build)."""
+    def __init__(self, filename, stride=10000, block_size=2**24):
+        self.filename = filename
+        self.stride = stride
+        self.block_size = block_size
+        self.pending = []
+        self.pending_size = 0
+        self.offsets = []
+        self.lines = 0          # Lines terminated so far
+        self.position = 0       # Bytes scanned so far
+        self.line_start = 0     # Start of the current (unterminated) line
+
+    def __call__(self, piece):
+        self.pending.append(piece)
+        self.pending_size += len(piece)
+        if self.pending_size >= self.block_size:
+            self._scan()
+
+    def _scan(self):
+        arr = np.frombuffer(b''.join(self.pending), dtype=np.uint8)
+        self.pending = []
+        self.pending_size = 0
+        position = self.position
+        line_starts = np.r_[self.line_start, np.flatnonzero(arr == ord(END)) + 1 + position]
+        line_numbers = self.lines + np.arange(len(line_starts))
+        in_block = (line_starts >= position) & (line_starts < position + len(arr))
+        headers = in_block & (line_numbers % 4 == 0)
+        if (arr[line_starts[headers] - position] != ord('@')).any():
+            raise RuntimeError("FASTQ file {:} is malformed (a header does not begin with '@').".format(self.filename))
+        if (arr[line_starts[in_block & (line_numbers % 4 == 2)] - position] != ord('+')).any():
+            raise RuntimeError("FASTQ file {:} is malformed (a third line does not begin with '+').".format(self.filename))
+        self.offsets.append(line_starts[headers & (line_numbers % (4*self.stride) == 0)])
+        self.lines += len(line_starts) - 1
+        self.line_start = line_starts[-1]
+        self.position += len(arr)
+
+    def finish(self):
+        if self.pending:
+            self._scan()
+        lines = self.lines + (1 if self.line_start < self.position else 0)     # Final line may lack a newline
+        if lines % 4 != 0:
+            raise RuntimeError("Input FASTQ file was not 4x lines long")
+        offsets = np.concatenate(self.offsets).astype(np.int64) if self.offsets else np.zeros(0, dtype=np.int64)
+        stat = os.stat(str(self.filename))
+        return FASTQIndex(offsets, lines//4, self.position, self.stride, stat.st_size, stat.st_mtime_ns)
+
+class FASTQIndex(object):
+    """Byte offsets (in the decompressed stream) of every `stride`-th record of a 
+FASTQ file, plus its read count. 
+
+Built in one (NumPy-vectorized) pass that also validates the record structure, 
+& saved as a sidecar (<filename>.fqidx, or in a cache directory if the file's 
+directory is not writable; see shared.sidecar_paths) that is re-used while the 
+file is unchanged. gzip files are indexed together with their GzipIndex in one
+decompression pass (load_or_build_gzip). Provides exact, balanced chunking for
+parallel workers (chunks), subsampling of whole blocks of records (subsample), &
+instant read counts.
+"""
+    sidecar_ext = '.fqidx'
+
+    def __init__(self, offsets, reads, length, stride, file_size=-1, mtime=-1):
+        self.offsets = offsets
+        self.reads = int(reads)
+        self.length = int(length)
+        self.stride = int(stride)
+        self.file_size = int(file_size)
+        self.mtime = int(mtime)
+
+    @classmethod
+    def build(cls, filename, stride=10000, block_size=2**24):
+        indexer = _FASTQIndexer(filename, stride, block_size)
+        with smart_open(filename, background=True) as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                indexer(block)
+        return indexer.finish()
+
+    def save(self, sidecar):
+        head = os.path.dirname(sidecar)
+        if head:
+            os.makedirs(head, exist_ok=True)
+        with open(sidecar, 'wb') as f:
+            np.savez(f, offsets=self.offsets, sizes=np.array([self.reads, self.length, self.stride, self.file_size, self.mtime], dtype=np.int64))
+
+    @classmethod
+    def load(cls, sidecar):
+        with np.load(sidecar) as npz:
+            return cls(npz['offsets'], *npz['sizes'])
+
+    @classmethod
+    def load_current(cls, filename, stride=10000):
+        """The sidecar index of `filename`, if one is current (otherwise, None)."""
+        stat = os.stat(str(filename))
+        for sidecar in sidecar_paths(filename, cls.sidecar_ext)[0]:
+            if os.path.isfile(sidecar):
+                index = cls.load(sidecar)
+                if index.file_size == stat.st_size and index.mtime == stat.st_mtime_ns and index.stride == stride:
+                    return index
+        return None
+
+    def save_sidecar(self, filename):
+        """Tries to save the index as the sidecar of `filename` (see shared.sidecar_paths)."""
+        try:
+            self.save(sidecar_paths(filename, self.sidecar_ext)[1])
+        except OSError:
+            pass
+
+    @classmethod
+    def load_or_build(cls, filename, stride=10000):
+        """Loads the sidecar index of `filename`, if it is current, or builds (and tries to save) a new index."""
+        index = cls.load_current(filename, stride=stride)
+        if index is None:
+            index = cls.build(filename, stride=stride)
+            index.save_sidecar(filename)
+        return index
+
+    @classmethod
+    def load_or_build_gzip(cls, filename, stride=10000, span=2**24):
+        """(FASTQIndex, GzipIndex) of a gzip file, loaded from current sidecars or 
+built together in one decompression pass (& saved)."""
+        index = cls.load_current(filename, stride=stride)
+        gzip_index = GzipIndex.load_current(filename)
+        if index is None:
+            indexer = _FASTQIndexer(filename, stride)
+            if gzip_index is None:
+                gzip_index = GzipIndex.build(filename, span=span, consumer=indexer)
+                gzip_index.save_sidecar(filename)
+            else:
+                with open_at(filename, gzip_index.access_point(0)) as f:
+                    for block in iter(lambda: f.read(2**20), b''):
+                        indexer(block)
+            index = indexer.finish()
+            index.save_sidecar(filename)
+        elif gzip_index is None:
+            gzip_index = GzipIndex.build(filename, span=span)
+            gzip_index.save_sidecar(filename)
+        return index, gzip_index
+
+    def block_range(self, i):
+        """(start, stop) byte range of records [i*stride, (i+1)*stride)."""
+        return int(self.offsets[i]), int(self.offsets[i+1]) if i + 1 < len(self.offsets) else self.length
+
+    def chunks(self, n):
+        """Splits the file into <= n (start, stop, reads) byte ranges of nearly-equal read counts (to within `stride`)."""
+        if len(self.offsets) == 0:
+            return [(0, self.length, 0)]
+        blocks = np.unique(np.linspace(0, len(self.offsets), n + 1).round().astype(int))
+        return [(self.block_range(first)[0], self.block_range(last - 1)[1], int(min(last*self.stride, self.reads) - first*self.stride))
+                    for first, last in zip(blocks[:-1], blocks[1:])]
+
+    def subsample(self, filename, n_blocks, seed=None):
+        """Iterates over the reads of `n_blocks` randomly-chosen blocks of `stride` consecutive records."""
+        chosen = np.sort(np.random.RandomState(seed).choice(len(self.offsets), min(n_blocks, len(self.offsets)), replace=False))
+        for i in chosen:
+            start, stop = self.block_range(i)
+            for read in IterFASTQRange(filename, start, stop):
+                yield read
+
+class IterFASTQRange(object):
+    """Iterates over the records of a FASTQ file whose headers begin within bytes 
+[start, stop) of the decompressed file. `start` must be the beginning of a record 
+(see FASTQIndex). gzip files are read from the nearest access point of their 
+GzipIndex (`access_point` or, if omitted, the file's sidecar index).
+"""
+    def __init__(self, filename, start, stop, access_point=None):
+        self.filename = filename
+        self.start = start
+        self.stop = stop
+        self.access_point = access_point
+
+    def __iter__(self): 
+        if self.access_point is None:
+            codec = detect_compression(self.filename)
+            if codec == 'gz':
+                self.access_point = GzipIndex.load_or_build(self.filename).access_point(self.start)
+            elif codec != 'none':
+                raise RuntimeError("{:} files cannot be read from the middle ({:}).".format(codec, self.filename))
+        if self.access_point is None:
+            f = open(str(self.filename), 'rb')
+            f.seek(self.start)
+        else:
+            f = open_at(self.filename, self.access_point, self.start)
+        self.f = prefetch(f)
+        if self.start < self.stop and self.f.peek(1)[:1] != b'@':
+            self.f.close()
+            raise RuntimeError("Byte {:} of {:} is not the beginning of a FASTQ record.".format(self.start, self.filename))
+        return self
+
+    def __next__(self):
+        if self.f.tell() < self.stop:
+            header = self.f.readline()
+            if header:
+                dna = self.f.readline()
+                self.f.readline()
+                QC = self.f.readline()
+                return header, dna, QC
+        self.f.close()
+        raise StopIteration
+
 cdef:
     bytes LINE_3 = b"\n+\n"
     bytes END = b'\n'
@@ -157,9 +660,50 @@ for i, nuc in enumerate(b'ACGTN-'):
     DNA_to_int[nuc] = i
 
 
+default_master_read = ''.join((
+    'GCGCACGTCTGCCGCGCTGTTCTCCTCTTCCTCATCTCCGGGACCCGGA',# forward flank
+    '........',                                         # sgID
+    'AA.....TT.....AA.....',                            # random barcode
+    'ATGCCCAAGAAGAAGAGGAAGGTGTCCAATTTACTGACCGTACACCAAAATTTGCCTGCATTACCGGTCGATGCAACGAGTGATGAGGTTCGCAAGAACCT')) # aft flank
+
+class AlignmentCache(OrderedDict):
+    """Bounded, least-recently-used cache of alignment outcomes, keyed by read sequence.
+
+Amplicon libraries are highly redundant, so MasterRead aligns every distinct 
+(trimmed) sequence once & retrieves the outcome of every duplicate from this 
+cache. Values are [score, N_start, N_stop, begin, method, filled_DNA]. At most 
+`max_size` sequences are retained, which caps memory usage. `hits` & `misses` 
+count the reads whose outcome was (or was not) retrieved from the cache.
+"""
+    def __init__(self, max_size):
+        super(AlignmentCache, self).__init__()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, DNA):
+        entry = self.get(DNA)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.move_to_end(DNA)
+        return entry
+
+    def store(self, DNA, alignment):
+        entry = self[DNA] = alignment[:4] + [0, alignment[5]]     # Future retrievals are 'Cached' (method 0)
+        if len(self) > self.max_size:
+            self.popitem(last=False)
+        return entry
+
 class MasterRead(object):
     possible_outcomes = ['Filtered', 'Unaligned', 'Wrong Barcode Length', 'Residual N', 'Insufficient Flank', 'Clustered']
+    alignment_methods = ['Cached', 'Exact Flanks', 'Full Alignment']
+    metric_names = ['Reads', 'Bytes In', 'Bytes Out', 'Compressed Bytes Out', 'Wall Time (s)', 
+                    'Read Time (s)', 'Align Time (s)', 'Output Time (s)', 'Compress Time (s)',
+                    'Cache Hits', 'Cache Misses']
     MAX_READ_LENGTH = 300
+    ALIGNMENT_BLOCK = 4096      # Reads aligned per BatchAligner call
 
     def __init__(self, master_read, args):
         self.alignment_flank = args.alignment_flank
@@ -192,22 +736,189 @@ class MasterRead(object):
        
         self.barcode_length = stop - start
         
+        # Position of `ref` within pre-sliced reads that match the master read exactly (fast path of _align_block)
+        ref_offset = (stop if self.ClonTracer else start - self.alignment_flank) - self.pre_slice.start
         self.c_ref = self.ref.encode('ascii')
         self.c_train = self.c_ref[:self.training_flank] + self.c_ref[-self.training_flank:]
-        self.max_score = sw.char_score(self.c_ref, self.c_ref)
+        self.aligner = ReferenceSW(self.c_ref, **NW_kwargs)
+        self.engine = args.aligner if hasattr(args, 'aligner') else 'ssw'
+        self.cache_size = args.cache_size if hasattr(args, 'cache_size') else 0
+        self.align_threads = args.align_threads if hasattr(args, 'align_threads') else 1
+        self.sink_kargs = dict(compression=args.compression if hasattr(args, 'compression') else None,
+                               level=args.compression_level if hasattr(args, 'compression_level') else None,
+                               threads=args.compression_threads if hasattr(args, 'compression_threads') else None)
+        self.derep_max_bytes = args.derep_max_mb*2**20 if hasattr(args, 'derep_max_mb') else DEFAULT_MAX_BYTES
+        self.unaligned_sketch_size = args.unaligned_sketch_size if hasattr(args, 'unaligned_sketch_size') else DEFAULT_CAPACITY
+        self.batch_aligner = BatchAligner(self.c_ref, **NW_kwargs)
+        self.banded_aligner = None
+        if self.engine == 'banded':
+            if ref_offset < 0:
+                raise RuntimeError("The banded aligner requires the entire alignment reference within trimmed reads (see --trim).")
+            self.banded_aligner = BandedAligner(self.c_ref, ref_offset=ref_offset, bandwidth=2*self.allowable_deviation, **NW_kwargs)
+        ref_bytes = np.frombuffer(self.c_ref, dtype=np.uint8)
+        self.anchors = np.flatnonzero(ref_bytes != o_N)
+        self.anchor_bases = ref_bytes[self.anchors]
+        self.ref_offset = ref_offset if ref_offset >= 0 and len(self.anchors) > 0 else None
+        N_positions = np.flatnonzero(ref_bytes == o_N)
+        self.exact_alignment = (self.aligner.score(self.c_ref), 
+                                ref_offset + N_positions[0] if len(N_positions) else -1,
+                                ref_offset + N_positions[-1] + 1 if len(N_positions) else -1,
+                                ref_offset)
+        self.max_score = self.aligner.score(self.c_ref)
         
         if self.ClonTracer:
             c_DNA = self.full.encode('ascii')
-            start = sw.ClonTracer_start(c_DNA, self.c_ref)
+            start = self.aligner.barcode_align(c_DNA).query_begin
             self.barcode_length = start
-            self.max_score = sw.char_score(c_DNA, self.c_ref)
+            self.max_score = self.aligner.score(c_DNA)
             
         self.min_align_score = args.min_align_score
         self.min_int_score = int(np.ceil(args.min_align_score*self.max_score))
 
+    def iter_aligned(self, input_fastq_iter, cache=None, metrics=None):
+        """Trims reads (pre_slice) & aligns them to `c_ref` in blocks.
+
+Yields (header, DNA, QC, score, N_start, N_stop, begin, method, filled) for every
+read, where `filled` is DNA with its Ns filled by the alignment (see 
+_align_sequences). Reads that failed the Illumina filter are not aligned & are 
+yielded with a score of -1. `method` indexes `alignment_methods`: the outcome was either retrieved 
+from `cache` (an AlignmentCache), the read matched every non-degenerate base of
+`c_ref` at its expected position (so alignment was skipped), or the read was 
+aligned. 
+
+`metrics` (a dict) accumulates 'Bytes In', 'Read Time (s)' (iterating over 
+input_fastq_iter), 'Align Time (s)' & 'Output Time (s)' (the caller's handling of
+yielded reads), timed per block of reads.
+"""
+        block = []
+        bytes_in = 0
+        read_time = 0.
+        tic = perf_counter()
+        for header, DNA, QC in input_fastq_iter:
+            bytes_in += len(header) + len(DNA) + len(QC) + 2
+            DNA = DNA[self.pre_slice]
+            QC = QC[self.pre_slice]
+            if not QC:
+                raise RuntimeError("Input FASTQ file was not 4x lines long")
+            block.append((header, DNA, QC))
+            if len(block) == self.ALIGNMENT_BLOCK:
+                read_time += perf_counter() - tic
+                yield from self._align_block(block, cache, metrics)
+                block = []
+                tic = perf_counter()
+        read_time += perf_counter() - tic
+        yield from self._align_block(block, cache, metrics)
+        if metrics is not None:
+            metrics['Bytes In'] += bytes_in
+            metrics['Read Time (s)'] += read_time
+
+    def _exact_matches(self, seqs, offsets):
+        """Boolean mask of packed reads that match every non-N base of `c_ref` at `ref_offset`."""
+        exact = np.zeros(len(offsets) - 1, dtype=bool)
+        if self.ref_offset is None:
+            return exact
+        fits = np.diff(offsets) >= self.ref_offset + len(self.c_ref)
+        if fits.any():
+            bases = np.frombuffer(seqs, dtype=np.uint8)[(offsets[:-1][fits] + self.ref_offset)[:, None] + self.anchors]
+            exact[fits] = (bases == self.anchor_bases).all(axis=1)
+        return exact
+
+    def _align_inexact(self, aligner, DNAs, inexact, outputs, filled):
+        """Aligns DNAs[inexact] into `outputs`, & the N-filled reads of those with Ns into `filled`."""
+        seqs, offsets = pack_reads([DNAs[i] for i in inexact])
+        aligned = aligner.align(seqs, offsets, threads=self.align_threads, fill_Ns=True)
+        for output, values in zip(outputs, aligned):
+            output[inexact] = values
+        for k, i in enumerate(inexact):
+            if c_N in DNAs[i]:
+                filled[i] = aligned[4][offsets[k]:offsets[k+1]].tobytes()
+        return aligned[0]
+
+    def _align_sequences(self, DNAs):
+        """Returns [score, N_start, N_stop, begin, method, filled] for every sequence in 
+DNAs, where `filled` is the sequence with its Ns replaced by the bases of `c_ref`
+that they align to. Reads that match `c_ref` exactly (method 1) have no Ns to fill
+(their Ns align to Ns of `c_ref`, or lie outside of it)."""
+        seqs, offsets = pack_reads(DNAs)
+        exact = self._exact_matches(seqs, offsets)
+        outputs = [np.full(len(DNAs), value, dtype=np.int32) for value in self.exact_alignment]
+        filled = list(DNAs)
+        inexact = np.flatnonzero(~exact)
+        if len(inexact) > 0 and self.banded_aligner is not None:
+            scores = self._align_inexact(self.banded_aligner, DNAs, inexact, outputs, filled)
+            inexact = inexact[scores == 0]          # Reads outside of the band are re-aligned by SSW
+        if len(inexact) > 0:
+            self._align_inexact(self.batch_aligner, DNAs, inexact, outputs, filled)
+        methods = np.where(exact, 1, 2)
+        alignments = [list(alignment) + [DNA] for alignment, DNA in zip(zip(*[output.tolist() for output in outputs + [methods]]), filled)]
+        AF = self.alignment_flank
+        for DNA, alignment in zip(DNAs, alignments):
+            score, start, stop = alignment[:3]
+            if start < AF or stop + AF > len(DNA):
+                # Scoring window runs off the read (e.g. truncated flank); score it as-is
+                alignment[0] = self.aligner.score(DNA[start - AF:stop + AF])
+        return alignments
+
+    def _align_block(self, block, cache=None, metrics=None):
+        tic = perf_counter()
+        DNAs = [DNA for header, DNA, QC in block if ILLUMINA_FAILED_FILTER not in header]
+        if cache is None:
+            alignments = self._align_sequences(DNAs)
+        else:
+            entries = OrderedDict()             # Every distinct DNA of the block is looked up once
+            for DNA in DNAs:
+                if DNA in entries:
+                    cache.hits += 1             # Repeated within this block (& retrieved even if since evicted)
+                else:
+                    entries[DNA] = cache.lookup(DNA)
+            missing = [DNA for DNA, entry in entries.items() if entry is None]
+            new = dict(zip(missing, self._align_sequences(missing)))
+            for DNA, alignment in new.items():
+                entries[DNA] = cache.store(DNA, alignment)
+            alignments = []
+            for DNA in DNAs:
+                alignment = new.pop(DNA, None)  # Only the first occurrence of a new DNA was aligned
+                alignments.append(entries[DNA] if alignment is None else alignment)
+        if metrics is not None:
+            metrics['Align Time (s)'] += perf_counter() - tic
+        alignments = iter(alignments)
+        tic = perf_counter()
+        try:
+            for read in block:
+                yield read + (tuple(next(alignments)) if ILLUMINA_FAILED_FILTER not in read[0] else (-1, -1, -1, -1, 0, read[1]))
+        finally:
+            if metrics is not None:
+                metrics['Output Time (s)'] += perf_counter() - tic
+
+    def open_sink(self, filename):
+        """Output file of iter_fastq: *.rds outputs are dereplicated (see tuba_seq/derep.py)."""
+        if is_derep(filename):
+            return DerepWriter(filename, max_bytes=self.derep_max_bytes)
+        return smart_open(filename, 'wb', True, background=True, **self.sink_kargs)
+
     def iter_fastq(self, input_fastq_iter, filenames):
+        """Aligns, filters & trims reads into training, cluster & unaligned output files.
+
+Returns (statistics, scores, bad_barcode_lengths, alignments, metrics, unaligned):
+pd.Series of read outcomes, alignment scores, lengths of bad barcodes, alignment
+methods, & performance metrics (see metric_names), & a SpaceSaving sketch of the 
+most frequent unaligned sequences (see tuba_seq/sketch.py). Metrics are cumulative
+stage times--reading (& decompressing) input, alignment (including N-filling, 
+from the same alignment) & output (classification, writing, & opening & closing
+output files)--each timed directly (together, they account for nearly all of the
+wall time), plus the time that background threads spent compressing output 
+(overlapping with the other stages), reads, bytes, & the hits & misses of the 
+AlignmentCache (one lookup per aligned read, see --cache_size).
+
+Outputs named *.rds receive DADA2 derep objects of their reads instead of FASTQ
+records (see open_sink).
+"""
+        wall_tic = perf_counter()
+        metrics = dict.fromkeys(self.metric_names, 0)
+        cache = AlignmentCache(self.cache_size) if self.cache_size > 0 else None
         scores = pd.Series(np.zeros(self.max_score+1, dtype=int), index=pd.Index(np.linspace(0,1,num=self.max_score+1), name='Score'), name='Occurrences')
         bad_barcode_lengths = pd.Series(np.zeros(self.MAX_READ_LENGTH, dtype=int), index=pd.Index(np.arange(self.MAX_READ_LENGTH), name='Length'), name='Occurrences')
+        unaligned = SpaceSaving(self.unaligned_sketch_size)
         cdef:
             int BL = self.barcode_length
             int TF = self.training_flank
@@ -219,31 +930,30 @@ class MasterRead(object):
             int Residual_N = 0
             int Insufficient_Flank = 0
             int Clustered = 0
+            long [:] method_counts = np.zeros(len(self.alignment_methods), dtype=int)
             long [:] score_view = scores.values
             long [:] bc_length_view = bad_barcode_lengths.values
             int qc_i
             int unaligned_counter = 0
 
-        with smart_open(filenames[0], 'wb', makedirs=True) as training_file, smart_open(filenames[1], 'wb', makedirs=True) as cluster_file, smart_open(filenames[2], 'wb', makedirs=True) as unaligned_file:
-            for header, DNA, QC in input_fastq_iter: 
-                DNA = DNA[self.pre_slice]
-                QC = QC[self.pre_slice]
-                if not QC:
-                    raise RuntimeError("Input FASTQ file was not 4x lines long")
-                if ILLUMINA_FAILED_FILTER in header:
+        tic = perf_counter()
+        with self.open_sink(filenames[0]) as training_file, self.open_sink(filenames[1]) as cluster_file, self.open_sink(filenames[2]) as unaligned_file:
+            sinks = [training_file, cluster_file, unaligned_file]
+            metrics['Output Time (s)'] += perf_counter() - tic
+            for header, DNA, QC, score, start, stop, begin, method, filled in self.iter_aligned(input_fastq_iter, cache, metrics): 
+                if score < 0:
                     Filtered += 1
                     continue
-                start, stop = sw.find_N_start_stop(DNA, self.c_ref)
-                DNA_scoring = DNA[start - self.alignment_flank:stop + self.alignment_flank]
-                score = sw.char_score(DNA_scoring, self.c_ref)
+                method_counts[method] += 1
                 score_view[score] += 1
                 if score < self.min_int_score:
                     unaligned_counter += 1
                     unaligned_file.write(DNA+END)
+                    unaligned.add(DNA)
                     continue
                 
                 if self.ClonTracer:
-                    start = sw.ClonTracer_start(DNA, self.c_ref)
+                    start = begin
                     if start != self.barcode_length or c_N in DNA:
                         bc_length_view[start] += 1
                         continue
@@ -263,9 +973,7 @@ class MasterRead(object):
                     assert len(tQC) == len(training_DNA), '{:} {:} {:} {:}'.format(len(tQC), len(training_DNA), tQC, training_DNA)
                     training_file.write(header+training_DNA+LINE_3+tQC+END)
         
-                if c_N in DNA:
-                    DNA = sw.fill_Ns(DNA, self.c_ref)
-                cluster_DNA = DNA[start - CF:start+BL+CF]
+                cluster_DNA = filled[start - CF:start+BL+CF]
                 if c_N in cluster_DNA:
                     Residual_N += 1
                     continue
@@ -275,9 +983,19 @@ class MasterRead(object):
                     Clustered += 1
                     cQC = QC[start-CF:start+BL+CF]
                     cluster_file.write(header+cluster_DNA+LINE_3+cQC+END)
+            tic = perf_counter()
+        metrics['Output Time (s)'] += perf_counter() - tic      # Closing (flushing) output files
         statistics = pd.Series([Filtered,   scores.iloc[:self.min_int_score].sum(),   bad_barcode_lengths.sum(),   Residual_N,   Insufficient_Flank,   Clustered], 
                             index=pd.Index(self.possible_outcomes))
-        return statistics, scores, bad_barcode_lengths
+        alignments = pd.Series(np.asarray(method_counts), index=pd.Index(self.alignment_methods), name='Alignments')
+        metrics.update({'Reads':statistics.sum(), 
+                        'Bytes Out':sum(sink.bytes_in for sink in sinks),
+                        'Compressed Bytes Out':sum(len(f.getvalue()) if isinstance(f, MemorySink) else os.path.getsize(f) for f in filenames),
+                        'Wall Time (s)':perf_counter() - wall_tic,
+                        'Compress Time (s)':sum(sink.busy for sink in sinks)})
+        if cache is not None:
+            metrics.update({'Cache Hits':cache.hits, 'Cache Misses':cache.misses})
+        return statistics, scores, bad_barcode_lengths, alignments, pd.Series(metrics, index=self.metric_names, name='Metrics'), unaligned
 
 import regex as re
 class Mismatcher(object):
@@ -347,3 +1065,32 @@ def _expected_errors(QC):
         errors += QC_map[q_score]
     return errors
 
+
+def batch_expected_errors(QC, offsets=None):
+    """Expected errors of many reads at once (vectorized alternative to _expected_errors).
+
+Parameters:
+-----------
+QC : uint8 array of Phred-score characters, either concatenated (with `offsets`, 
+    e.g. FASTQBatch.QC) or an (n_reads x max_len) matrix padded with zeros.
+
+offsets : Scores of read i are QC[offsets[i]:offsets[i+1]] (omit for matrices).
+
+Returns: float64 array of expected errors per read.
+"""
+    QC = np.asarray(QC, dtype=np.uint8)
+    valid = (QC >= 33) & (QC <= 75)
+    if offsets is None:
+        valid |= QC == 0
+    if not valid.all():
+        q_score = int(QC[~valid].flat[0])
+        raise ValueError("Q score must be between 33 and 75. It was {:} (i.e. {:})".format(q_score, chr(q_score)))
+    errors = np.asarray(QC_map)[QC]
+    if offsets is None:
+        return errors.sum(axis=1)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    EEs = np.zeros(len(offsets) - 1)
+    nonempty = offsets[1:] > offsets[:-1]
+    if nonempty.any():      # Segments of reduceat end at the next start, so empty reads are skipped (& stay 0)
+        EEs[nonempty] = np.add.reduceat(errors[:offsets[-1]], offsets[:-1][nonempty])
+    return EEs
@@ -0,0 +1,303 @@
+"""Random access into gzip-compressed files, for parallel processing of FASTQs.
+
+A GzipIndex records access points--compressed & uncompressed offsets from which
+decompression can resume--so that workers can begin reading mid-file:
+
+1) BGZF files are indexed by walking their block headers, without decompressing
+    anything (every block is an independent gzip member).
+
+2) Other gzip files are indexed once, zran-style: the file is inflated and an
+    access point (with the preceding 32 kB window) is recorded at a byte-aligned
+    deflate-block boundary (or new gzip member) every `span` uncompressed bytes.
+
+Indices are saved as sidecars (<filename>.gzidx, or in a cache directory if the
+file's directory is not writable; see shared.sidecar_paths) & re-used while the
+file is unchanged. Building an index can also hand the decompressed stream to a
+`consumer` (e.g. a FASTQ record indexer), so both are built in one pass. 
+
+open_at(filename, point, offset) returns a buffered, read-only file object that
+decompresses from an access point.
+"""
+import io, os, zlib, struct
+import numpy as np
+from libc.string cimport memset
+from shared import sidecar_paths
+
+cdef extern from "zlib.h" nogil:
+    ctypedef struct z_stream:
+        unsigned char *next_in
+        unsigned int avail_in
+        unsigned char *next_out
+        unsigned int avail_out
+        int data_type
+    int Z_OK, Z_STREAM_END, Z_BLOCK, Z_NEED_DICT, Z_DATA_ERROR, Z_MEM_ERROR
+    int inflateInit2(z_stream *strm, int windowBits)
+    int inflate(z_stream *strm, int flush)
+    int inflateReset(z_stream *strm)
+    int inflateEnd(z_stream *strm)
+
+cdef enum:
+    WINSIZE = 32768
+CHUNK = 2**18
+sidecar_ext = '.gzidx'
+
+def is_bgzf(filename):
+    with open(filename, 'rb') as f:
+        header = f.read(16)
+    return len(header) == 16 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+def _bgzf_points(filename):
+    """Access points at the start of every BGZF block (reads only block headers & sizes)."""
+    compressed = []
+    uncompressed = []
+    position = 0
+    total = 0
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        while position < file_size:
+            f.seek(position)
+            header = f.read(18)
+            if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+                raise RuntimeError("{:} is not a BGZF file (malformed block at byte {:}).".format(filename, position))
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            f.seek(position + block_size - 4)
+            block_length = struct.unpack('<I', f.read(4))[0]
+            if block_length > 0:
+                compressed.append(position)
+                uncompressed.append(total)
+            position += block_size
+            total += block_length
+    if not compressed:
+        compressed, uncompressed = [0], [0]
+    n = len(compressed)
+    return (np.array(compressed, dtype=np.int64), np.array(uncompressed, dtype=np.int64), np.ones(n, dtype=bool),
+            np.zeros(0, dtype=np.uint8), np.zeros(n + 1, dtype=np.int64), total)
+
+def _inflate_points(filename, long span, consumer=None):
+    """Access points every `span` bytes, found by inflating the entire file once 
+(every piece of decompressed output is passed to `consumer`, if provided)."""
+    cdef:
+        z_stream strm
+        int ret = Z_OK
+        long totin = 0
+        long totout = 0
+        long last = 0
+        int left
+        unsigned int before
+        unsigned char window[WINSIZE]
+        bytes chunk
+    compressed = [0]
+    uncompressed = [0]
+    member_start = [True]
+    windows = [b'']
+    memset(&strm, 0, sizeof(strm))
+    if inflateInit2(&strm, 47) != Z_OK:
+        raise MemoryError("Could not initialize zlib")
+    strm.avail_out = 0
+    try:
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK)
+                if not chunk:
+                    if ret != Z_STREAM_END:
+                        raise RuntimeError("{:} is a truncated gzip file.".format(filename))
+                    break
+                strm.next_in = <unsigned char *>chunk
+                strm.avail_in = len(chunk)
+                while strm.avail_in:
+                    if ret == Z_STREAM_END:     # Another gzip member follows
+                        inflateReset(&strm)
+                        if totout - last > span:
+                            compressed.append(totin)
+                            uncompressed.append(totout)
+                            member_start.append(True)
+                            windows.append(b'')
+                            last = totout
+                    if strm.avail_out == 0:
+                        strm.avail_out = WINSIZE
+                        strm.next_out = window
+                    before = strm.avail_out
+                    totin += strm.avail_in
+                    totout += strm.avail_out
+                    ret = inflate(&strm, Z_BLOCK)
+                    totin -= strm.avail_in
+                    totout -= strm.avail_out
+                    if ret == Z_NEED_DICT or ret == Z_DATA_ERROR or ret == Z_MEM_ERROR:
+                        raise RuntimeError("{:} is not a valid gzip file (zlib error {:} at byte {:}).".format(filename, ret, totin))
+                    if consumer is not None and before > strm.avail_out:
+                        consumer((<char *>window)[WINSIZE-before:WINSIZE-strm.avail_out])
+                    # End of a deflate block (not the last) that ends on a byte boundary
+                    if (ret != Z_STREAM_END and strm.data_type & 128 and not strm.data_type & 64 and
+                            strm.data_type & 7 == 0 and totout - last > span):
+                        left = strm.avail_out
+                        if totout >= WINSIZE:
+                            windows.append((<char *>window)[WINSIZE-left:WINSIZE] + (<char *>window)[:WINSIZE-left])
+                        else:
+                            windows.append((<char *>window)[:totout])
+                        compressed.append(totin)
+                        uncompressed.append(totout)
+                        member_start.append(False)
+                        last = totout
+    finally:
+        inflateEnd(&strm)
+    window_offsets = np.zeros(len(windows) + 1, dtype=np.int64)
+    np.cumsum([len(w) for w in windows], out=window_offsets[1:])
+    return (np.array(compressed, dtype=np.int64), np.array(uncompressed, dtype=np.int64), np.array(member_start, dtype=bool),
+            np.frombuffer(b''.join(windows), dtype=np.uint8), window_offsets, totout)
+
+class GzipIndex(object):
+    """Access points of a gzip file (see module docstring).
+
+Parameters:
+-----------
+compressed, uncompressed : Offsets of each access point in the compressed file &
+    decompressed stream.
+
+member_start : Whether each access point begins a gzip member (otherwise, it
+    begins a raw deflate block that needs its window).
+
+windows, window_offsets : Concatenated windows (preceding 32 kB of output) of
+    every access point; window i is windows[window_offsets[i]:window_offsets[i+1]].
+
+uncompressed_size : Length of the decompressed stream.
+"""
+    def __init__(self, compressed, uncompressed, member_start, windows, window_offsets, uncompressed_size, file_size=-1, mtime=-1):
+        self.compressed = compressed
+        self.uncompressed = uncompressed
+        self.member_start = member_start
+        self.windows = windows
+        self.window_offsets = window_offsets
+        self.uncompressed_size = int(uncompressed_size)
+        self.file_size = int(file_size)
+        self.mtime = int(mtime)
+
+    def __len__(self):
+        return len(self.compressed)
+
+    @classmethod
+    def build(cls, filename, span=2**24, consumer=None):
+        """Indexes `filename`, passing its decompressed stream to `consumer` (if provided)."""
+        filename = str(filename)
+        stat = os.stat(filename)
+        if is_bgzf(filename):
+            points = _bgzf_points(filename)
+            if consumer is not None:        # BGZF blocks are indexed without inflating, so the stream is read separately
+                with open_at(filename, (0, 0, True, b'')) as f:
+                    for block in iter(lambda: f.read(CHUNK), b''):
+                        consumer(block)
+        else:
+            points = _inflate_points(filename, span, consumer)
+        return cls(*points, file_size=stat.st_size, mtime=stat.st_mtime_ns)
+
+    def save(self, sidecar):
+        head = os.path.dirname(sidecar)
+        if head:
+            os.makedirs(head, exist_ok=True)
+        with open(sidecar, 'wb') as f:
+            np.savez_compressed(f, compressed=self.compressed, uncompressed=self.uncompressed, member_start=self.member_start,
+                windows=self.windows, window_offsets=self.window_offsets,
+                sizes=np.array([self.uncompressed_size, self.file_size, self.mtime], dtype=np.int64))
+
+    def is_current(self, filename):
+        stat = os.stat(str(filename))
+        return self.file_size == stat.st_size and self.mtime == stat.st_mtime_ns
+
+    @classmethod
+    def load(cls, sidecar):
+        with np.load(sidecar) as npz:
+            uncompressed_size, file_size, mtime = npz['sizes']
+            return cls(npz['compressed'], npz['uncompressed'], npz['member_start'], npz['windows'], npz['window_offsets'],
+                       uncompressed_size, file_size, mtime)
+
+    @classmethod
+    def load_current(cls, filename):
+        """The sidecar index of `filename`, if one is current (otherwise, None)."""
+        candidates, destination = sidecar_paths(filename, sidecar_ext)
+        for sidecar in candidates:
+            if os.path.isfile(sidecar):
+                index = cls.load(sidecar)
+                if index.is_current(filename):
+                    return index
+        return None
+
+    def save_sidecar(self, filename):
+        """Tries to save the index as the sidecar of `filename` (see shared.sidecar_paths)."""
+        try:
+            self.save(sidecar_paths(filename, sidecar_ext)[1])
+        except OSError:
+            pass
+
+    @classmethod
+    def load_or_build(cls, filename, span=2**24):
+        """Loads the sidecar index of `filename`, if it is current, or builds (and tries to save) a new index."""
+        index = cls.load_current(filename)
+        if index is None:
+            index = cls.build(filename, span=span)
+            index.save_sidecar(filename)
+        return index
+
+    def access_point(self, offset):
+        """(compressed, uncompressed, member_start, window) of the last access point at/before uncompressed `offset`."""
+        i = max(np.searchsorted(self.uncompressed, offset, side='right') - 1, 0)
+        window = self.windows[self.window_offsets[i]:self.window_offsets[i+1]].tobytes()
+        return int(self.compressed[i]), int(self.uncompressed[i]), bool(self.member_start[i]), window
+
+class _InflateReader(io.RawIOBase):
+    """Raw stream of the decompressed bytes of a gzip file, beginning at an access point."""
+    def __init__(self, filename, point):
+        compressed, self.position, member_start, window = point
+        self.f = open(filename, 'rb')
+        self.f.seek(compressed)
+        self.raw_deflate = not member_start
+        self.d = zlib.decompressobj(-15, zdict=window) if self.raw_deflate else zlib.decompressobj(31)
+        self.skip = 0
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, b):
+        while not len(self.pending):
+            data = b''
+            if self.d.eof:
+                data = self.d.unused_data
+                if self.raw_deflate:        # Skip the gzip trailer (CRC32 & ISIZE) of the member
+                    self.skip = 8
+                    self.raw_deflate = False
+                self.d = zlib.decompressobj(31)
+            if not data:
+                data = self.f.read(CHUNK)
+                if not data:
+                    return 0
+            if self.skip:
+                skipped = min(self.skip, len(data))
+                self.skip -= skipped
+                data = data[skipped:]
+            if data:
+                self.pending = memoryview(self.d.decompress(data))
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        self.position += n
+        return n
+
+    def close(self):
+        self.f.close()
+        super(_InflateReader, self).close()
+
+def open_at(filename, point, offset=None):
+    """Buffered, read-only file object of the decompressed contents of `filename`,
+starting at access `point` (from GzipIndex.access_point) or, if provided, at the
+uncompressed `offset` after the point."""
+    f = io.BufferedReader(_InflateReader(str(filename), point), buffer_size=CHUNK)
+    if offset is not None:
+        remaining = offset - point[1]
+        while remaining > 0:
+            skipped = len(f.read(min(remaining, CHUNK)))
+            if skipped == 0:
+                break
+            remaining -= skipped
+    return f
@@ -0,0 +1,166 @@
+"""Checkpoints of preprocessing runs, so that interrupted runs can resume.
+
+A RunManifest is a JSON file with an entry for every input FASTQ: its size,
+mtime, content hash, the run's parameters, its output files, the record ranges
+(work units) it was split into, the sizes of the output files after every unit
+whose outputs have been written, & the stats (e.g. outcome & score histograms,
+& the merged sketch of unaligned sequences) summed over these units. Stats are
+stored beside the manifest (in `filename`.stats/, one file per input), so that
+each save encodes only the stats of inputs whose units finished since the last
+save, rather than the sketches of every input. Outputs are
+written in unit order, so a rerun truncates the outputs to the end of the last
+completed unit, processes only the remaining units, & resumes from the summed 
+stats. Inputs whose recorded outputs were not entirely flushed (so that the 
+summed stats cover units that must be redone) are processed from scratch.
+
+Entries of inputs that changed (size, mtime, or hash), or were processed with
+different parameters, are stale & processed from scratch. The manifest is
+replaced atomically (write, then rename) as units finish.
+"""
+import os, json, hashlib
+from time import time
+import pandas as pd
+from tuba_seq.sketch import SpaceSaving
+
+def content_hash(filename, sample=2**20):
+    """BLAKE2 hash of the size, first & last `sample` bytes of a file (a fast check that it is unchanged)."""
+    size = os.path.getsize(filename)
+    h = hashlib.blake2b(str(size).encode('ascii'), digest_size=16)
+    with open(filename, 'rb') as f:
+        h.update(f.read(sample))
+        f.seek(max(size - sample, 0))
+        h.update(f.read(sample))
+    return h.hexdigest()
+
+def _encode(output):
+    """JSON-able form of a func output: a pandas Series, SpaceSaving sketch, number, or tuple of these."""
+    if isinstance(output, tuple):
+        return {'tuple':[_encode(item) for item in output]}
+    if isinstance(output, SpaceSaving):
+        return {'sketch':output.to_dict()}
+    if isinstance(output, pd.Series):
+        return {'name':output.name, 'index_name':output.index.name, 'index':output.index.tolist(), 'values':output.values.tolist()}
+    return {'value':output.item() if hasattr(output, 'item') else output}
+
+def _decode(encoded):
+    if 'tuple' in encoded:
+        return tuple(_decode(item) for item in encoded['tuple'])
+    if 'sketch' in encoded:
+        return SpaceSaving.from_dict(encoded['sketch'])
+    if 'values' in encoded:
+        return pd.Series(encoded['values'], index=pd.Index(encoded['index'], name=encoded['index_name']), name=encoded['name'])
+    return encoded['value']
+
+class RunManifest(object):
+    """Checkpoints of a run (see module docstring).
+
+Parameters:
+-----------
+filename : JSON file of the manifest (loaded, if it exists).
+
+parameters : Dict of the run's (JSON-able) parameters that affect its outputs.
+
+save_interval : Minimum seconds between saves as units finish (the outputs of
+    units finished after the last save are simply redone).
+"""
+    def __init__(self, filename, parameters, save_interval=10):
+        self.filename = filename
+        self.parameters = parameters
+        self.save_interval = save_interval
+        self.last_save = 0
+        self.entries = {}
+        self.totals = {}        # Summed stats of entries, encoded when saved
+        self.stats_dir = filename + '.stats'
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                self.entries = json.load(f)
+
+    def save(self, force=True):
+        if force or time() - self.last_save >= self.save_interval:
+            for in_fastq, total in self.totals.items():
+                self.entries[in_fastq]['stats'] = self._save_stats(in_fastq, total)
+            self.totals = {}
+            temp = self.filename + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(temp, self.filename)
+            self.last_save = time()
+
+    def _save_stats(self, in_fastq, total):
+        """Writes the encoded `total` of `in_fastq` beside the manifest & returns its filename."""
+        name = hashlib.blake2b(in_fastq.encode(), digest_size=8).hexdigest() + '.json'
+        os.makedirs(self.stats_dir, exist_ok=True)
+        path = os.path.join(self.stats_dir, name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(_encode(total), f)
+        os.replace(path + '.tmp', path)
+        return name
+
+    def _load_stats(self, entry):
+        with open(os.path.join(self.stats_dir, entry['stats'])) as f:
+            return _decode(json.load(f))
+
+    def _fingerprint(self, in_fastq):
+        stat = os.stat(in_fastq)
+        return dict(size=stat.st_size, mtime=stat.st_mtime_ns, hash=content_hash(in_fastq), parameters=self.parameters)
+
+    def resume(self, in_fastq, out_filenames):
+        """(units, number of completed units, summed outputs of the completed units or
+None) of a current entry of `in_fastq`, after truncating its outputs to the end 
+of the last completed unit; or None, if there is no current entry."""
+        entry = self.entries.get(in_fastq)
+        if entry is None or entry['outputs'] != list(out_filenames):
+            return None
+        if any(entry[key] != value for key, value in self._fingerprint(in_fastq).items()):
+            return None
+        sizes = [os.path.getsize(f) if os.path.isfile(f) else 0 for f in out_filenames]
+        flushed = lambda chunk: all(recorded <= size for recorded, size in zip(chunk['output_sizes'], sizes))
+        if len(entry['chunks']) == len(entry['units']) and flushed(entry['chunks'][-1]):
+            chunks = entry['chunks']        # Complete (outputs may shrink as they are finalized, e.g. merged derep objects)
+        else:
+            chunks = []
+            for chunk in entry['chunks']:   # Units whose outputs were (entirely) flushed
+                if not flushed(chunk):
+                    break
+                chunks.append(chunk)
+        if len(chunks) < len(entry['chunks']) or (chunks and (entry.get('stats') is None or not os.path.isfile(os.path.join(self.stats_dir, entry['stats'])))):
+            return None     # The summed stats include units that must be redone (or are missing)
+        if len(chunks) < len(entry['units']) and any(stop is None for start, stop, reads in entry['units']):
+            return None     # A whole-file unit (of a serial run) cannot be resumed part-way
+        entry['status'] = 'complete' if len(chunks) == len(entry['units']) else 'running'
+        final_sizes = chunks[-1]['output_sizes'] if chunks else [0]*len(out_filenames)
+        for f, size in zip(out_filenames, final_sizes):
+            with open(f, 'ab') as out_file:
+                out_file.truncate(size)
+        return [tuple(unit) for unit in entry['units']], len(chunks), self._load_stats(entry) if chunks else None
+
+    def start(self, in_fastq, out_filenames, units):
+        """Begins a new entry of `in_fastq`, split into `units` ((start, stop, reads) 
+record ranges, or [(0, None, None)] for the whole file), & truncates its outputs."""
+        entry = self._fingerprint(in_fastq)
+        entry.update(outputs=list(out_filenames), units=[list(unit) for unit in units], chunks=[], stats=None, status='running')
+        self.entries[in_fastq] = entry
+        self.totals.pop(in_fastq, None)
+        for f in out_filenames:
+            head = os.path.dirname(f)
+            if head:
+                os.makedirs(head, exist_ok=True)
+            open(f, 'wb').close()
+        self.save()
+
+    def forget(self, in_fastq):
+        """Discards the entry of `in_fastq` (so that it is processed from scratch)."""
+        self.entries.pop(in_fastq, None)
+        self.totals.pop(in_fastq, None)
+
+    def chunk_done(self, in_fastq, total, output_sizes):
+        """Records the next unit of `in_fastq`, after its outputs were flushed to files 
+of `output_sizes` bytes; `total` is the summed output of all completed units 
+(only the latest total is kept, & encoded when the manifest is saved)."""
+        entry = self.entries[in_fastq]
+        entry['chunks'].append({'output_sizes':list(output_sizes)})
+        self.totals[in_fastq] = total
+        complete = len(entry['chunks']) == len(entry['units'])
+        if complete:
+            entry['status'] = 'complete'
+        self.save(force=complete)
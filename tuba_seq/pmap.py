@@ -9,11 +9,11 @@ functions:
     intended for function calls that are individually long & memory-intensive.
 
 """
-import os
+import os, shutil
 from warnings import warn
 from pickle import PicklingError
 from progressbar import ProgressBar, Bar, Percentage
-from time import sleep 
+from time import sleep, time
 import numpy as np
 try:
     import multiprocessing
@@ -53,97 +53,219 @@ finally:
             warn("Lambda functions cannot be Pickled for Parallelization. Using single Process.", RuntimeWarning)
             return list(map(func, Iter))
 
-class _mid_fastq_iter(object):
-    def __init__(self, filename, seq_id, start, stop):
-        self.filename = filename
-        self.seq_id = seq_id
-        self.start = start
-        self.stop = stop
-
-    def __iter__(self): 
-        self.f = self.filename.open('rb')
-        self.f.seek(self.start)
-        # Find the beginning of the next FASTQ header
-        lines = []
-        for i, line in zip(range(5), self.f):
-            lines.append(line)
-            if line.startswith(self.seq_id):
-                break
-        else:
-            raise RuntimeError("Took more than 4 lines to find header in middle of FASTQ file (start pos: {:}, stop pos: {:}, file length: {:}):\n".format(
-                                    self.start, self.stop, self.filename.stat().st_size)+'\n'.join(lines))
-        self.f.seek(self.f.tell() - len(line))
-        return self
-        
-    def __next__(self):
-        if self.f.tell() < self.stop:
-            header = self.f.readline()
-            dna = self.f.readline()
-            self.f.readline()
-            qc = self.f.readline()
-            return header, dna, qc
-        else:
-            self.f.close()
-            raise StopIteration
-        
-    def __exit__(self):
-        self.f.close()
-
-compressions = dict(gzip='gunzip',gz='gunzip', bz2='bunzip2', lzma='unxz', xz='unxz') 
+gzip_suffixes = {'.gz', '.gzip', '.bgz'}
+compressions = {'.bz2', '.lzma', '.xz'}
 
 from pathlib import Path
-def fastq_map_sum(in_fastq, out_filenames, func, CPUs=CPUs-1, temp_dir_prefix='tmp', uncompress_input=True):
-    """Asynchronously processes an input fastq file.
+from tuba_seq.shared import smart_open, MemorySink
+from tuba_seq.gzindex import GzipIndex
+from tuba_seq.fastq import FASTQIndex, IterFASTQRange
+from tuba_seq.derep import is_derep, merge_partials
+def _map_chunk(args):
+    """Runs func on a chunk of reads, writing its outputs in memory; returns (job, 
+chunk, func output, compressed output bytes, start time, stop time)."""
+    job, chunk, func, reads, out_filenames = args
+    start = time()
+    sinks = [MemorySink(f) for f in out_filenames]
+    output = func(reads, sinks)
+    return job, chunk, output, [sink.getvalue() for sink in sinks], start, time()
+
+def _add(total, output):
+    """Folds the func output of a unit into the running total (None) of its job."""
+    if total is None:
+        return output
+    return tuple(a + b for a, b in zip(total, output)) if type(output) == tuple else total + output
 
-Processes reads from a single FASTQ file by distributing the analysis work *and*
-I/O. A thread is devoted to reading the input FASTQ, threads are devoted to 
-writing to every output file, and a number of worker threads communicate with 
-these I/O threads to process the reads. Job queues mediate thread interactions.
+def _schedule(job_units, done):
+    """(reads, job, chunk, start, stop) of every unprocessed unit, in processing order. 
+Jobs are ordered largest-unit-first, but each job's units are kept in chunk order,
+so that finished units rarely wait in the parent for a late predecessor."""
+    units = [(reads, job, chunk, unit_start, unit_stop) for job in range(len(job_units)) 
+                for chunk, (unit_start, unit_stop, reads) in enumerate(job_units[job]) if chunk >= done[job]]
+    largest = [0]*len(job_units)
+    for reads, job, chunk, unit_start, unit_stop in units:
+        largest[job] = max(largest[job], reads)
+    units.sort(key=lambda unit: (-largest[unit[1]], unit[1], unit[2]))
+    return units
+
+def _index_input(in_fastq, temp_dir_prefix, uncompress_input):
+    """(file to read, FASTQIndex, GzipIndex or None, temporary file or None) of an input FASTQ."""
+    in_file = Path(in_fastq)
+    if in_file.suffix in gzip_suffixes:
+        return (in_file,) + FASTQIndex.load_or_build_gzip(in_file) + (None,)
+    if in_file.suffix in compressions:
+        if not uncompress_input:
+            raise RuntimeError("{:} cannot be parallel-processed without decompression (only gzip files can be indexed).".format(in_fastq))
+        print("Uncompressing", in_fastq, "(Cannot parallel-process a bz2/lzma file)...")
+        Dir = Path(temp_dir_prefix+in_file.name.partition('.fastq')[0])
+        Dir.mkdir(parents=True, exist_ok=True)
+        temp_input = Dir / in_file.stem
+        with smart_open(in_file) as source, temp_input.open('wb') as destination:
+            shutil.copyfileobj(source, destination, 2**24)
+        return temp_input, FASTQIndex.build(temp_input), None, temp_input
+    return in_file, FASTQIndex.load_or_build(in_file), None, None
+
+def fastq_map_sums(jobs, func, CPUs=CPUs-1, temp_dir_prefix='tmp', uncompress_input=True, chunks=CHUNKS, manifest=None):
+    """Processes many FASTQ files on one shared process pool.
+
+Every input is split into work units--ranges of records (see fastq_map_sum)--
+in proportion to its (decompressed) size, such that all inputs together yield
+~`chunks` units. Inputs are processed largest-first, each in chunk order, on one 
+pool, so huge & tiny samples are processed concurrently & no process idles 
+while others finish a huge sample. Outputs of every input are written in input 
+order; units that finish before their predecessors are held in memory until 
+then, which chunk order keeps to ~CPUs units.
 
 Inputs:
 -------
-in_fastq : Input FASTQ filename. Must be uncompressed. 
+jobs : List of (in_fastq, out_filenames) pairs (see fastq_map_sum).
+
+func : See fastq_map_sum.
+
+chunks : Approximate total number of work units.
+
+manifest : RunManifest (see tuba_seq/manifest.py) that checkpoints every unit as 
+    its outputs are written. Jobs with a current entry resume from their last 
+    written unit (re-using the summed func outputs of previous units); other 
+    jobs are processed from scratch, truncating their outputs (default: None).
 
-out_files : List of output filenames. Compression must be smart_open compliant.
+Outputs:
+--------
+sums : List of the summed func outputs of every job (outputs are folded into 
+    these sums as their units are written, so only the sums are kept).
 
-func : func(fastq_read_iter, out_filenames) -> tuple of sum-able objects. 
+timings : pd.DataFrame of the work units & reads processed, wall time (first unit
+    started to last unit finished), busy time (summed over units), & the time 
+    that the parent spent writing (merging) the bytes of the outputs of every 
+    input.
 
+utilization : Fraction of the pool's process-time spent processing units.
 """
-    in_file = Path(in_fastq)
+    import pandas as pd
+    start = time()
+    job_units = [None]*len(jobs)    # (start, stop, reads) record ranges of every job
+    done = [0]*len(jobs)            # Units written of every job
+    totals = [None]*len(jobs)       # Summed func outputs of the written units of every job
+    if manifest is not None:
+        for job, (in_fastq, out_filenames) in enumerate(jobs):
+            resumed = manifest.resume(in_fastq, out_filenames)
+            if resumed is not None:
+                job_units[job], done[job], totals[job] = resumed
+    P = multiprocessing.Pool(processes=CPUs)
+    inputs = [None]*len(jobs)
+    out_files = [None]*len(jobs)
+    try:
+        # Inputs are indexed (gzip files in one decompression pass) on the pool, concurrently
+        to_index = [job for job in range(len(jobs)) if job_units[job] is None or done[job] < len(job_units[job])]
+        for job, Input in zip(to_index, P.starmap(_index_input, [(jobs[job][0], temp_dir_prefix, uncompress_input) for job in to_index], chunksize=1)):
+            inputs[job] = Input
+        total_length = max(sum(Input[1].length for Input in inputs if Input is not None), 1)
+        for job, (in_fastq, out_filenames) in enumerate(jobs):
+            if job_units[job] is None:
+                fastq_index = inputs[job][1]
+                job_units[job] = fastq_index.chunks(max(1, int(round(chunks*fastq_index.length/total_length))))
+                if manifest is not None:
+                    manifest.start(in_fastq, out_filenames, job_units[job])
     
-    if in_file.suffix in compressions and uncompress_input:
-        algorithm = compressions[in_ext]
-        print("Uncompressing", in_fastq, 'with', algorithm, "(Cannot parallel-process a compressed file)...")
-        os.system([algorithm, in_fastq])
-        in_file = Path(in_file.stem)
-
-    file_length = in_file.stat().st_size
+        units = _schedule(job_units, done)
+        Iter = [(job, chunk, func, IterFASTQRange(inputs[job][0], unit_start, unit_stop, None if inputs[job][2] is None else inputs[job][2].access_point(unit_start)), jobs[job][1])
+                    for reads, job, chunk, unit_start, unit_stop in units]
     
-    start_positions = np.linspace(0, file_length, CHUNKS, False).round().astype(int)
-    stop_positions = np.r_[start_positions[1:], file_length]
-     
-    sample = in_file.name.partition('.fastq')[0]
+        for in_fastq, out_filenames in jobs:
+            for head, tail in map(os.path.split, out_filenames):
+                if head:
+                    os.makedirs(head, exist_ok=True)
     
-    Dir = Path(temp_dir_prefix+sample)
+        n_units = [0]*len(jobs)
+        n_reads = [0]*len(jobs)
+        for reads, job, chunk, unit_start, unit_stop in units:
+            n_units[job] += 1
+            n_reads[job] += reads
+        pending = [{} for job in jobs]      # Outputs of finished units that await their predecessors
+        first_start = [float('inf')]*len(jobs)
+        last_stop = [0.]*len(jobs)
+        busy = [0.]*len(jobs)
+        merge = [0.]*len(jobs)
+        bytes_written = [0]*len(jobs)
+        for job, chunk, output, blocks, unit_start, unit_stop in P.imap_unordered(_map_chunk, Iter, chunksize=1):
+            first_start[job] = min(first_start[job], unit_start)
+            last_stop[job] = max(last_stop[job], unit_stop)
+            busy[job] += unit_stop - unit_start
+            pending[job][chunk] = output, blocks
+            if out_files[job] is None:
+                out_files[job] = [open(f, 'ab') for f in jobs[job][1]]
+            while done[job] in pending[job]:
+                output, blocks = pending[job].pop(done[job])
+                tic = time()
+                for out_file, block in zip(out_files[job], blocks):
+                    out_file.write(block)
+                    out_file.flush()
+                    bytes_written[job] += len(block)
+                merge[job] += time() - tic
+                totals[job] = _add(totals[job], output)
+                done[job] += 1
+                if done[job] == len(job_units[job]):
+                    for out_file in out_files[job]:
+                        out_file.close()
+                    tic = time()
+                    for f in filter(is_derep, jobs[job][1]):
+                        merge_partials(f)
+                    merge[job] += time() - tic
+                    output_sizes = [os.path.getsize(f) for f in jobs[job][1]]
+                else:
+                    output_sizes = [out_file.tell() for out_file in out_files[job]]
+                if manifest is not None:
+                    manifest.chunk_done(jobs[job][0], totals[job], output_sizes)
+    finally:
+        P.terminate()
+        for files in out_files:
+            for out_file in files or []:
+                out_file.close()
+        for Input in inputs:
+            if Input is not None and Input[3] is not None:
+                Input[3].unlink()
+                Input[3].parent.rmdir()
+        if manifest is not None:
+            manifest.save()
+    elapsed = time() - start
+    timings = pd.DataFrame({'Units':n_units, 
+                            'Reads':n_reads,
+                            'Wall Time (s)':[max(stop - start, 0.) for start, stop in zip(first_start, last_stop)],
+                            'Busy Time (s)':busy,
+                            'Merge Time (s)':merge,
+                            'Bytes Written':bytes_written}, index=pd.Index([in_fastq for in_fastq, out_filenames in jobs], name='Input'))
+    return totals, timings, sum(busy)/(CPUs*elapsed)
 
-    with in_file.open('rb') as f:
-          seq_id = f.readline().partition(':'.encode('ascii'))[0]
-    
-    Iter = [(_mid_fastq_iter(in_file, seq_id, start, stop), [str(Dir / head / (str(start)+tail)) for head, tail in map(os.path.split, out_filenames)]) for start, stop in zip(start_positions, stop_positions)]
-    
-    for head, tail in map(os.path.split, out_filenames):
-        os.makedirs(head, exist_ok=True)
-        (Dir / head).mkdir(parents=True, exist_ok=True)
-
-    with multiprocessing.Pool(processes=CPUs) as P:
-        rs = P.starmap_async(func, Iter, chunksize=1)
-        outputs = rs.get()
-    intermediate_files = list(zip(*[outfiles for it, outfiles in Iter]))
-    for f, i_files in zip(out_filenames, intermediate_files):
-        os.system("cat "+' '.join(i_files)+" >> "+f)
-        for File in i_files:
-            os.remove(File)
-        (Dir / f).parent.rmdir()
-    Dir.rmdir()
-    return list(map(sum, zip(*outputs))) if type(outputs[0]) == tuple else sum(outputs)
+def fastq_map_sum(in_fastq, out_filenames, func, CPUs=CPUs-1, temp_dir_prefix='tmp', uncompress_input=True):
+    """Asynchronously processes an input fastq file.
+
+Processes reads from a single FASTQ file by distributing the analysis work 
+across processes. The input is split into chunks of reads, which workers read 
+in place (see in_fastq). Each worker writes its outputs in memory, compressed, 
+and the parent appends them to the output files in input order as they arrive--
+compressed formats are simply concatenated as independent members/frames--so 
+no intermediate files are written. Dereplicated (*.rds) outputs are concatenated
+partial tables until the last chunk, & then merged (see tuba_seq/derep.py).
+fastq_map_sums processes many files at once.
 
+Inputs:
+-------
+in_fastq : Input FASTQ filename. Reads are split into chunks of equal read 
+    counts using a FASTQIndex of record offsets (built once & saved as a sidecar).
+    gzip (including BGZF) files are read in place via a GzipIndex (also a 
+    sidecar, built in the same decompression pass). Sidecars of inputs in 
+    read-only directories are cached in $TUBA_SEQ_CACHE (default: 
+    ~/.cache/tuba_seq). bz2/lzma files cannot be indexed & are decompressed to
+    a temporary file. 
+
+out_files : List of output filenames (appended to). Compression must be 
+    smart_open compliant & support concatenation (all of its codecs do).
+
+func : func(fastq_read_iter, out_files) -> tuple of sum-able objects. out_files 
+    are MemorySinks (named after out_filenames) that func opens with smart_open.
+
+uncompress_input : Permit decompression of bz2/lzma inputs to a temporary file
+    (otherwise, these inputs raise a RuntimeError).
+"""
+    sums, timings, utilization = fastq_map_sums([(in_fastq, out_filenames)], func, CPUs=CPUs, temp_dir_prefix=temp_dir_prefix, uncompress_input=uncompress_input)
+    return sums[0]
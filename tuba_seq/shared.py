@@ -9,23 +9,386 @@ from datetime import datetime
 import atexit, warnings, functools
 from pathlib import Path
 
-import gzip, bz2, lzma
-file_openers = dict(gz=gzip.open, gzip=gzip.open, lzma=lzma.open, xz=lzma.open, bz2=bz2.open)
+import gzip, bz2, lzma, zlib, struct, os, io, threading, queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
-def smart_open(filename, mode='rb', makedirs=False):
-    """Infers compression of file from extension.
+BGZF_BLOCK_SIZE = 0xff00        # Max uncompressed bytes per block, so that every compressed block fits in 64 kB 
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+def _bgzf_block(data, level):
+    """Compresses `data` into a single BGZF block (a gzip member with a 'BC' extra field)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    if len(cdata) > 0xffff - 25:        # Incompressible data: store it instead
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+    return (struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25) + 
+            cdata + 
+            struct.pack('<2I', zlib.crc32(data), len(data)))
+
+_bgzf_executor = None
+def _shared_executor():
+    global _bgzf_executor
+    if _bgzf_executor is None:
+        _bgzf_executor = ThreadPoolExecutor(os.cpu_count())
+    return _bgzf_executor
+
+class BGZFWriter(object):
+    """Writes a BGZF file--a series of independent gzip blocks readable by any gzip 
+tool--compressing blocks on a thread pool (zlib releases the GIL). Blocks are 
+written in order.
+
+Parameters:
+-----------
+filename : Output file.
+
+mode : 'wb' or 'ab' (default: 'wb').
+
+executor : concurrent.futures Executor that compresses blocks, which the writer 
+    shuts down when closed (default: a thread pool of # of CPUs, shared by all 
+    BGZFWriters of the process).
+
+level : zlib compression level (default: 6).
+"""
+    def __init__(self, filename, mode='wb', executor=None, level=6):
+        if mode not in {'w', 'wb', 'a', 'ab'}:
+            raise ValueError("BGZFWriter only writes binary files (mode 'wb' or 'ab').")
+        self.f = filename if isinstance(filename, MemorySink) else open(filename, mode[0]+'b')
+        self.level = level
+        self.owns_executor = executor is not None
+        self.executor = _shared_executor() if executor is None else executor
+        self.threads = self.executor._max_workers
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.closed = False
+
+    def _submit(self, data):
+        self.pending.append(self.executor.submit(_bgzf_block, data, self.level))
+        while len(self.pending) > 2*self.threads:
+            self.f.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= BGZF_BLOCK_SIZE:
+            view = memoryview(self.buffer)
+            full = len(view) - len(view) % BGZF_BLOCK_SIZE
+            for start in range(0, full, BGZF_BLOCK_SIZE):
+                self._submit(bytes(view[start:start + BGZF_BLOCK_SIZE]))
+            view.release()
+            del self.buffer[:full]
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.f.write(self.pending.popleft().result())
+        self.f.flush()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.f.write(BGZF_EOF)
+            self.f.close()
+            if self.owns_executor:
+                self.executor.shutdown()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class BackgroundWriter(object):
+    """Buffers writes into blocks of `block_size` bytes, which a background thread
+writes to file object `f` (compressors release the GIL, so compression overlaps
+with the caller's work). At most `max_blocks` blocks wait in the queue.
+
+`bytes_in` counts the bytes written & `busy` the seconds that the background 
+thread spent writing (i.e. compressing) them.
+"""
+    def __init__(self, f, block_size=2**20, max_blocks=4):
+        self.f = f
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        self.bytes_in = 0
+        self.busy = 0.
+        self.queue = queue.Queue(max_blocks)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._write_blocks, daemon=True)
+        self.thread.start()
+
+    def _write_blocks(self):
+        while True:
+            block = self.queue.get()
+            try:
+                if block is None:
+                    return
+                if self.error is None:
+                    start = perf_counter()
+                    self.f.write(block)
+                    self.busy += perf_counter() - start
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _hand_off(self):
+        self._raise_error()
+        self.queue.put(b''.join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.bytes_in += len(data)
+        if self.buffered >= self.block_size:
+            self._hand_off()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self._hand_off()
+        self.queue.join()
+        self._raise_error()
+        self.f.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.buffer:
+                self.queue.put(b''.join(self.buffer))
+                self.buffer = []
+            self.queue.put(None)
+            self.thread.join()
+            start = perf_counter()
+            self.f.close()
+            self.busy += perf_counter() - start
+            self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _read_blocks(f, block_size, blocks, stopped):
+    """Reads file object `f` into queue `blocks` until EOF (b''), an error (queued), or 
+`stopped` is set. It holds no reference to its BackgroundReader, so an abandoned 
+reader is garbage collected & closed (stopping this thread)."""
+    def put(block):
+        while not stopped.is_set():
+            try:
+                blocks.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    try:
+        while not stopped.is_set():
+            block = f.read(block_size)
+            put(block)
+            if not block:
+                return
+    except Exception as e:
+        put(e)
+
+class BackgroundReader(io.RawIOBase):
+    """Reads file object `f` in blocks of `block_size` bytes on a background thread,
+prefetching up to `max_blocks` blocks. Use prefetch() for a buffered (readline-able)
+reader. Errors of the background thread are raised by the next read.
+"""
+    def __init__(self, f, block_size=2**20, max_blocks=4):
+        self.f = f
+        self.block_size = block_size
+        self.position = f.tell()
+        self.queue = queue.Queue(max_blocks)
+        self.stopped = threading.Event()
+        self.pending = memoryview(b'')
+        self.eof = False
+        self.error = None
+        self.thread = threading.Thread(target=_read_blocks, args=(f, block_size, self.queue, self.stopped), daemon=True)
+        self.thread.start()
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, b):
+        while not len(self.pending):
+            if self.error is not None:
+                raise self.error
+            if self.eof:
+                return 0
+            block = self.queue.get()
+            if isinstance(block, Exception):
+                self.error = block
+                raise block
+            if not block:
+                self.eof = True
+                return 0
+            self.pending = memoryview(block)
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        self.position += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.f.close()
+        super(BackgroundReader, self).close()
+
+class MemorySink(io.BytesIO):
+    """In-memory output file named `name`: smart_open(sink, 'wb') writes into it with 
+the codec of `name` (e.g. 'reads.fastq.gz'), and its contents remain available 
+(getvalue) after it is closed.
+"""
+    def __init__(self, name):
+        super(MemorySink, self).__init__()
+        self.name = name
+
+    def close(self):
+        pass
+
+def prefetch(f, block_size=2**20, max_blocks=4):
+    """Buffered reader of file object `f` that decompresses/reads ahead on a background thread."""
+    return io.BufferedReader(BackgroundReader(f, block_size, max_blocks), block_size)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+def _level_kargs(keyword, level):
+    return {} if level is None else {keyword:level}
+
+def _gzip_open(filename, mode, level=None, threads=None):
+    return gzip.open(filename, mode, **_level_kargs('compresslevel', level))
+
+def _bz2_open(filename, mode, level=None, threads=None):
+    return bz2.open(filename, mode, **_level_kargs('compresslevel', level))
+
+def _lzma_open(filename, mode, level=None, threads=None):
+    return lzma.open(filename, mode, **_level_kargs('preset', level)) if mode[0] in 'wax' else lzma.open(filename, mode)
+
+def _bgzf_open(filename, mode, level=None, threads=None):
+    if mode[0] not in 'wa':
+        return gzip.open(filename, mode)
+    executor = None if threads is None else ThreadPoolExecutor(threads)
+    return BGZFWriter(filename, mode, executor=executor, **_level_kargs('level', level))
+
+def _zstd_open(filename, mode, level=None, threads=None):
+    if zstandard is None:
+        raise RuntimeError("zstd compression requires the `zstandard` package (pip install zstandard).")
+    if mode[0] in 'wax':
+        kargs = _level_kargs('level', level)
+        kargs['threads'] = -1 if threads is None else threads    # -1 = all CPUs
+        return zstandard.open(filename, mode, cctx=zstandard.ZstdCompressor(**kargs))
+    return zstandard.open(filename, mode)
+
+def _lz4_open(filename, mode, level=None, threads=None):
+    if lz4 is None:
+        raise RuntimeError("lz4 compression requires the `lz4` package (pip install lz4).")
+    return lz4.frame.open(filename, mode, **_level_kargs('compression_level', level))
+
+def _uncompressed_open(filename, mode, level=None, threads=None):
+    return filename if isinstance(filename, MemorySink) else open(filename, mode)
+
+file_openers = dict(gz=_gzip_open, gzip=_gzip_open, bgz=_gzip_open, bgzf=_bgzf_open, 
+                    bz2=_bz2_open, lzma=_lzma_open, xz=_lzma_open, 
+                    zst=_zstd_open, zstd=_zstd_open, lz4=_lz4_open, none=_uncompressed_open)
+magic_numbers = [(b'\x1f\x8b', 'gz'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zst'), (b'\x04\x22\x4d\x18', 'lz4')]
+compression_extensions = dict(bgzf='.gz', none='')
+
+def available_codecs():
+    """`--compression` choices whose libraries are installed."""
+    unavailable = ({'zst'} if zstandard is None else set()) | ({'lz4'} if lz4 is None else set())
+    return [codec for codec in ['gz', 'bgzf', 'bz2', 'lzma', 'zst', 'lz4', 'none'] if codec not in unavailable]
+
+def compression_ext(compression):
+    """Filename extension of a `--compression` choice (e.g. 'bgzf' -> '.gz', 'none' -> '')."""
+    return compression_extensions.get(compression, '.'+compression)
+
+def detect_compression(filename):
+    """Codec of an existing file from its magic bytes ('none' if unrecognized or empty)."""
+    with open(str(filename), 'rb') as f:
+        head = f.read(6)
+    for magic, codec in magic_numbers:
+        if head.startswith(magic):
+            return codec
+    return 'none'
+
+def sidecar_paths(filename, ext):
+    """(locations to look for, location to write) of sidecar `ext` (e.g. an index) of 
+`filename`. Sidecars are written next to their file if its directory is writable,
+& otherwise into the cache directory ($TUBA_SEQ_CACHE, default: ~/.cache/tuba_seq),
+so read-only data directories are never written to.
+"""
+    import hashlib
+    filename = os.path.abspath(str(filename))
+    cache_dir = os.environ.get('TUBA_SEQ_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'tuba_seq'))
+    key = hashlib.blake2b(filename.encode(), digest_size=8).hexdigest()
+    adjacent = filename + ext
+    cached = os.path.join(cache_dir, key + '.' + os.path.basename(filename) + ext)
+    return [adjacent, cached], adjacent if os.access(os.path.dirname(filename), os.W_OK) else cached
+
+def smart_open(filename, mode='rb', makedirs=False, compression=None, level=None, threads=None, background=False):
+    """Opens a (compressed) file. Codecs of existing files are read from magic 
+bytes; codecs of new files are inferred from the extension.
 
 Parameters:
 -----------
 mode : Filemode string (default: 'rb').     
 
 makedirs : Create directory tree for file, if non-existent (default: False).
+
+compression : Codec to use instead of the inferred codec, e.g. 'bgzf' writes a 
+    .gz file as parallel-compressed BGZF (default: None).
+
+level : Compression level of the codec (default: the codec's default).
+
+threads : Compression threads, for codecs that support them (bgzf & zst; 
+    default: all CPUs).
+
+background : (De)compress on a background thread: writes are handed off in 
+    large blocks (BackgroundWriter) & reads are prefetched (prefetch). Binary 
+    modes only (default: False).
+
+`filename` may also be a MemorySink, which is written in memory (with the codec 
+of its name).
 """
-    File = Path(filename)
-    if makedirs: 
+    in_memory = isinstance(filename, MemorySink)
+    File = Path(filename.name if in_memory else filename)
+    if makedirs and not in_memory: 
         File.parent.mkdir(exist_ok=True)
-    open_func = file_openers.get(File.suffix[1:], open)
-    return open_func(str(filename), mode)
+    if compression is None:
+        if mode[0] == 'r' and not in_memory and File.is_file():
+            compression = detect_compression(File)
+        else:
+            compression = File.suffix[1:] if File.suffix[1:] in file_openers else 'none'
+    f = file_openers[compression](filename if in_memory else str(filename), mode, level=level, threads=threads)
+    if background:
+        return BackgroundWriter(f) if mode[0] in 'wax' else prefetch(f)
+    return f
     
 class logPrint(object):
     def line_break(self):
@@ -0,0 +1,104 @@
+"""Bounded-memory counts of the most frequent items of a stream.
+
+A SpaceSaving sketch tracks at most ~2 x `capacity` items. Items are counted
+exactly until the sketch is full; it is then pruned to the `capacity` items
+with the largest counts, & the largest pruned count becomes the sketch's
+`floor`: an upper bound on the (uncounted) occurrences of every untracked item.
+Items that enter the sketch after pruning begin at the floor, so that every
+count is an upper bound on the item's true occurrences (count - error is a
+lower bound), & every item that occurs more than `floor` times is tracked.
+
+Sketches are summable (sketch_1 + sketch_2, or sum([...])), so sketches of the
+chunks of a file (see pmap.fastq_map_sum), or of many samples, merge like the
+other outputs of MasterRead.iter_fastq. Merged counts & floors are sums, which
+keeps both bounds.
+"""
+import pandas as pd
+
+DEFAULT_CAPACITY = 10000
+
+class SpaceSaving(object):
+    """Most frequent items of a stream (see module docstring).
+
+Parameters:
+-----------
+capacity : Number of items retained when the sketch is pruned (default: 10000).
+"""
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}        # Overestimates of items counted from the floor
+        self.floor = 0
+        self.total = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, item):
+        count = self.counts.get(item)
+        if count is None:
+            if self.floor:
+                self.errors[item] = self.floor
+            self.counts[item] = self.floor + 1
+            if len(self.counts) > 2*self.capacity:
+                self._prune()
+        else:
+            self.counts[item] = count + 1
+        self.total += 1
+
+    def _prune(self):
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        if len(ranked) > self.capacity:
+            self.floor = max(self.floor, ranked[self.capacity][1])
+            self.counts = dict(ranked[:self.capacity])
+            self.errors = {item:error for item, error in self.errors.items() if item in self.counts}
+
+    def __add__(self, other):
+        if not isinstance(other, SpaceSaving):
+            return NotImplemented
+        merged = SpaceSaving(max(self.capacity, other.capacity))
+        for item in self.counts.keys() | other.counts.keys():
+            merged.counts[item] = self.counts.get(item, self.floor) + other.counts.get(item, other.floor)
+            error = (self.errors.get(item, 0) if item in self.counts else self.floor) + (other.errors.get(item, 0) if item in other.counts else other.floor)
+            if error:
+                merged.errors[item] = error
+        merged.floor = self.floor + other.floor
+        merged.total = self.total + other.total
+        merged._prune()
+        return merged
+
+    def __radd__(self, other):
+        if other == 0:      # The start of sum()
+            return self
+        return self.__add__(other)
+
+    def top(self, n=None):
+        """pd.Series of the counts (upper bounds) of the `n` most frequent items (default: all tracked items)."""
+        counts = pd.Series(self.counts, name='Occurrences', dtype=int).sort_values(ascending=False)
+        return counts if n is None else counts.iloc[:n]
+
+    def heavy_hitters(self, threshold):
+        """pd.Series of the counts of every item that may occur at least `threshold` times (i.e. whose count does)."""
+        counts = self.top()
+        return counts.loc[counts >= threshold]
+
+    def guaranteed(self):
+        """pd.Series of the lower bounds (count - error) of the counts of every tracked item."""
+        return (self.top() - pd.Series(self.errors, dtype=int)).fillna(self.top()).astype(int).sort_values(ascending=False)
+
+    def to_dict(self):
+        """JSON-able form of the sketch (bytes items are decoded as ASCII)."""
+        decode = lambda item: item.decode('ascii') if isinstance(item, bytes) else item
+        return dict(capacity=self.capacity, floor=self.floor, total=self.total, bytes=any(isinstance(item, bytes) for item in self.counts),
+                    counts={decode(item):count for item, count in self.counts.items()},
+                    errors={decode(item):error for item, error in self.errors.items()})
+
+    @classmethod
+    def from_dict(cls, d):
+        self = cls(d['capacity'])
+        encode = (lambda item: item.encode('ascii')) if d['bytes'] else (lambda item: item)
+        self.counts = {encode(item):count for item, count in d['counts'].items()}
+        self.errors = {encode(item):error for item, error in d['errors'].items()}
+        self.floor = d['floor']
+        self.total = d['total']
+        return self
@@ -52,10 +52,75 @@ def construct_alignment(q, r, nQryBeg, nRefBeg, lCigar):
 o_N = ord(b'N')
 o_gap = ord(b'-')
 
+class Alignment(object):
+    """Outcome of aligning a read (query) to a degenerate reference, e.g. MasterRead.c_ref.
+
+Everything downstream needs from an alignment is derived from a single SSW call:
+
+score : Smith-Waterman score of the alignment.
+
+N_start, N_stop : Position of the degenerate (N) region of the reference, 
+    projected onto the query.
+
+query_begin, query_end : 0-based, inclusive boundaries of the alignment on the query.
+
+query_align, ref_align : CIGAR-derived projection of the alignment (gaps as '-').
+
+filled : The query with its N bases replaced by the reference (computed lazily).
+"""
+    __slots__ = ['query', 'query_align', 'ref_align', 'score', 'query_begin', 'query_end', 'N_start', 'N_stop', '_filled']
+
+    def __init__(self, query, query_align, ref_align, score, query_begin, query_end):
+        self.query = query
+        self.query_align = query_align
+        self.ref_align = ref_align
+        self.score = score
+        self.query_begin = query_begin
+        self.query_end = query_end
+        N_start = ref_align.find(b'N')
+        N_stop = ref_align.rfind(b'N') + 1
+        head_gaps = query_align[0:N_start].count(b'-')
+        barcode_gaps = query_align[N_start:N_stop].count(b'-')
+        self.N_start = query_begin + N_start - head_gaps
+        self.N_stop = query_begin + N_stop - head_gaps - barcode_gaps
+        self._filled = None
+
+    @property
+    def filled(self):
+        if self._filled is None:
+            middle = bytes(bytearray([q if (q != o_N or r == o_gap) else r for q, r in zip(self.query_align, self.ref_align) if q != o_gap]))
+            self._filled = self.query[:self.query_begin] + middle + self.query[self.query_end+1:]
+        return self._filled
+
 class SW(object):
-    def __dealloc__(self):
-        ssw.init_destroy(self.qProfile)
-        ssw.align_destroy(self.res)
+    """Smith-Waterman aligner. 
+
+The query profile & result of the most recent alignment are retained (as 
+self.qProfile & self.res) until the next alignment, when they are freed. Call 
+close()--or use the aligner as a context manager--to free them immediately. 
+"""
+    qProfile = None
+    res = None
+
+    def _release(self):
+        if self.res:
+            ssw.align_destroy(self.res)
+        if self.qProfile:
+            ssw.init_destroy(self.qProfile)
+        self.res = None
+        self.qProfile = None
+
+    def close(self):
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
 
     def __init__(self, match=6, mismatch=2, gap_open=6, gap_extend=1):
         # init DNA score matrix
@@ -74,7 +139,9 @@ class SW(object):
         self.lEle = lEle
 
     def char_align(self, char_query, char_reference):
-        nQuery = self.nEle2Int[list(char_query)].ctypes.data_as(ct.POINTER(ct.c_int8))
+        self._release()
+        self._nQuery = self.nEle2Int[list(char_query)]
+        nQuery = self._nQuery.ctypes.data_as(ct.POINTER(ct.c_int8))
         self.qProfile = ssw.ssw_init(nQuery, ct.c_int32(len(char_query)), self.mat, len(self.lEle), 2)
         nMaskLen = len(char_query) // 2 if len(char_query) > 30 else 15
         nFlag = 2
@@ -85,31 +152,29 @@ class SW(object):
         out = construct_alignment(char_query, char_reference, contents.nQryBeg, contents.nRefBeg, lCigar)
         return out
 
-    def find_N_start_stop(self, char_query, char_reference):
+    def barcode_align(self, char_query, char_reference):
+        """Aligns `char_query` once & returns an Alignment (score, N start/stop, filled read)."""
         query_align, ref_align = self.char_align(char_query, char_reference)
-        query_begin = self.res.contents.nQryBeg
-        N_start = ref_align.find(b'N')
-        N_stop = ref_align.rfind(b'N') + 1
-        head_gaps = query_align[0:N_start].count(b'-')
-        barcode_gaps = query_align[N_start:N_stop].count(b'-')
-        return query_begin + N_start - head_gaps, query_begin + N_stop - head_gaps - barcode_gaps
+        contents = self.res.contents
+        return Alignment(char_query, query_align, ref_align, contents.nScore, contents.nQryBeg, contents.nQryEnd)
+
+    def find_N_start_stop(self, char_query, char_reference):
+        alignment = self.barcode_align(char_query, char_reference)
+        return alignment.N_start, alignment.N_stop
 
     def ClonTracer_start(self, char_query, char_reference):
-        query_align, ref_align = self.char_align(char_query, char_reference)
-        return self.res.contents.nQryBeg
+        return self.barcode_align(char_query, char_reference).query_begin
 
     def fill_Ns(self, char_query, char_reference):
-        query_align, ref_align = self.char_align(char_query, char_reference)
-        middle = bytes(bytearray([q if (q != o_N or r == o_gap) else r for q, r in zip(query_align, ref_align) if q != o_gap]))
-        contents = self.res.contents
-        out = char_query[:contents.nQryBeg] + middle + char_query[contents.nQryEnd+1:]
-        return out
+        return self.barcode_align(char_query, char_reference).filled
 
     def align(self, query, reference):
         return self.char_align(query.encode('ascii'), reference.encode('ascii'))
 
     def char_score(self, char_query, char_reference):
-        nQuery = self.nEle2Int[list(char_query)].ctypes.data_as(ct.POINTER(ct.c_int8))
+        self._release()
+        self._nQuery = self.nEle2Int[list(char_query)]
+        nQuery = self._nQuery.ctypes.data_as(ct.POINTER(ct.c_int8))
         self.qProfile = ssw.ssw_init(nQuery, ct.c_int32(len(char_query)), self.mat, len(self.lEle), 2)
         nMaskLen = len(char_query) // 2 if len(char_query) > 30 else 15
         nFlag = 0
@@ -117,21 +182,52 @@ class SW(object):
         self.res = ssw.ssw_align(self.qProfile, nReference, ct.c_int32(len(char_reference)), self.gap_open, self.gap_extend, nFlag, 0, 0, nMaskLen)
         return self.res.contents.nScore
 
-    def fill_Ns(self, char_query, char_reference):
-        query_align, ref_align = self.char_align(char_query, char_reference)
-        middle = bytes(bytearray([q if (q != o_N or r == o_gap) else r for q, r in zip(query_align, ref_align) if q != o_gap]))
-        contents = self.res.contents
-        out = char_query[:contents.nQryBeg] + middle + char_query[contents.nQryEnd+1:]
+class ReferenceSW(SW):
+    """SW aligner with a query profile built once on a fixed reference.
+
+SW.char_align builds (& allocates) a query profile for every read. When millions
+of reads are aligned to the same reference (e.g. MasterRead.c_ref), it is much 
+cheaper to build the profile once on the reference and to stream reads through 
+it as the alignment target. The profile is freed when the aligner is destroyed.
+"""
+    def __init__(self, char_reference, **kargs):
+        super(ReferenceSW, self).__init__(**kargs)
+        self.char_reference = char_reference
+        # ssw_init keeps pointers to both the encoded reference & self.mat, so they must outlive the profile.
+        self._nReference = self.nEle2Int[list(char_reference)]
+        self.rProfile = ssw.ssw_init(self._nReference.ctypes.data_as(ct.POINTER(ct.c_int8)), ct.c_int32(len(char_reference)), self.mat, len(self.lEle), 2)
+        self.nMaskLen = len(char_reference) // 2 if len(char_reference) > 30 else 15
+
+    def close(self):
+        super(ReferenceSW, self).close()
+        if getattr(self, 'rProfile', None) is not None:
+            ssw.init_destroy(self.rProfile)
+            self.rProfile = None
+
+    def __reduce__(self):
+        # ctypes pointers cannot be pickled, so child processes rebuild the profile.
+        return (_rebuild_ReferenceSW, (self.char_reference, dict(match=self.match, mismatch=self.mismatch, gap_open=self.gap_open, gap_extend=self.gap_extend)))
+
+    def _align_read(self, char_read, nFlag):
+        nRead = self.nEle2Int[list(char_read)].ctypes.data_as(ct.POINTER(ct.c_int8))
+        return ssw.ssw_align(self.rProfile, nRead, ct.c_int32(len(char_read)), self.gap_open, self.gap_extend, nFlag, 0, 0, self.nMaskLen)
+
+    def barcode_align(self, char_read):
+        """Aligns `char_read` to the profiled reference & returns an Alignment."""
+        res = self._align_read(char_read, 2)
+        contents = res.contents
+        lCigar = [contents.sCigar[idx] for idx in range(contents.nCigarLen)]
+        # Roles are reversed: the profiled reference is the SSW query & the read is the SSW target.
+        ref_align, read_align = construct_alignment(self.char_reference, char_read, contents.nQryBeg, contents.nRefBeg, lCigar)
+        out = Alignment(char_read, read_align, ref_align, contents.nScore, contents.nRefBeg, contents.nRefEnd)
+        ssw.align_destroy(res)
         return out
 
-    def align(self, query, reference):
-        return self.char_align(query.encode('ascii'), reference.encode('ascii'))
+    def score(self, char_read):
+        res = self._align_read(char_read, 0)
+        out = res.contents.nScore
+        ssw.align_destroy(res)
+        return out
 
-    def char_score(self, char_query, char_reference):
-        nQuery = self.nEle2Int[list(char_query)].ctypes.data_as(ct.POINTER(ct.c_int8))
-        self.qProfile = ssw.ssw_init(nQuery, ct.c_int32(len(char_query)), self.mat, len(self.lEle), 2)
-        nMaskLen = len(char_query) // 2 if len(char_query) > 30 else 15
-        nFlag = 0
-        nReference = self.nEle2Int[list(char_reference)].ctypes.data_as(ct.POINTER(ct.c_int8))
-        self.res = ssw.ssw_align(self.qProfile, nReference, ct.c_int32(len(char_reference)), self.gap_open, self.gap_extend, nFlag, 0, 0, nMaskLen)
-        return self.res.contents.nScore
+def _rebuild_ReferenceSW(char_reference, kargs):
+    return ReferenceSW(char_reference, **kargs)
@@ -0,0 +1,198 @@
+"""Synthetic Tuba-seq libraries, for benchmarking & testing the pipeline.
+
+A SyntheticLibrary is a set of tumors--each an sgRNA (from an sgRNA_info.csv
+file) & a random barcode (from the degenerate pattern of a master read)--with
+lognormally-distributed sizes, plus a few large spike-in barcodes. From it:
+
+1) write_fastq() writes merged amplicon reads, sampled in proportion to tumor
+    size, with substitution, indel & N rates, and a fraction of contaminating
+    (unalignable) reads, drawn from a contaminant genome (e.g. PhiX) if one is
+    provided. Reads are generated in vectorized blocks, so 100M-read files are
+    practical.
+
+2) write_clusters() writes DADA2-style cluster CSVs (the input of
+    bin/postprocess.py) of the tumors of every sample.
+
+3) truth() tabulates the tumors & their expected fraction of reads.
+"""
+import os
+import numpy as np
+import pandas as pd
+from tuba_seq.shared import smart_open
+
+bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+complement = np.arange(256, dtype=np.uint8)
+complement[bases] = bases[::-1]
+PLUS = np.frombuffer(b'\n+\n', dtype=np.uint8)
+NEWLINE = np.frombuffer(b'\n', dtype=np.uint8)
+HIGH_QUALITY = ord('F')     # Phred 37
+LOW_QUALITY = ord('+')      # Phred 10, at substitutions & N bases
+ID_DIGITS = 10
+
+def _fill(pattern, rng, n):
+    """(n x len(pattern)) uint8 matrix of `pattern` with its '.' & 'N' positions randomized."""
+    template = np.frombuffer(pattern.upper().replace('.', 'N').encode('ascii'), dtype=np.uint8)
+    seqs = np.tile(template, (n, 1))
+    degenerate = template == ord('N')
+    seqs[:, degenerate] = bases[rng.randint(0, 4, size=(n, degenerate.sum()))]
+    return seqs
+
+def _genome(genome):
+    """uint8 array of a genome, given as a sequence (str) or a FASTA filename."""
+    if os.path.isfile(genome):
+        with smart_open(genome, 'rb') as f:
+            genome = b''.join(line.strip() for line in f if not line.startswith(b'>')).decode('ascii')
+    return np.frombuffer(genome.upper().encode('ascii'), dtype=np.uint8)
+
+def _windows(genome, rng, n, L):
+    """(n x L) uint8 matrix of random windows of either strand of `genome`."""
+    if len(genome) < L:
+        raise ValueError("Contaminant genome ({:} bp) is shorter than the reads ({:} bp).".format(len(genome), L))
+    windows = genome[rng.randint(0, len(genome) - L + 1, size=n)[:, np.newaxis] + np.arange(L)]
+    reverse = rng.random_sample(n) < 0.5
+    windows[reverse] = complement[windows[reverse, ::-1]]
+    return windows
+
+def _as_strings(matrix):
+    if matrix.shape[1] == 0:
+        return np.full(len(matrix), '', dtype=object)
+    return np.ascontiguousarray(matrix).view('S{:}'.format(matrix.shape[1])).ravel().astype(str)
+
+class SyntheticLibrary(object):
+    """Tumors of a synthetic Tuba-seq experiment (see module docstring).
+
+Parameters:
+-----------
+sgRNA_info : DataFrame (or CSV filename) of sgRNAs with 'ID' & 'target' columns.
+
+master_read : Outline of the amplicon; its degenerate ('.' or 'N') region begins
+    with the sgID, followed by the random barcode.
+
+barcodes : Number of tumors (barcodes) per sgRNA (default: 1000).
+
+size_sigma : Standard deviation of log tumor sizes (default: 1.5).
+
+spike_barcodes : Number of spike-in barcodes (of the 'Spike' target, if present)
+    (default: 3).
+
+spike_size : Size of each spike-in barcode, relative to the median tumor
+    (default: 100).
+
+seed : Seed of the random number generator (default: None).
+"""
+    def __init__(self, sgRNA_info, master_read, barcodes=1000, size_sigma=1.5, spike_barcodes=3, spike_size=100, seed=None):
+        if not isinstance(sgRNA_info, pd.DataFrame):
+            sgRNA_info = pd.read_csv(sgRNA_info)
+        self.rng = np.random.RandomState(seed)
+        self.master_read = master_read.upper().replace('.', 'N')
+        start = self.master_read.index('N')
+        stop = self.master_read.rindex('N') + 1
+        self.head = self.master_read[:start]
+        self.tail = self.master_read[stop:]
+        IDs = sgRNA_info['ID'].str.upper()
+        sgID_length = IDs.str.len().max()
+        self.barcode_pattern = self.master_read[start + sgID_length:stop]
+
+        is_spike = (sgRNA_info['target'] == 'Spike').values
+        counts = np.where(is_spike, spike_barcodes, barcodes)
+        sgRNAs = np.repeat(np.arange(len(sgRNA_info)), counts)
+        sizes = np.exp(size_sigma*self.rng.randn(len(sgRNAs)))
+        sizes[is_spike[sgRNAs]] = spike_size
+        self.tumors = pd.DataFrame({'target':sgRNA_info['target'].values[sgRNAs],
+                                    'ID':IDs.values[sgRNAs],
+                                    'barcode':_as_strings(_fill(self.barcode_pattern, self.rng, len(sgRNAs))),
+                                    'size':sizes})
+        self.amplicons = np.vstack([np.frombuffer((self.head+ID+barcode+self.tail).encode('ascii'), dtype=np.uint8)
+                                    for ID, barcode in zip(self.tumors['ID'], self.tumors['barcode'])])
+
+    def truth(self):
+        """The tumors & their expected fraction of (uncontaminated) reads."""
+        return self.tumors.assign(fraction=self.tumors['size']/self.tumors['size'].sum())
+
+    def _read_block(self, first_read, n, fractions, error_rate, indel_rate, N_rate, contamination, genome):
+        """FASTQ bytes of n reads, numbered from first_read, of tumors with expected `fractions` of reads."""
+        rng = self.rng
+        L = self.amplicons.shape[1]
+        tumors = rng.choice(len(self.tumors), size=n, p=fractions)
+        DNA = self.amplicons[tumors]
+        contaminants = rng.random_sample(n) < contamination
+        if genome is None:
+            DNA[contaminants] = bases[rng.randint(0, 4, size=(contaminants.sum(), L))]
+        else:
+            DNA[contaminants] = _windows(genome, rng, contaminants.sum(), L)
+        QC = np.full((n, L), HIGH_QUALITY, dtype=np.uint8)
+
+        errors = rng.random_sample((n, L)) < error_rate
+        codes = np.searchsorted(bases, DNA[errors])
+        DNA[errors] = bases[(codes + rng.randint(1, 4, size=len(codes))) % 4]
+        Ns = rng.random_sample((n, L)) < N_rate
+        DNA[Ns] = ord('N')
+        QC[errors | Ns] = LOW_QUALITY
+
+        numbers = first_read + np.arange(n)
+        digits = (numbers[:, np.newaxis]//10**np.arange(ID_DIGITS - 1, -1, -1)) % 10 + ord('0')
+        prefix = np.frombuffer(b'@SYNTH:1:FC:1:1:', dtype=np.uint8)
+        suffix = np.frombuffer(b' 1:N:0:1\n', dtype=np.uint8)
+        headers = np.hstack([np.tile(prefix, (n, 1)), digits.astype(np.uint8), np.tile(suffix, (n, 1))])
+
+        indels = rng.random_sample(n) < indel_rate*L
+        fixed = ~indels
+        records = np.hstack([headers[fixed], DNA[fixed], np.tile(PLUS, (fixed.sum(), 1)), QC[fixed], np.tile(NEWLINE, (fixed.sum(), 1))])
+        block = [records.tobytes()]
+        for i in np.flatnonzero(indels):    # Indels (1-3 bp) change read lengths, so these reads are formatted individually
+            position = rng.randint(1, L - 1)
+            size = rng.randint(1, 4)
+            if rng.random_sample() < 0.5:
+                dna = np.r_[DNA[i, :position], bases[rng.randint(0, 4, size=size)], DNA[i, position:]]
+                qc = np.r_[QC[i, :position], np.full(size, HIGH_QUALITY, dtype=np.uint8), QC[i, position:]]
+            else:
+                dna = np.r_[DNA[i, :position], DNA[i, position + size:]]
+                qc = np.r_[QC[i, :position], QC[i, position + size:]]
+            block.append(b''.join([headers[i].tobytes(), dna.astype(np.uint8).tobytes(), b'\n+\n', qc.astype(np.uint8).tobytes(), b'\n']))
+        return b''.join(block)
+
+    def write_fastq(self, filename, reads, error_rate=1e-3, indel_rate=1e-5, N_rate=1e-3, contamination=0.01, contaminant_genome=None, block_size=100000):
+        """Writes `reads` synthetic reads to `filename` (compressed according to its extension).
+
+Parameters:
+-----------
+error_rate : Probability of a substitution at every base (default: 0.001).
+
+indel_rate : Probability of an indel (1-3 bp) at every base, i.e. at most
+    one per read (default: 1e-5).
+
+N_rate : Probability of an N at every base (default: 0.001).
+
+contamination : Fraction of contaminating reads, which will not align (default: 0.01).
+
+contaminant_genome : Sequence (str) or FASTA file of the genome that contaminating
+    reads are drawn from (random windows of either strand), e.g. PhiX174, which is
+    not distributed with tuba_seq (default: None, i.e. uniformly random sequence).
+"""
+        fractions = self.truth()['fraction'].values
+        genome = None if contaminant_genome is None else _genome(contaminant_genome)
+        with smart_open(filename, 'wb', background=True) as f:
+            for first_read in range(0, reads, block_size):
+                f.write(self._read_block(first_read, min(block_size, reads - first_read), fractions, error_rate, indel_rate, N_rate, contamination, genome))
+
+    def write_clusters(self, directory, samples, reads_per_sample=1000000, flank=4):
+        """Writes a DADA2-style cluster CSV (<sample>.csv) of every sample to `directory`.
+
+Every sample contains every tumor, with abundances drawn (Poisson) from its
+expected reads. Cluster sequences include `flank` bases on each side of the sgID
+& barcode (see bin/postprocess.py --flank).
+"""
+        os.makedirs(directory, exist_ok=True)
+        truth = self.truth()
+        start = len(self.head)
+        sequences = _as_strings(self.amplicons[:, start - flank:len(self.master_read) - len(self.tail) + flank])
+        filenames = []
+        for i in range(samples):
+            abundance = self.rng.poisson(truth['fraction'].values*reads_per_sample) + 1
+            n0 = self.rng.binomial(abundance, 0.9)
+            clusters = pd.DataFrame({'sequence':sequences, 'abundance':abundance, 'n0':n0, 'n1':abundance - n0, 'nunq':1,
+                                     'pval':0., 'birth_pval':0., 'birth_ham':0})
+            filename = os.path.join(directory, 'Sample{:}.csv'.format(i))
+            clusters.to_csv(filename, index=False)
+            filenames.append(filename)
+        return filenames
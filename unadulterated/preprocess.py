@@ -32,6 +32,7 @@ parser.add_argument("--base_dir", type=str, default=os.getcwd(),
 help='Base directory to work within. This directory must contain a folder entitled "{:}" containing all FASTQ files to process.'.format(params.original_dir))
 parser.add_argument("-v", "--verbose", help='Output more Info', action="store_true")
 parser.add_argument('-p', '--parallel', action='store_true', help='Multithreaded operation')
+parser.add_argument('--chunksize', type=int, default=1000000, help='Number of reads to process at a time (bounds memory usage).')
 parser.add_argument('-e', '--maxEE', type=float, default=2, help='Maximum Expected Errors per read (default 2.)')
 
 args = parser.parse_args()
@@ -80,12 +81,18 @@ tail_matchers = [fastq.singleMismatcher(params.tail[i:i+match_len]) for i in off
 start_expected = min(len(params.head), len(params.tail))
 stop_expected = start_expected + params.barcode_length
 
-def process_file(f):
-    """Processes a FASTQ file into a training file for DADA2 & a barcode clustering file
+def drop_abnormal_lengths(reads, lengths, key):
+    """reads.drop_abnormal_lengths() with the normal length of the file's first chunk (stored in `lengths`)."""
+    if key not in lengths:
+        lengths[key] = reads.normal_length()
+    return reads.drop_abnormal_lengths(lengths[key])
+
+def process_chunk(df, f, short_filename, append, lengths):
+    """Processes a chunk of a FASTQ file into a training file for DADA2 & a barcode clustering file.
+
+Normal read lengths are determined by the first chunk & saved in `lengths` for later chunks.
 """
-    df = (fastq.fastqDF.from_file(os.path.join(params.original_dir, f), use_Illumina_filter=True, fake_header=False)
-                       .co_slice(symmetric_immediate_truncation_of_read))
-    short_filename = f.split(params.fastq_handle)[0]
+    df = df.co_slice(symmetric_immediate_truncation_of_read)
     
     # Attempt #1 to repair N bases
     degen = df['DNA'].str.contains("N")
@@ -128,25 +135,21 @@ def process_file(f):
     # Train DADA2 only on the barcode-flanking regions of reads
     train_starts = starts[was_not_degen].apply(lambda start: slice(start-training_flank, start))
     train_stops  =  stops[was_not_degen].apply(lambda stop:  slice(stop, stop + training_flank))
-    (train.vector_slice(train_starts, train_stops)
-          .drop_abnormal_lengths()
-          .write(params.training_dir+f))
+    drop_abnormal_lengths(train.vector_slice(train_starts, train_stops), lengths, 'training').write(params.training_dir+f, append=append)
 
     # Trim reads for DADA2 clustering 
-    slices = starts.apply(lambda start: slice(start - cluster_flank, start + cluster_distance_from_start))
-    sliced = passed_kmers.vector_slice(slices).drop_abnormal_lengths()
-    cluster = (sliced.select_reads(~sliced.isDegenerate())
-                     .drop_abnormal_lengths())
+    slices = (starts.values - cluster_flank, starts.values + cluster_distance_from_start)
+    sliced = drop_abnormal_lengths(passed_kmers.to_matrix().vector_slice(slices), lengths, 'sliced')
+    cluster = drop_abnormal_lengths(sliced.select_reads(~sliced.isDegenerate()), lengths, 'cluster')
     
     # Discard reads with poor QC scores
     EEs = cluster.expected_errors()
     clean = cluster.select_reads(EEs <= args.maxEE)
 
     # Write clustering file
-    clean.write(params.preprocessed_dir+('{short_filename}.fastq'.format(**locals())))
+    clean.write(params.preprocessed_dir+('{short_filename}.fastq'.format(**locals())), append=append)
     
-    #Output summary
-    counts = dict(saved = initial_wrongs - final_wrongs,
+    return dict(saved = initial_wrongs - final_wrongs,
                   reads = len(df),
            passed_kmers = len(passed_kmers),
                 cluster = len(cluster),
@@ -155,9 +158,18 @@ def process_file(f):
             good_flanks = len(passed_kmers)+truncated_degen,
                     EEs = EEs.sum())
 
+def process_file(f):
+    """Processes a FASTQ file, in chunks of `--chunksize` reads, into a training file for DADA2 & a barcode clustering file
+"""
+    short_filename = f.split(params.fastq_handle)[0]
+    chunks = fastq.fastqDF.iter_chunks(os.path.join(params.original_dir, f), chunksize=args.chunksize, use_Illumina_filter=True, fake_header=False)
+    lengths = {}
+    counts = pd.DataFrame([process_chunk(df, f, short_filename, i > 0, lengths) for i, df in enumerate(chunks)]).sum()
+
+    #Output summary
     reads = counts['reads']
     percents = {k:v/reads for k, v in counts.items()}
-    percents['EE_rate'] = counts['EEs']/(len(clean)*len(clean['DNA'].values[0]))
+    percents['EE_rate'] = counts['EEs']/(counts['clean']*(params.barcode_length + 2*cluster_flank))
     Log("{:} ({:.2}M reads): {good_flanks:.0%} good flanks, {clean:.0%} used. Estimated Error Rate: {EE_rate:.3%}.".format(
         short_filename, reads*1e-6, **percents), print_line=True)
     return counts